@@ -1,7 +1,7 @@
 import os
 import sqlite3
-from datetime import datetime, timedelta
-import traceback
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
 from flask import (
     Flask, 
     render_template, 
@@ -14,234 +14,3420 @@ from flask import (
     jsonify, 
     make_response,
     g,
-    send_from_directory
+    has_request_context,
+    send_from_directory,
+    Response,
+    stream_with_context,
+    before_render_template,
+    template_rendered
 )
+import click
+import csv
 import io
 from io import BytesIO
 import base64
+import calendar
+import gzip
+import hashlib
+import heapq
+import ipaddress
+import queue
+import threading
+import time
 from threading import Thread
 import json
+import mimetypes
+import random
+import re
+import sys
+import tempfile
+from pathlib import Path
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
+from markupsafe import Markup
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import secrets
-from functools import wraps
+import socket
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from itertools import islice
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Optional: only needed for the archive-logs command
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Optional: static assets get a brotli variant when this is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Handlers are installed by LogPipeline once the configuration is loaded
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(32)  # Generate a secure random secret key
+# Static files are served by static_file() below
+app = Flask(__name__, static_folder=None)
+# Set SECRET_KEY in the environment so signed data survives restarts and is
+# shared by every worker; a random key is only suitable for development
+app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
+
+# Custom SQLite adapters and converters for Python 3.12 compatibility.
+# Datetimes are stored as integer "local epoch" seconds: the naive wall-clock
+# time read as if it were UTC. That is the convention SQLite's strftime('%s')
+# and 'unixepoch' use, so durations are plain subtraction and times can be
+# formatted in SQL without converting every row in Python.
+EPOCH = datetime(1970, 1, 1)
+
+def adapt_datetime(dt):
+    return calendar.timegm(dt.timetuple())
+
+def convert_datetime(val):
+    try:
+        return EPOCH + timedelta(seconds=int(val))
+    except ValueError:
+        pass
+    # Columns that default to CURRENT_TIMESTAMP still hold text
+    try:
+        return datetime.fromisoformat(val.decode())
+    except (AttributeError, ValueError):
+        return None
+
+def sql_hms(expr):
+    """SQL expression formatting a number of seconds as H:MM:SS"""
+    return f"printf('%d:%02d:%02d', ({expr}) / 3600, ({expr}) % 3600 / 60, ({expr}) % 60)"
+
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter("timestamp", convert_datetime)
+
+# Configuration
+class Config:
+    # Database setup
+    DATABASE_PATH = 'check_in_system.db'
+    
+    # File upload configuration
+    UPLOAD_FOLDER = 'static/uploads'
+    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+    
+    # Session configuration
+    SESSION_COOKIE_SECURE = False  # Set to True only if using HTTPS
+    SESSION_COOKIE_HTTPONLY = True
+    SESSION_COOKIE_SAMESITE = 'Lax'
+    PERMANENT_SESSION_LIFETIME = timedelta(hours=8)  # Also how long idle server-side sessions live
+    SESSION_BACKEND = 'sqlite'  # 'sqlite' (sessions table), 'file' or 'cookie' (signed cookies only)
+    SESSION_FILE_DIR = 'flask_session'  # Directory for the file backend
+    SESSION_CACHE_SIZE = 4096  # Sessions kept in each worker's in-memory LRU
+    SESSION_CACHE_TTL = 10  # Seconds a cached session is trusted before re-reading the store
+    SESSION_TOUCH_INTERVAL = 300  # Seconds between expiry refreshes of an unchanged session
+    SESSION_SWEEP_INTERVAL = 600  # Seconds between purges of expired sessions
+    
+    # Connection pool configuration
+    DB_POOL_SIZE = 10  # Max connections per worker process
+    DB_POOL_TIMEOUT = 30  # Seconds to wait for a free connection
+    DB_BUSY_TIMEOUT = 5000  # Milliseconds SQLite waits on a locked database
+    DB_STATEMENT_CACHE = 128  # Prepared statements cached per connection
+    RESET_SEQUENCES_ON_DELETE = False  # Rewrite sqlite_sequence after deletes
+    DB_CONNECTION_FACTORY = None  # Connection class for pooled connections (default: InstrumentedConnection)
+    
+    # Per-office shards; each office's staff and logs live in a database file of their own
+    HOME_OFFICE = 'main'  # Office whose shard is DATABASE_PATH (it also holds the scheduler lease)
+    SHARDS = {}  # Office -> (shard number >= 1, database path), e.g. {'nyc': (1, 'check_in_nyc.db')}; never renumber
+    SHARD_FAN_OUT_THREADS = 8  # Threads per worker querying shards in parallel for admin views
+    
+    # Logging; records go through a queue so request threads never wait on log I/O
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # Root logger level
+    LOG_LEVELS = {'werkzeug': 'WARNING'}  # Per-logger overrides
+    LOG_FORMAT = 'json'  # 'json' (one object per line) or 'text'
+    LOG_QUEUE_SIZE = 10000  # Records buffered for the writer thread; further records are dropped
+    LOG_REQUESTS = True  # Log one record per request with its route, status and duration
+    LOG_REQUEST_SAMPLE_RATE = 1.0  # Fraction of ordinary requests logged (errors and slow requests always are)
+    LOG_SLOW_REQUEST_MS = 1000  # Requests slower than this are always logged, at WARNING
+    
+    # Request instrumentation
+    INSTRUMENTATION = True  # Collect per-request SQL and template timings
+    SLOW_QUERY_MS = 200  # Log statements slower than this with their query plan (0 disables)
+    SERVER_TIMING = True  # Report timings to the browser in a Server-Timing header
+    
+    # Write-behind ingestion for check-in/out and break events
+    INGEST_BATCHING = False  # Opt-in: group writes into batched transactions
+    INGEST_BATCH_INTERVAL_MS = 50  # Max time spent collecting a batch
+    INGEST_BATCH_SIZE = 200  # Max events per batch
+    INGEST_ACK_TIMEOUT = 10  # Seconds a request waits for its batch to commit
+    
+    # Per-user "today status" cache
+    TODAY_CACHE_SIZE = 4096  # Max cached (staff_id, date) entries per worker
+    TODAY_CACHE_TTL = 30  # Seconds before an entry is re-read from the database
+    FRAGMENT_CACHE_SIZE = 256  # Rendered dashboard fragments kept per worker
+    USER_AGENT_CACHE_SIZE = 1024  # Distinct User-Agent strings parsed and mapped to ids per worker
+    
+    # Live status updates (Server-Sent Events)
+    SSE_KEEPALIVE = 15  # Seconds between keepalive comments on idle streams
+    SSE_RETRY_MS = 5000  # Client reconnect delay sent to EventSource
+    SSE_HISTORY = 256  # Recent events kept for Last-Event-ID replay
+    
+    # ASGI entry point (asgi.py)
+    ASGI_THREADS = 32  # Threads running the Flask routes that are not served natively
+    
+    # Password hashing
+    PASSWORD_HASH_METHOD = f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}'  # Stored hashes using anything else are upgraded on login
+    PASSWORD_HASH_WORKERS = 2  # Processes doing hash work (0 hashes on the request thread)
+    PASSWORD_HASH_MAX_PENDING = 32  # Hash jobs admitted at once; further logins are asked to retry
+    PASSWORD_HASH_TIMEOUT = 10  # Seconds a request waits for its hash job
+    
+    # Check-in configuration
+    LATE_THRESHOLD = 9  # 9 AM
+    BULK_EVENTS_MAX = 5000  # Max events accepted per /api/bulk_events request
+    RANGE_REPORT_PAGE_SIZE = 50  # Rows per page of /reports/range
+    RANGE_REPORT_MAX_DAYS = 366  # Longest date range /reports/range accepts
+    STAFF_PAGE_SIZE = 25  # Staff per page of the dashboard's staff table
+    WORK_HOURS = 8  # 8 hours per day
+    BREAK_TYPES = {
+        'short': 15,    # 15 minutes
+        'regular': 30,  # 30 minutes
+        'lunch': 60     # 1 hour
+    }
+    
+    # Office networks; each check-in's address is classified by longest-prefix match
+    OFFICE_NETWORKS = {}  # CIDR -> office name, e.g. {'10.1.0.0/16': 'London HQ'}; matches are on-site
+    VPN_NETWORKS = {}  # CIDR -> VPN name; matches are VPN and anything unmatched is remote
+    
+    # Columnar archive of historical logs (flask archive-logs, needs pyarrow)
+    ARCHIVE_DIR = 'archive'  # Root of the date-partitioned archive
+    ARCHIVE_FORMAT = 'parquet'  # 'parquet' or 'arrow' (Arrow IPC)
+    ARCHIVE_RETENTION_DAYS = 365  # Days of logs kept in SQLite when pruning
+    
+    # Read-only reporting replicas, one snapshot file per shard next to its database
+    REPORT_REPLICA = True  # Admin reports, exports and location history read the snapshot
+    REPORT_REPLICA_MAX_AGE = 120  # Seconds a snapshot may lag before a read refreshes it first
+    
+    # Background jobs; every worker runs a scheduler but only the lease holder runs jobs
+    SCHEDULER_ENABLED = True  # Start the scheduler thread in each worker process
+    SCHEDULER_TICK = 60  # Seconds between checks for due jobs
+    SCHEDULER_LEASE_TTL = 300  # Seconds before another worker takes over an unrenewed lease
+    SCHEDULER_JOBS = {  # Seconds between runs of each job (0 disables it)
+        'auto_close': 15 * 60,
+        'recompute_break_totals': 20 * 3600,
+        'refresh_summary': 20 * 3600,
+        'optimize': 20 * 3600,
+        'incremental_vacuum': 20 * 3600,
+        'refresh_report_replica': 60,
+    }
+    SCHEDULER_NIGHTLY_HOURS = (1, 5)  # Local hours [start, end) the nightly jobs may run in
+    SCHEDULER_LOOKBACK_DAYS = 7  # Days re-checked by the break total and summary jobs
+    AUTO_CLOSE_TIME = '23:00'  # Check-ins and breaks still open are closed at this time of their day
+
+# Apply configuration
+app.config.from_object(Config)
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, including any request context fields"""
+
+    FIELDS = ('request_id', 'method', 'path', 'route', 'status', 'user_id', 'duration_ms')
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """Queues records for the pipeline's writer thread.
+
+    Only the request context is captured here, on the calling thread;
+    message and traceback formatting happen on the writer thread. A full
+    queue drops the record rather than block the request.
+    """
+
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        if has_request_context() and getattr(record, 'request_id', None) is None:
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+            record.route = request.endpoint
+            # Read the session dict directly so logging doesn't mark it accessed
+            record.user_id = dict.get(session._get_current_object(), 'user_id')
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.pipeline.get_queue().put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+class LogPipeline:
+    """Root log handler feeding a QueueListener that does the writing.
+
+    Every worker process gets its own queue and writer thread; a forked
+    worker starts them on its first record.
+    """
+
+    def __init__(self, stream=None, fmt='json', queue_size=10000):
+        self.handler = logging.StreamHandler(stream or sys.stderr)
+        self.handler.setFormatter(JsonLogFormatter() if fmt == 'json' else
+                                  logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        self.queue_size = queue_size
+        self.queue_handler = LogQueueHandler(self)
+        self.dropped = 0
+        self.pid = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def get_queue(self):
+        if self.pid != os.getpid():
+            with self._lock:
+                if self.pid != os.getpid():
+                    self._listener = QueueListener(queue.Queue(self.queue_size), self.handler)
+                    self._listener.start()
+                    self.pid = os.getpid()
+        return self._listener.queue
+
+    def stop(self):
+        """Write out everything queued and stop the writer thread"""
+        with self._lock:
+            if self._listener is not None and self.pid == os.getpid():
+                self._listener.stop()
+            self.pid = self._listener = None
+
+    def install(self, level='INFO', levels=None):
+        root = logging.getLogger()
+        root.handlers[:] = [self.queue_handler]
+        root.setLevel(level)
+        for name, name_level in (levels or {}).items():
+            logging.getLogger(name).setLevel(name_level)
+        atexit.register(self.stop)
+
+log_pipeline = LogPipeline(fmt=app.config['LOG_FORMAT'], queue_size=app.config['LOG_QUEUE_SIZE'])
+# Password hasher processes re-import `python app.py` as __mp_main__; they don't log
+if __name__ != '__mp_main__':
+    log_pipeline.install(app.config['LOG_LEVEL'], app.config['LOG_LEVELS'])
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+
+# Checked in order; the first match wins (Edge and Opera also claim Chrome and Safari)
+UA_BROWSERS = [
+    ('Edge', re.compile(r'edg(?:e|a|ios)?/', re.I)),
+    ('Opera', re.compile(r'opr/|opera', re.I)),
+    ('Samsung Internet', re.compile(r'samsungbrowser/', re.I)),
+    ('Firefox', re.compile(r'firefox/|fxios/', re.I)),
+    ('Chrome', re.compile(r'chrome/|crios/', re.I)),
+    ('Safari', re.compile(r'version/[\d.]+.*safari/', re.I)),
+    ('Internet Explorer', re.compile(r'msie |trident/', re.I)),
+]
+UA_SYSTEMS = [
+    ('Windows', re.compile(r'windows', re.I)),
+    ('iOS', re.compile(r'iphone|ipad|ipod', re.I)),
+    ('Android', re.compile(r'android', re.I)),
+    ('ChromeOS', re.compile(r'cros', re.I)),
+    ('macOS', re.compile(r'mac os x|macintosh', re.I)),
+    ('Linux', re.compile(r'linux', re.I)),
+]
+UA_MOBILE_MARKERS = ('mobile', 'android', 'iphone', 'ipad')
+UA_BOT = re.compile(r'bot|crawl|spider|slurp|curl|wget|python-requests', re.I)
+
+@lru_cache(maxsize=app.config['USER_AGENT_CACHE_SIZE'])
+def parse_user_agent(user_agent):
+    """Browser, OS and device class for a User-Agent string (cached per distinct string)"""
+    lowered = user_agent.lower()
+    browser = next((name for name, pattern in UA_BROWSERS if pattern.search(user_agent)), 'Other')
+    os_name = next((name for name, pattern in UA_SYSTEMS if pattern.search(user_agent)), 'Other')
+    is_mobile = any(marker in lowered for marker in UA_MOBILE_MARKERS)
+    if UA_BOT.search(user_agent):
+        device = 'bot'
+    elif 'ipad' in lowered or 'tablet' in lowered or ('android' in lowered and 'mobile' not in lowered):
+        device = 'tablet'
+    elif is_mobile:
+        device = 'mobile'
+    else:
+        device = 'desktop'
+    return {'browser': browser, 'os': os_name, 'device': device, 'is_mobile': is_mobile}
+
+class UserAgentCache:
+    """LRU of User-Agent string -> user_agents.id for this worker.
+
+    Each distinct string is stored, and parsed, once. Only ids read back
+    from existing rows are cached, so an id from an insert that is later
+    rolled back never outlives its transaction.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (database, user agent) -> id
+        self._lock = threading.Lock()
+
+    def intern(self, cursor, user_agent, database=None):
+        """Id of the user_agents row for a string, inserting it if new.
+        
+        ``database`` is the shard the cursor writes to (default: DATABASE_PATH).
+        """
+        key = (database or app.config['DATABASE_PATH'], user_agent)
+        with self._lock:
+            user_agent_id = self._entries.get(key)
+            if user_agent_id is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return user_agent_id
+            self.misses += 1
+        
+        cursor.execute('SELECT id FROM user_agents WHERE user_agent = ?', (user_agent,))
+        row = cursor.fetchone()
+        if row is None:
+            parsed = parse_user_agent(user_agent)
+            cursor.execute('''
+                INSERT INTO user_agents (user_agent, browser, os, device, is_mobile)
+                VALUES (?, ?, ?, ?, ?)
+                RETURNING id
+            ''', (user_agent, parsed['browser'], parsed['os'], parsed['device'], parsed['is_mobile']))
+            return cursor.fetchone()[0]
+        
+        with self._lock:
+            self._entries[key] = row[0]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return row[0]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+user_agent_cache = UserAgentCache(app.config['USER_AGENT_CACHE_SIZE'])
+
+def client_info_for(ip_address, user_agent):
+    return {'ip_address': ip_address, 'user_agent': user_agent, **parse_user_agent(user_agent)}
+
+@app.before_request
+def detect_client():
+    """Parse the caller's device once per request; see get_client_info()"""
+    g.client_info = client_info_for(request.remote_addr or 'Unknown', request.headers.get('User-Agent', 'Unknown'))
+
+def get_client_info():
+    """The current request's IP address, User-Agent and parsed device fields"""
+    if 'client_info' not in g:
+        detect_client()
+    return g.client_info
+
+class PrefixTrie:
+    """Longest-prefix-match table of IPv4 and IPv6 networks.
+
+    A multibit trie with 8-bit strides: a lookup visits at most one node
+    per address byte (4 for IPv4, 16 for IPv6) however many prefixes are
+    loaded. A prefix that does not end on a byte boundary is expanded on
+    insert into every value of its last byte it covers.
+    """
+
+    def __init__(self):
+        # node = (byte -> child node, byte -> (prefix length, value))
+        self._roots = {4: ({}, {}), 6: ({}, {})}
+        self._defaults = {4: None, 6: None}
+        self.size = 0
+
+    def insert(self, network, value):
+        network = ipaddress.ip_network(network, strict=False)
+        length = network.prefixlen
+        self.size += 1
+        if length == 0:
+            self._defaults[network.version] = value
+            return
+        packed = network.network_address.packed
+        node = self._roots[network.version]
+        depth = (length - 1) // 8
+        for byte in packed[:depth]:
+            node = node[0].setdefault(byte, ({}, {}))
+        spare_bits = 8 * (depth + 1) - length
+        first = packed[depth]
+        entries = node[1]
+        for byte in range(first, first + (1 << spare_bits)):
+            # A longer prefix already expanded over this byte still wins
+            existing = entries.get(byte)
+            if existing is None or existing[0] <= length:
+                entries[byte] = (length, value)
+
+    def lookup(self, address):
+        """Value of the longest prefix containing an address string, or None"""
+        packed = pack_ip(address)
+        if packed is None:
+            return None
+        version = 4 if len(packed) == 4 else 6
+        best = self._defaults[version]
+        node = self._roots[version]
+        for byte in packed:
+            entry = node[1].get(byte)
+            if entry is not None:
+                best = entry[1]
+            node = node[0].get(byte)
+            if node is None:
+                break
+        return best
+
+IPV4_MAPPED_PREFIX = b'\0' * 10 + b'\xff\xff'
+
+def pack_ip(address):
+    """Packed bytes of an IP address string (IPv4-mapped IPv6 as IPv4), or None"""
+    try:
+        return socket.inet_pton(socket.AF_INET, address)
+    except (OSError, TypeError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    except (OSError, TypeError):
+        return None
+    return packed[12:] if packed.startswith(IPV4_MAPPED_PREFIX) else packed
+
+NETWORK_TYPES = ('onsite', 'vpn', 'remote')
+
+class NetworkClassifier:
+    """Classifies client addresses as on-site (with their office), VPN or remote"""
+
+    def __init__(self, office_networks, vpn_networks):
+        self.sources = (office_networks, vpn_networks)
+        self.trie = PrefixTrie()
+        for cidr, name in vpn_networks.items():
+            self.trie.insert(cidr, (name, 'vpn'))
+        # Inserted last so an office range wins a tie with a VPN range
+        for cidr, name in office_networks.items():
+            self.trie.insert(cidr, (name, 'onsite'))
+
+    def classify(self, ip_address):
+        """(site, network_type); site is None for remote addresses"""
+        return self.trie.lookup(ip_address) or (None, 'remote')
+
+_network_classifier = None
+_network_classifier_lock = threading.Lock()
+
+def get_network_classifier():
+    """Classifier for the configured networks, rebuilt when they are replaced"""
+    global _network_classifier
+    office, vpn = app.config['OFFICE_NETWORKS'], app.config['VPN_NETWORKS']
+    classifier = _network_classifier
+    if classifier is None or classifier.sources[0] is not office or classifier.sources[1] is not vpn:
+        with _network_classifier_lock:
+            classifier = _network_classifier
+            if classifier is None or classifier.sources[0] is not office or classifier.sources[1] is not vpn:
+                classifier = _network_classifier = NetworkClassifier(office, vpn)
+    return classifier
+
+def classify_location_logs(cursor):
+    """Re-run network classification over every location log.
+
+    Each distinct address is classified once; returns the rows updated.
+    """
+    classifier = get_network_classifier()
+    cursor.execute('SELECT DISTINCT ip_address FROM location_logs')
+    addresses = [(ip, *classifier.classify(ip)) for (ip,) in cursor.fetchall()]
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS ip_sites (ip_address TEXT PRIMARY KEY, site TEXT, network_type TEXT)')
+    cursor.execute('DELETE FROM ip_sites')
+    cursor.executemany('INSERT INTO ip_sites VALUES (?, ?, ?)', addresses)
+    cursor.execute('''
+        UPDATE location_logs SET site = ip_sites.site, network_type = ip_sites.network_type
+        FROM ip_sites
+        WHERE ip_sites.ip_address = location_logs.ip_address
+          AND (location_logs.site IS NOT ip_sites.site OR location_logs.network_type IS NOT ip_sites.network_type)
+    ''')
+    updated = cursor.rowcount
+    cursor.execute('DROP TABLE ip_sites')
+    return updated
+
+class PasswordHasherBusy(Exception):
+    """Raised when the password hasher is at its admission limit"""
+
+def normalize_hash_method(method):
+    """Expand a werkzeug hash method to the parameters it stores in the hash"""
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        digest = parts[1] if len(parts) > 1 else 'sha256'
+        iterations = parts[2] if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{digest}:{iterations}'
+    if parts[0] == 'scrypt':
+        n, r, p = (parts[1:] + ['32768', '8', '1'][len(parts) - 1:])[:3]
+        return f'scrypt:{n}:{r}:{p}'
+    return method
+
+def password_needs_rehash(password_hash):
+    """True if a stored hash was made with a different method or cost than configured"""
+    stored_method = password_hash.split('$', 1)[0]
+    return stored_method != normalize_hash_method(app.config['PASSWORD_HASH_METHOD'])
+
+class PasswordHasher:
+    """Runs password hashing in a bounded pool of worker processes.
+
+    A login burns a few hundred milliseconds of CPU on pbkdf2; doing that on
+    the request thread lets a shift-start login storm starve check-ins in
+    the same worker. Jobs go to at most `workers` processes, and once
+    `max_pending` jobs are in flight new ones are refused with
+    PasswordHasherBusy instead of queueing behind the storm.
+    """
+
+    def __init__(self, workers=2, max_pending=32, timeout=10):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._submitted = 0
+        self._rejected = 0
+        self._timeouts = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: the request threads may hold locks mid-fork
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PasswordHasherBusy()
+        with self._lock:
+            self._submitted += 1
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job finishes, even if its request gave up
+        # waiting, so a storm can't pile up more than max_pending jobs
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._timeouts += 1
+            raise PasswordHasherBusy()
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool next time and finish this job here
+            with self._lock:
+                self._executor = None
+            return func(*args)
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def generate(self, password, method):
+        return self._run(generate_password_hash, password, method)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'submitted': self._submitted,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+_password_hasher = None
+_password_hasher_lock = threading.Lock()
+
+def get_password_hasher():
+    """Get the password hasher for this worker process"""
+    global _password_hasher
+    pid = os.getpid()
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if _password_hasher is None or _password_hasher.pid != pid or _password_hasher.workers != workers:
+        with _password_hasher_lock:
+            if _password_hasher is None or _password_hasher.pid != pid or _password_hasher.workers != workers:
+                # Forked workers and config changes get a hasher of their own
+                if _password_hasher is not None and _password_hasher.pid == pid:
+                    _password_hasher.shutdown()
+                _password_hasher = PasswordHasher(
+                    workers=workers,
+                    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+                    timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+                )
+    return _password_hasher
+
+def hash_password(password):
+    """Hash a password with the configured method, off the request thread"""
+    return get_password_hasher().generate(password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    """Check a password against its stored hash, off the request thread"""
+    return get_password_hasher().check(password_hash, password)
+
+def init_db():
+    """Initialize every office's database with the required tables"""
+    numbers = [number for number, _ in app.config['SHARDS'].values()]
+    if len(set(numbers)) != len(numbers) or min(numbers, default=1) < 1:
+        raise ValueError('SHARDS numbers must be unique and at least 1')
+    for number, database in shard_databases().values():
+        init_shard(database, number)
+    reserve_staff_emails()
+
+def init_shard(database, number=0):
+    """Create or migrate one shard's database"""
+    try:
+        conn = sqlite3.connect(database)
+        cursor = conn.cursor()
+        # Lets the scheduler hand free pages back; only takes effect on a new file
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        
+        # Create staff table with indexes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS staff (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_staff_email ON staff(email)')
+        
+        # Create check_in_logs table with indexes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS check_in_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id INTEGER NOT NULL,
+            check_in_time TIMESTAMP,
+            check_out_time TIMESTAMP,
+            date TEXT NOT NULL,
+            is_late BOOLEAN DEFAULT FALSE,
+            late_reason TEXT,
+            total_break_time INTEGER DEFAULT 0,
+            FOREIGN KEY (staff_id) REFERENCES staff (id) ON DELETE CASCADE
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_check_in_logs_staff_date ON check_in_logs(staff_id, date)')
+        
+        # Create break_logs table with indexes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS break_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            check_in_log_id INTEGER NOT NULL,
+            break_start TIMESTAMP NOT NULL,
+            break_end TIMESTAMP,
+            break_type TEXT NOT NULL,
+            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id) ON DELETE CASCADE
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_break_logs_check_in ON break_logs(check_in_log_id)')
+        
+        # Create simplified location_logs table with indexes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS location_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            check_in_log_id INTEGER NOT NULL,
+            ip_address TEXT NOT NULL,
+            browser TEXT,
+            is_mobile BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id) ON DELETE CASCADE
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_location_logs_check_in ON location_logs(check_in_log_id)')
+        
+        conn.commit()
+        migrate_db(conn)
+        if number:
+            reserve_shard_ids(conn, number)
+        conn.close()
+        logger.info(f"Database {database} initialized successfully")
+    except sqlite3.Error as e:
+        logger.error(f"Database initialization error: {str(e)}")
+        raise
+
+def reserve_shard_ids(conn, number):
+    """Start the shard's AUTOINCREMENT ids in its own range; see shard_for_id()"""
+    floor = number << SHARD_ID_BITS
+    for table_name in SHARDED_SEQUENCES:
+        conn.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', (table_name, table_name))
+        conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?', (floor, table_name, floor))
+    conn.commit()
+
+def migration_open_break_index(cursor):
+    """Partial index over open breaks for the break_end IS NULL lookups"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_break_logs_open 
+        ON break_logs(check_in_log_id) 
+        WHERE break_end IS NULL
+    ''')
+
+# Per staff, per day attendance totals maintained alongside check_in_logs.
+# worked_seconds is check-in to check-out; 0 until the day is checked out.
+SUMMARY_UPSERT = '''
+    INSERT INTO daily_attendance_summary (
+        staff_id, date, check_in_log_id, worked_seconds,
+        break_minutes, break_count, is_late, updated_at
+    )
+    SELECT 
+        l.staff_id,
+        l.date,
+        l.id,
+        CASE WHEN l.check_in_time IS NOT NULL AND l.check_out_time IS NOT NULL
+             THEN l.check_out_time - l.check_in_time
+             ELSE 0 END,
+        COALESCE(l.total_break_time, 0),
+        (SELECT COUNT(*) FROM break_logs b WHERE b.check_in_log_id = l.id),
+        COALESCE(l.is_late, 0),
+        CURRENT_TIMESTAMP
+    FROM check_in_logs l
+    WHERE {where}
+    ON CONFLICT (staff_id, date) DO UPDATE SET
+        check_in_log_id = excluded.check_in_log_id,
+        worked_seconds = excluded.worked_seconds,
+        break_minutes = excluded.break_minutes,
+        break_count = excluded.break_count,
+        is_late = excluded.is_late,
+        updated_at = excluded.updated_at
+'''
+
+def refresh_daily_summary(cursor, log_id):
+    """Recompute the summary row for a single check-in log"""
+    cursor.execute(SUMMARY_UPSERT.format(where='l.id = ?'), (log_id,))
+
+def backfill_daily_summary(cursor, start=None, end=None):
+    """Rebuild summary rows from the raw logs, optionally for a date range"""
+    if start and end:
+        cursor.execute(SUMMARY_UPSERT.format(where='l.date BETWEEN ? AND ?'), (start, end))
+    else:
+        cursor.execute(SUMMARY_UPSERT.format(where='1'))
+    return cursor.rowcount
+
+def migration_daily_summary(cursor):
+    """Precomputed daily attendance summary, backfilled from existing logs"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_attendance_summary (
+            staff_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            check_in_log_id INTEGER NOT NULL,
+            worked_seconds INTEGER NOT NULL DEFAULT 0,
+            break_minutes INTEGER NOT NULL DEFAULT 0,
+            break_count INTEGER NOT NULL DEFAULT 0,
+            is_late BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (staff_id, date),
+            FOREIGN KEY (staff_id) REFERENCES staff (id) ON DELETE CASCADE,
+            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_summary_date ON daily_attendance_summary(date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_summary_log ON daily_attendance_summary(check_in_log_id)')
+    backfill_daily_summary(cursor)
+
+def migration_cascade_deletes(cursor):
+    """Rebuild log tables so their foreign keys cascade on delete.
+
+    SQLite cannot alter a foreign key in place, so each table is copied into
+    a new table with the amended definition. Orphaned rows left behind by
+    earlier deletes are dropped on the way.
+    """
+    cursor.execute('DELETE FROM check_in_logs WHERE staff_id NOT IN (SELECT id FROM staff)')
+    for table_name in ('break_logs', 'location_logs'):
+        cursor.execute(f'DELETE FROM {table_name} WHERE check_in_log_id NOT IN (SELECT id FROM check_in_logs)')
+    
+    for table_name in ('check_in_logs', 'break_logs', 'location_logs'):
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        table_sql = cursor.fetchone()[0]
+        if 'ON DELETE CASCADE' in table_sql:
+            continue
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table_name,))
+        index_sql = [row[0] for row in cursor.fetchall()]
+        
+        new_sql = re.sub(r'(REFERENCES \w+ \(\w+\))', r'\1 ON DELETE CASCADE', table_sql)
+        new_sql = new_sql.replace(table_name, f'{table_name}_new', 1)
+        cursor.execute(new_sql)
+        cursor.execute(f'INSERT INTO {table_name}_new SELECT * FROM {table_name}')
+        cursor.execute(f'DROP TABLE {table_name}')
+        cursor.execute(f'ALTER TABLE {table_name}_new RENAME TO {table_name}')
+        for sql in index_sql:
+            cursor.execute(sql)
+    
+    # The summary is derived data: recreate it with its new foreign keys
+    cursor.execute('DROP TABLE IF EXISTS daily_attendance_summary')
+    migration_daily_summary(cursor)
+
+def migration_sessions(cursor):
+    """Server-side session store; rows go with their staff member"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES staff (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+
+def migration_report_covering_index(cursor):
+    """Covering index so date-range reports never touch the check_in_logs table"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_check_in_logs_date_cover
+        ON check_in_logs(date, staff_id, is_late, check_in_time, check_out_time, total_break_time)
+    ''')
+
+def migration_epoch_timestamps(cursor):
+    """Convert ISO-string attendance timestamps to integer local-epoch seconds"""
+    for table_name, columns in (
+        ('check_in_logs', ('check_in_time', 'check_out_time')),
+        ('break_logs', ('break_start', 'break_end')),
+    ):
+        for column in columns:
+            cursor.execute(f'''
+                UPDATE {table_name}
+                SET {column} = CAST(strftime('%s', {column}) AS INTEGER)
+                WHERE typeof({column}) = 'text' AND strftime('%s', {column}) IS NOT NULL
+            ''')
+    # Earlier steps built the summary with the current (integer) duration math
+    backfill_daily_summary(cursor)
+
+def migration_scheduler(cursor):
+    """Lease and run history for the background scheduler"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            runs INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            last_started_at REAL,
+            last_duration_ms REAL,
+            last_status TEXT,
+            last_result TEXT,
+            last_error TEXT
+        )
+    ''')
+    # Partial index over the days nobody checked out of, for auto-close
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_check_in_logs_open
+        ON check_in_logs(date)
+        WHERE check_out_time IS NULL
+    ''')
+
+# Tables whose writes bump each data version: staff covers the staff list,
+# check_ins the set of check-ins (late list), attendance every attendance write
+DATA_VERSION_TRIGGERS = {
+    'staff': [('staff', 'INSERT'), ('staff', 'UPDATE'), ('staff', 'DELETE')],
+    'check_ins': [('check_in_logs', 'INSERT'), ('check_in_logs', 'DELETE')],
+    'attendance': [
+        ('check_in_logs', 'INSERT'), ('check_in_logs', 'UPDATE'), ('check_in_logs', 'DELETE'),
+        ('break_logs', 'INSERT'), ('break_logs', 'UPDATE'), ('break_logs', 'DELETE'),
+    ],
+    'locations': [('location_logs', 'INSERT'), ('location_logs', 'UPDATE'), ('location_logs', 'DELETE')],
+}
+
+def migration_data_versions(cursor):
+    """Counters bumped by triggers on every write, for caching and ETags"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    for name, events in DATA_VERSION_TRIGGERS.items():
+        cursor.execute('''
+            INSERT OR IGNORE INTO data_versions (name, version, updated_at)
+            VALUES (?, 0, (julianday('now') - 2440587.5) * 86400.0)
+        ''', (name,))
+        for table_name, event in events:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS bump_{name}_on_{table_name}_{event.lower()}
+                AFTER {event} ON {table_name}
+                BEGIN
+                    UPDATE data_versions
+                    SET version = version + 1, updated_at = (julianday('now') - 2440587.5) * 86400.0
+                    WHERE name = '{name}';
+                END
+            ''')
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have run, so existing databases pick up new steps on the next init_db().
+def migration_user_agents(cursor):
+    """Move location_logs' raw User-Agent strings into a user_agents dimension table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_agents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_agent TEXT NOT NULL UNIQUE,
+            browser TEXT NOT NULL,
+            os TEXT NOT NULL,
+            device TEXT NOT NULL,
+            is_mobile BOOLEAN NOT NULL
+        )
+    ''')
+    cursor.execute("SELECT DISTINCT COALESCE(browser, 'Unknown') FROM location_logs")
+    user_agents = [row[0] for row in cursor.fetchall()]
+    cursor.executemany('''
+        INSERT OR IGNORE INTO user_agents (user_agent, browser, os, device, is_mobile)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (ua, parsed['browser'], parsed['os'], parsed['device'], parsed['is_mobile'])
+        for ua, parsed in ((ua, parse_user_agent(ua)) for ua in user_agents)
+    ])
+    cursor.execute('ALTER TABLE location_logs ADD COLUMN user_agent_id INTEGER REFERENCES user_agents (id)')
+    cursor.execute('''
+        UPDATE location_logs SET user_agent_id = ua.id
+        FROM user_agents ua
+        WHERE ua.user_agent = COALESCE(location_logs.browser, 'Unknown')
+    ''')
+    cursor.execute('ALTER TABLE location_logs DROP COLUMN browser')
+    cursor.execute('ALTER TABLE location_logs DROP COLUMN is_mobile')
+
+def migration_network_sites(cursor):
+    """Office/VPN/remote classification stored on each location log"""
+    cursor.execute('ALTER TABLE location_logs ADD COLUMN site TEXT')
+    cursor.execute('ALTER TABLE location_logs ADD COLUMN network_type TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_location_logs_network ON location_logs(network_type, site)')
+    classify_location_logs(cursor)
+
+def migration_location_versions(cursor):
+    """Data version for location_logs, so reporting replicas notice location-only writes"""
+    migration_data_versions(cursor)
+
+def migration_staff_emails(cursor):
+    """Emails claimed across every office (only the home shard's table is used)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS staff_emails (
+            email TEXT PRIMARY KEY
+        )
+    ''')
+
+MIGRATIONS = [
+    migration_open_break_index,
+    migration_daily_summary,
+    migration_cascade_deletes,
+    migration_sessions,
+    migration_report_covering_index,
+    migration_epoch_timestamps,
+    migration_scheduler,
+    migration_data_versions,
+    migration_user_agents,
+    migration_network_sites,
+    migration_location_versions,
+    migration_staff_emails,
+]
+
+def migrate_db(conn):
+    """Apply any schema migrations the database has not seen yet"""
+    # Table rebuilds must not trigger foreign key actions mid-copy
+    conn.execute('PRAGMA foreign_keys=OFF')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.error(f"Migration {number} ({migration.__name__}) failed")
+            raise
+
+class QueryStats:
+    """SQL and template timings collected while handling one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.statements = {}  # sql -> [executions, seconds, rows]
+
+    def record(self, sql, seconds, rows, executed):
+        self.db_seconds += seconds
+        self.rows += rows
+        entry = self.statements.get(sql)
+        if entry is None:
+            entry = self.statements[sql] = [0, 0.0, 0]
+        if executed:
+            self.queries += 1
+            entry[0] += 1
+        entry[1] += seconds
+        entry[2] += rows
+
+def current_query_stats():
+    """Stats for the request being handled on this thread, if instrumented"""
+    if has_request_context():
+        return g.get('query_stats')
+    return None
+
+def log_slow_query(conn, sql, parameters, seconds):
+    """Log a slow statement together with its EXPLAIN QUERY PLAN output"""
+    try:
+        # A plain cursor keeps the EXPLAIN itself out of the request stats
+        plan = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+        plan_text = '\n'.join(f'  {row[3]}' for row in plan) or '  (no plan)'
+    except sqlite3.Error as e:
+        plan_text = f'  (plan unavailable: {e})'
+    # Only the parameter count: the values include password hashes and emails
+    logger.warning(
+        f"Slow query ({seconds * 1000:.1f} ms) on {request.method} {request.path}:\n"
+        f"  {' '.join(sql.split())}\n  params: {len(parameters)} bound\n{plan_text}"
+    )
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that charges execution and fetch time to the current request.
+
+    Time spent fetching rows counts towards the statement that produced
+    them, so lazily-stepped SELECTs are measured in full.
+    """
+    _stats = None
+
+    def _begin(self, sql, parameters):
+        self._stats = current_query_stats()
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._slow_logged = False
+
+    def _charge(self, seconds, rows, executed=False):
+        self._stats.record(self._sql, seconds, rows, executed)
+        self._elapsed += seconds
+        threshold = app.config['SLOW_QUERY_MS']
+        if threshold and not self._slow_logged and self._elapsed * 1000 >= threshold:
+            self._slow_logged = True
+            log_slow_query(self.connection, self._sql, self._parameters, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        if self._stats is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._charge(time.perf_counter() - started, 0, executed=True)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, ())
+        if self._stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._charge(time.perf_counter() - started, 0, executed=True)
+
+    def fetchone(self):
+        if self._stats is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._charge(time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        if self._stats is None:
+            return super().fetchmany(self.arraysize if size is None else size)
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._charge(time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        if self._stats is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._charge(time.perf_counter() - started, len(rows))
+        return rows
+
+    def __next__(self):
+        if self._stats is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._charge(time.perf_counter() - started, 0)
+            raise
+        self._charge(time.perf_counter() - started, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors report to the current request's QueryStats"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        stats = current_query_stats()
+        if stats is None:
+            return super().commit()
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            stats.db_seconds += time.perf_counter() - started
+
+class RequestMetrics:
+    """Per-route request, SQL and template totals in Prometheus form"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._statuses = {}
+
+    def observe(self, route, method, status, seconds, stats):
+        with self._lock:
+            key = (route, method)
+            totals = self._routes.get(key)
+            if totals is None:
+                totals = self._routes[key] = {
+                    'requests': 0, 'seconds': 0.0, 'buckets': [0] * len(self.BUCKETS),
+                    'queries': 0, 'rows': 0, 'db_seconds': 0.0, 'template_seconds': 0.0,
+                }
+            totals['requests'] += 1
+            totals['seconds'] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    totals['buckets'][i] += 1
+            totals['queries'] += stats.queries
+            totals['rows'] += stats.rows
+            totals['db_seconds'] += stats.db_seconds
+            totals['template_seconds'] += stats.template_seconds
+            status_key = (route, method, status)
+            self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+
+    def snapshot(self):
+        """Copy of the per-route totals keyed by (route, method)"""
+        with self._lock:
+            return {key: dict(totals, buckets=list(totals['buckets'])) for key, totals in self._routes.items()}
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            statuses = sorted(self._statuses.items())
+        lines = [
+            '# HELP checkin_http_requests_total Requests handled, by route, method and status.',
+            '# TYPE checkin_http_requests_total counter',
+        ]
+        for (route, method, status), count in statuses:
+            lines.append(f'checkin_http_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+        lines += [
+            '# HELP checkin_http_request_duration_seconds Time from request start to response, by route.',
+            '# TYPE checkin_http_request_duration_seconds histogram',
+        ]
+        for (route, method), totals in routes:
+            labels = f'route="{route}",method="{method}"'
+            for bound, count in zip(self.BUCKETS, totals['buckets']):
+                lines.append(f'checkin_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'checkin_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {totals["requests"]}')
+            lines.append(f'checkin_http_request_duration_seconds_sum{{{labels}}} {totals["seconds"]:.6f}')
+            lines.append(f'checkin_http_request_duration_seconds_count{{{labels}}} {totals["requests"]}')
+        for name, field, kind, help_text in (
+            ('checkin_db_queries_total', 'queries', 'counter', 'SQL statements executed, by route.'),
+            ('checkin_db_rows_total', 'rows', 'counter', 'Rows fetched from SQLite, by route.'),
+            ('checkin_db_seconds_total', 'db_seconds', 'counter', 'Time spent in SQLite, by route.'),
+            ('checkin_template_seconds_total', 'template_seconds', 'counter', 'Time spent rendering templates, by route.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for (route, method), totals in routes:
+                value = totals[field]
+                value = f'{value:.6f}' if isinstance(value, float) else value
+                lines.append(f'{name}{{route="{route}",method="{method}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_log():
+    # Honour an id assigned by the proxy so log lines can be joined up
+    g.request_id = request.headers.get('X-Request-ID') or secrets.token_hex(8)
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_request_instrumentation():
+    if app.config['INSTRUMENTATION']:
+        g.query_stats = QueryStats()
+
+@before_render_template.connect_via(app)
+def _template_render_started(sender, template, context, **extra):
+    if 'query_stats' in g:
+        g.template_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _template_render_finished(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        g.query_stats.template_seconds += time.perf_counter() - started
+
+@app.after_request
+def add_server_timing(response):
+    """Expose this request's SQL and template time to the browser"""
+    stats = g.get('query_stats')
+    if stats is not None:
+        g.response_status = response.status_code
+    if stats is not None and app.config['SERVER_TIMING']:
+        total = time.perf_counter() - stats.started
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries, {stats.rows} rows", '
+            f'tpl;dur={stats.template_seconds * 1000:.1f}, '
+            f'app;dur={total * 1000:.1f}'
+        )
+    return response
+
+@app.teardown_request
+def record_request_metrics(error):
+    """Fold the request's timings into the per-route totals.
+
+    Runs after a streamed response has finished, so exports are measured
+    in full even though their Server-Timing header only covers the setup.
+    """
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return
+    route = request.endpoint or 'unmatched'
+    # Unhandled errors never reach after_request; a stream cut short has
+    # already sent its status line, so that is what gets counted
+    status = g.get('response_status', 500)
+    request_metrics.observe(route, request.method, status, time.perf_counter() - stats.started, stats)
+
+@app.after_request
+def add_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+        g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def log_request(error):
+    """Log the finished request, sampling the ordinary ones.
+
+    Server errors and requests slower than LOG_SLOW_REQUEST_MS are always
+    logged; other requests at LOG_REQUEST_SAMPLE_RATE.
+    """
+    started = g.pop('request_started', None)
+    if started is None or not app.config['LOG_REQUESTS']:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    status = g.get('response_status', 500)
+    slow = duration_ms >= app.config['LOG_SLOW_REQUEST_MS']
+    if status < 500 and not slow and random.random() >= app.config['LOG_REQUEST_SAMPLE_RATE']:
+        return
+    level = logging.ERROR if status >= 500 else logging.WARNING if slow else logging.INFO
+    logger.log(level, f"{request.method} {request.path} {status} {duration_ms:.1f}ms",
+               extra={'status': status, 'duration_ms': round(duration_ms, 1)})
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of reusable SQLite connections.
+
+    Connections are opened once in WAL mode and handed out per request,
+    so the connect/PRAGMA/page-cache cost is not paid on every request.
+    """
+
+    def __init__(self, database, max_size=10, timeout=30, busy_timeout=5000, cached_statements=128,
+                 factory=sqlite3.Connection):
+        self.database = database
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=self.factory,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        return conn
+
+    def acquire(self):
+        """Check out a connection, opening a new one if the pool is not full"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.max_size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError('Timed out waiting for a database connection')
+                finally:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_time += time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any open transaction"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection: drop it so a fresh one is opened next time
+            with self._lock:
+                self._in_use -= 1
+                self._created -= 1
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._lock:
+            return {
+                'size': self._created,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': self._created - self._in_use,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_ms': round(self._wait_time * 1000, 3),
+            }
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+# Row ids of shard N start at N << SHARD_ID_BITS, so every staff, check-in,
+# break and location id says which office's database holds it
+SHARD_ID_BITS = 40
+SHARDED_SEQUENCES = ('staff', 'check_in_logs', 'break_logs', 'location_logs')
+
+def shard_databases():
+    """Office -> (shard number, database path) for every shard, home office first"""
+    shards = {app.config['HOME_OFFICE']: (0, app.config['DATABASE_PATH'])}
+    shards.update(app.config['SHARDS'])
+    return shards
+
+def shard_database(office=None):
+    """Database path of an office's shard (default: the home office)"""
+    if office is None:
+        return app.config['DATABASE_PATH']
+    return shard_databases()[office][1]
+
+def shard_for_id(row_id):
+    """Office whose shard holds a staff, check-in, break or location id"""
+    number = int(row_id) >> SHARD_ID_BITS
+    if number:
+        for office, (shard_number, _) in app.config['SHARDS'].items():
+            if shard_number == number:
+                return office
+    # Ids of an office no longer configured match nothing in the home shard
+    return app.config['HOME_OFFICE']
+
+def reserve_staff_emails():
+    """Record every shard's staff emails in the home shard's staff_emails.
+
+    Each shard's staff table only keeps emails unique within that shard, so
+    register() claims the email here before inserting the staff row. This
+    catches up staff added before the table existed or outside register().
+    """
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    try:
+        for _, database in shard_databases().values():
+            shard = sqlite3.connect(database)
+            try:
+                emails = shard.execute('SELECT email FROM staff').fetchall()
+            finally:
+                shard.close()
+            conn.executemany('INSERT OR IGNORE INTO staff_emails (email) VALUES (?)', emails)
+        conn.commit()
+    finally:
+        conn.close()
+
+def current_office():
+    """Office of the logged-in user, whose id names their shard; else the home office"""
+    if has_request_context():
+        user_id = session.get('user_id')
+        if user_id is not None:
+            return shard_for_id(user_id)
+    return app.config['HOME_OFFICE']
+
+_pools = {}  # database path -> ConnectionPool
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool(office=None):
+    """Get this worker's connection pool for an office's shard (default: the home office)"""
+    global _pools_pid
+    database = shard_database(office)
+    pid = os.getpid()
+    pool = _pools.get(database)
+    if pool is None or pool.pid != pid:
+        with _pool_lock:
+            if _pools_pid != pid:
+                # Forked workers get pools of their own
+                _pools.clear()
+                _pools_pid = pid
+            pool = _pools.get(database)
+            if pool is None:
+                # Config changes close the pools of databases no longer configured
+                configured = {path for _, path in shard_databases().values()}
+                for stale in [path for path in _pools if path not in configured]:
+                    _pools.pop(stale).close_all()
+                pool = _pools[database] = ConnectionPool(
+                    database,
+                    max_size=app.config['DB_POOL_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                    cached_statements=app.config['DB_STATEMENT_CACHE'],
+                    factory=app.config['DB_CONNECTION_FACTORY'] or InstrumentedConnection,
+                )
+    return pool
+
+def shard_pools():
+    """This worker's pool for every office's shard, home office first"""
+    return {office: get_pool(office) for office in shard_databases()}
+
+@contextmanager
+def pooled_connection(office=None):
+    """Check a connection out of an office's pool for the length of a with block"""
+    pool = get_pool(office)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def get_db(office=None):
+    """Check out a pooled connection to an office's shard for the current request.
+    
+    Defaults to the logged-in user's office. Each office's connection is
+    kept until the request ends.
+    """
+    if office is None:
+        office = current_office()
+    connections = g.setdefault('sqlite_dbs', {})
+    if office not in connections:
+        try:
+            pool = get_pool(office)
+            connections[office] = (pool, pool.acquire())
+        except sqlite3.Error as e:
+            logger.error(f"Database connection error: {str(e)}")
+            raise
+    return connections[office][1]
+
+@app.teardown_appcontext
+def close_db(error):
+    """Return the request's database connections to their pools and close any replica connections"""
+    for pool, conn in g.pop('sqlite_dbs', {}).values():
+        try:
+            pool.release(conn)
+        except Exception as e:
+            logger.error(f"Error releasing database connection: {str(e)}")
+    for conn in g.pop('report_dbs', {}).values():
+        conn.close()
+
+_fan_out_executor = None  # (pid, ThreadPoolExecutor)
+_fan_out_lock = threading.Lock()
+
+def get_fan_out_executor():
+    """Get the threads that query shards in parallel for this worker process"""
+    global _fan_out_executor
+    pid = os.getpid()
+    if _fan_out_executor is None or _fan_out_executor[0] != pid:
+        with _fan_out_lock:
+            if _fan_out_executor is None or _fan_out_executor[0] != pid:
+                _fan_out_executor = (pid, ThreadPoolExecutor(app.config['SHARD_FAN_OUT_THREADS'],
+                                                             thread_name_prefix='shard-fan-out'))
+    return _fan_out_executor[1]
+
+def fan_out(fn, *args, conn=None, replica=False):
+    """Run fn(cursor, *args) on every office's shard; returns {office: result}.
+    
+    Several shards are queried in parallel, each on a connection of its
+    own, so fn must fetch everything it needs before returning. With a
+    single shard fn runs on ``conn``, or the request's connection. With
+    ``replica`` each shard is read through its reporting replica.
+    """
+    offices = list(shard_databases())
+    if len(offices) == 1:
+        if conn is None:
+            conn = get_report_db(offices[0]) if replica else get_db(offices[0])
+        return {offices[0]: fn(conn.cursor(), *args)}
+    connect = report_connection if replica else pooled_connection
+    
+    def run(office):
+        with connect(office) as shard_conn:
+            return fn(shard_conn.cursor(), *args)
+    
+    futures = {office: get_fan_out_executor().submit(run, office) for office in offices}
+    return {office: future.result() for office, future in futures.items()}
+
+def merge_sorted(results, key, reverse=False):
+    """Merge fan_out() results that are each lists sorted by key"""
+    return list(heapq.merge(*results.values(), key=key, reverse=reverse))
+
+class ReportReplica:
+    """Read-only snapshot of a database file for reporting queries.
+    
+    A refresh copies the database with SQLite's online backup API into a
+    temporary file and renames it over the replica, so readers never see a
+    partial copy and keep the snapshot they opened. Nothing writes to a
+    replica in place, which lets readers open it immutable and skip file
+    locking altogether. The copy is skipped when the database's data
+    versions and schema version still match the replica's; the replica's
+    mtime then just moves forward. Its mtime is always a time the replica
+    was known to match the database. Any worker may refresh; the last
+    rename wins.
+    """
+
+    def __init__(self, database, path, busy_timeout=5000, factory=sqlite3.Connection):
+        self.database = database
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._checks = 0
+        self._copies = 0
+        self._copy_time = 0.0
+
+    def refreshed_at(self):
+        """Epoch seconds the replica was last known current, or None before its first refresh"""
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _open(self):
+        conn = sqlite3.connect(
+            f'{Path(self.path).resolve().as_uri()}?mode=ro&immutable=1',
+            uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+            factory=self.factory,
+        )
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect(self, max_age):
+        """Open a read-only connection, refreshing the replica first if it is older than max_age seconds"""
+        self.ensure_fresh(max_age)
+        return self._open()
+
+    def ensure_fresh(self, max_age):
+        """Refresh the replica if it is older than max_age seconds; returns refreshed_at()"""
+        refreshed_at = self.refreshed_at()
+        if refreshed_at is None or time.time() - refreshed_at > max_age:
+            with self._lock:
+                # Another thread may have refreshed it while this one waited
+                refreshed_at = self.refreshed_at()
+                if refreshed_at is None or time.time() - refreshed_at > max_age:
+                    self._refresh()
+                    refreshed_at = self.refreshed_at()
+        return refreshed_at
+
+    def invalidate(self):
+        """Make the next read refresh the replica, e.g. after a write the reader expects to see"""
+        try:
+            os.utime(self.path, (0, 0))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _signature(conn):
+        user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        versions = conn.execute('SELECT name, version FROM data_versions ORDER BY name').fetchall()
+        return user_version, [tuple(row) for row in versions]
+
+    def _replica_signature(self):
+        try:
+            conn = self._open()
+        except sqlite3.Error:
+            return None
+        try:
+            return self._signature(conn)
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
+    def refresh(self, source=None, force=False):
+        """Bring the replica up to date from ``source``, a connection to the database (default: a new one).
+        
+        Returns {'copied': bool} plus the size and time taken of any copy.
+        """
+        with self._lock:
+            return self._refresh(source, force)
+
+    def _refresh(self, source=None, force=False):
+        own_source = source is None
+        if own_source:
+            source = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000)
+        try:
+            started = time.time()
+            signature = self._signature(source)
+            self._checks += 1
+            if not force and self._replica_signature() == signature:
+                os.utime(self.path, (started, started))
+                return {'copied': False}
+            
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            try:
+                target = sqlite3.connect(temp_path)
+                try:
+                    source.backup(target)
+                    # The copy keeps the source's WAL mode; readers open it immutable, without -wal/-shm files
+                    target.execute('PRAGMA journal_mode=DELETE')
+                finally:
+                    target.close()
+                # Stamped with when the copy began, so it never claims to be newer than it is
+                os.utime(temp_path, (started, started))
+                os.replace(temp_path, self.path)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+            duration = time.time() - started
+            self._copies += 1
+            self._copy_time += duration
+            return {'copied': True, 'bytes': os.path.getsize(self.path), 'duration_ms': round(duration * 1000, 3)}
+        finally:
+            if own_source:
+                source.close()
+
+    def stats(self):
+        """Replica age plus this worker's refresh counters"""
+        refreshed_at = self.refreshed_at()
+        return {
+            'path': self.path,
+            'refreshed_at': refreshed_at,
+            'age_s': round(time.time() - refreshed_at, 3) if refreshed_at is not None else None,
+            'checks': self._checks,
+            'copies': self._copies,
+            'copy_time_ms': round(self._copy_time * 1000, 3),
+        }
+
+_report_replicas = {}  # absolute database path -> ReportReplica
+_report_replica_lock = threading.Lock()
+
+def report_replica_path(database):
+    """Where a database's reporting replica lives: next to it, as NAME.report.EXT"""
+    root, ext = os.path.splitext(database)
+    return f'{root}.report{ext or ".db"}'
+
+def get_report_replica(database=None):
+    """Get the reporting replica of a shard's database file (default: the home office's)"""
+    database = os.path.abspath(database or app.config['DATABASE_PATH'])
+    replica = _report_replicas.get(database)
+    if replica is None:
+        with _report_replica_lock:
+            replica = _report_replicas.get(database)
+            if replica is None:
+                replica = _report_replicas[database] = ReportReplica(
+                    database,
+                    report_replica_path(database),
+                    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                    factory=app.config['DB_CONNECTION_FACTORY'] or InstrumentedConnection,
+                )
+    return replica
+
+@contextmanager
+def report_connection(office=None):
+    """Read-only connection to an office's reporting replica for the length of a with block.
+    
+    Falls back to a pooled connection to the shard itself when
+    REPORT_REPLICA is off.
+    """
+    if not app.config['REPORT_REPLICA']:
+        with pooled_connection(office) as conn:
+            yield conn
+        return
+    conn = get_report_replica(shard_database(office)).connect(app.config['REPORT_REPLICA_MAX_AGE'])
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def get_report_db(office=None):
+    """Read-only connection to an office's reporting replica for the current request.
+    
+    Defaults to the logged-in user's office, and is the request's pooled
+    connection (get_db) when REPORT_REPLICA is off.
+    """
+    if not app.config['REPORT_REPLICA']:
+        return get_db(office)
+    if office is None:
+        office = current_office()
+    connections = g.setdefault('report_dbs', {})
+    if office not in connections:
+        connections[office] = get_report_replica(shard_database(office)).connect(app.config['REPORT_REPLICA_MAX_AGE'])
+    return connections[office]
+
+def report_data_as_of(offices=None):
+    """Local time the reporting replicas of some offices (default: all) were last known current.
+    
+    Refreshes any older than REPORT_REPLICA_MAX_AGE first. None when
+    reports read the live databases.
+    """
+    if not app.config['REPORT_REPLICA']:
+        return None
+    max_age = app.config['REPORT_REPLICA_MAX_AGE']
+    refreshed_at = [get_report_replica(shard_database(office)).ensure_fresh(max_age)
+                    for office in (offices or shard_databases())]
+    return datetime.fromtimestamp(min(refreshed_at))
+
+class SQLiteSessionStore:
+    """Sessions kept in the sessions table, in the shard of the user they belong to.
+    
+    Logged-out sessions live in the home office's shard. A session id says
+    nothing about its user, so loads look in every shard and take the
+    freshest row; one left behind when a session changed user goes stale
+    and is swept.
+    """
+
+    def _office(self, user_id):
+        return shard_for_id(user_id) if user_id is not None else app.config['HOME_OFFICE']
+
+    def load(self, sid):
+        found = None
+        for office in shard_databases():
+            with pooled_connection(office) as conn:
+                row = conn.execute('SELECT data, expires_at, user_id FROM sessions WHERE id = ?', (sid,)).fetchone()
+            if row and (found is None or row[1] > found[1]):
+                found = tuple(row)
+        return found
+
+    def save(self, sid, data, expires_at, user_id):
+        with pooled_connection(self._office(user_id)) as conn:
+            try:
+                conn.execute('''
+                    INSERT INTO sessions (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        user_id = excluded.user_id, data = excluded.data, expires_at = excluded.expires_at
+                ''', (sid, user_id, data, expires_at))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                # The user was deleted mid-request; their session goes with them
+                conn.rollback()
+                conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+                conn.commit()
+
+    def touch(self, sid, expires_at, user_id=None):
+        with pooled_connection(self._office(user_id)) as conn:
+            conn.execute('UPDATE sessions SET expires_at = ? WHERE id = ?', (expires_at, sid))
+            conn.commit()
+
+    def delete(self, sid):
+        for office in shard_databases():
+            with pooled_connection(office) as conn:
+                conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+                conn.commit()
+
+    def sweep(self, now):
+        """Delete expired sessions, returning how many were removed"""
+        removed = 0
+        for office in shard_databases():
+            with pooled_connection(office) as conn:
+                removed += conn.execute('DELETE FROM sessions WHERE expires_at < ?', (now,)).rowcount
+                conn.commit()
+        return removed
+
+class FileSessionStore:
+    """Sessions kept as one JSON file each in a shared directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sid):
+        return os.path.join(self.directory, f'{sid}.json')
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return record['data'], record['expires_at'], record.get('user_id')
+
+    def save(self, sid, data, expires_at, user_id):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename so readers in other workers never see half a file
+        tmp_path = f'{self._path(sid)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'data': data, 'expires_at': expires_at, 'user_id': user_id}, f)
+        os.replace(tmp_path, self._path(sid))
+
+    def touch(self, sid, expires_at, user_id=None):
+        record = self.load(sid)
+        if record is not None:
+            self.save(sid, record[0], expires_at, record[2])
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, now):
+        """Delete expired session files, returning how many were removed"""
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            record = self.load(name[:-5])
+            if record is not None and record[1] < now:
+                self.delete(name[:-5])
+                removed += 1
+        return removed
+
+class ServerSideSession(SecureCookieSession):
+    """Session dict whose contents live server-side under an opaque id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the session to a fresh id, e.g. on login, to prevent fixation"""
+        self.previous_sid = self.previous_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+class ServerSideSessionInterface(SessionInterface):
+    """Session interface backed by a session store plus an in-memory LRU.
+
+    The cookie only carries a random session id. Each worker keeps recently
+    used sessions in an LRU so routes' role checks read from memory; saves
+    are write-through, and SESSION_CACHE_TTL bounds how stale a session
+    changed by another worker can be. Expired sessions are swept from the
+    store every SESSION_SWEEP_INTERVAL seconds.
+    """
+
+    serializer = TaggedJSONSerializer()
+    # What secrets.token_urlsafe(32) produces; anything else never reaches a store
+    SID_PATTERN = re.compile(r'[A-Za-z0-9_-]{43}')
+
+    def __init__(self, store, cache_size=4096, cache_ttl=10):
+        self.store = store
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # sid -> (cached_until, data, expires_at, user_id)
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def _cache_get(self, sid):
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is None or entry[0] < time.monotonic():
+                self._cache.pop(sid, None)
+                self.misses += 1
+                return None
+            self._cache.move_to_end(sid)
+            self.hits += 1
+            return entry[1:]
+
+    def _cache_put(self, sid, data, expires_at, user_id):
+        with self._lock:
+            self._cache[sid] = (time.monotonic() + self.cache_ttl, data, expires_at, user_id)
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def invalidate_user(self, user_id):
+        """Forget every cached session belonging to a user"""
+        with self._lock:
+            for sid in [sid for sid, entry in self._cache.items() if entry[3] == user_id]:
+                del self._cache[sid]
+
+    def open_session(self, app, request):
+        now = time.time()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and self.SID_PATTERN.fullmatch(sid):
+            cached = self._cache_get(sid)
+            if cached is None:
+                cached = self.store.load(sid)
+                if cached is not None:
+                    self._cache_put(sid, *cached)
+            if cached is not None and cached[1] >= now:
+                return ServerSideSession(self.serializer.loads(cached[0]), sid=sid, expires_at=cached[1])
+        return ServerSideSession(sid=secrets.token_urlsafe(32))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+            self._cache_drop(session.previous_sid)
+        
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                self._cache_drop(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+        
+        if session.accessed:
+            response.vary.add('Cookie')
+        
+        # Unchanged sessions only rewrite their expiry every SESSION_TOUCH_INTERVAL
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        expires_at = now + lifetime
+        user_id = session.get('user_id')
+        if session.modified:
+            data = self.serializer.dumps(dict(session))
+            self.store.save(session.sid, data, expires_at, user_id)
+        elif session.expires_at is None or expires_at - session.expires_at >= app.config['SESSION_TOUCH_INTERVAL']:
+            data = self.serializer.dumps(dict(session))
+            self.store.touch(session.sid, expires_at, user_id)
+        else:
+            data = None
+        
+        if data is not None:
+            self._cache_put(session.sid, data, expires_at, user_id)
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+        self._maybe_sweep(now)
+
+    def _maybe_sweep(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + app.config['SESSION_SWEEP_INTERVAL']
+        try:
+            removed = self.store.sweep(now)
+            if removed:
+                logger.info(f"Swept {removed} expired sessions")
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Error sweeping sessions: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.store).__name__,
+                'entries': len(self._cache),
+                'max_entries': self.cache_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+def make_session_interface():
+    """Build the session interface selected by SESSION_BACKEND"""
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return SecureCookieSessionInterface()
+    if backend == 'file':
+        store = FileSessionStore(app.config['SESSION_FILE_DIR'])
+    elif backend == 'sqlite':
+        store = SQLiteSessionStore()
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    return ServerSideSessionInterface(store, app.config['SESSION_CACHE_SIZE'], app.config['SESSION_CACHE_TTL'])
+
+app.session_interface = make_session_interface()
+
+class TodayStatusCache:
+    """Bounded LRU/TTL cache of each user's check-in state for today.
+
+    Entries are keyed by (staff_id, date) and hold the check-in log fields
+    plus the active break, or None when the user has not checked in. Write
+    handlers update entries write-through; the TTL bounds how stale an entry
+    can get when another worker process made the change.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_entries=4096, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._date = None
+        self._lock = threading.Lock()
+
+    def _rollover(self, date):
+        # Yesterday's entries can never be hit again once the date changes
+        if date != self._date:
+            self._entries.clear()
+            self._date = date
+
+    def get(self, staff_id, date):
+        key = (int(staff_id), date)
+        with self._lock:
+            self._rollover(date)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, staff_id, date, status):
+        key = (int(staff_id), date)
+        with self._lock:
+            self._rollover(date)
+            self._entries[key] = (time.monotonic() + self.ttl, status)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, staff_id, date=None):
+        """Drop one day's entry, or every entry for the staff member"""
+        with self._lock:
+            if date is not None:
+                self._entries.pop((int(staff_id), date), None)
+            else:
+                for key in [key for key in self._entries if key[0] == int(staff_id)]:
+                    del self._entries[key]
+
+    def write_through(self, result):
+        """Apply a committed write handler result to the cached entry"""
+        if not result or 'staff_id' not in result:
+            return
+        staff_id, date, changes = result['staff_id'], result['date'], result.get('today')
+        if changes is None:
+            # The write was rejected, so the cached view may be out of date
+            self.invalidate(staff_id, date)
+        elif 'id' in changes:
+            self.put(staff_id, date, dict(changes))
+        else:
+            current = self.get(staff_id, date)
+            if current is self.MISSING or current is None:
+                self.invalidate(staff_id, date)
+            else:
+                self.put(staff_id, date, {**current, **changes})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+today_cache = TodayStatusCache(app.config['TODAY_CACHE_SIZE'], app.config['TODAY_CACHE_TTL'])
+
+def get_today_status(staff_id, date, conn=None):
+    """Get a user's check-in state for the day, from the cache when possible"""
+    status = today_cache.get(staff_id, date)
+    if status is not TodayStatusCache.MISSING:
+        return status
+    
+    cursor = (conn or get_db(shard_for_id(staff_id))).cursor()
+    cursor.execute('''
+        SELECT id, check_in_time, check_out_time, is_late, late_reason, total_break_time 
+        FROM check_in_logs 
+        WHERE staff_id = ? AND date = ?
+    ''', (staff_id, date))
+    log = cursor.fetchone()
+    
+    status = None
+    if log:
+        cursor.execute('''
+            SELECT break_start, break_type 
+            FROM break_logs 
+            WHERE check_in_log_id = ? AND break_end IS NULL
+        ''', (log['id'],))
+        active_break = cursor.fetchone()
+        status = {
+            'id': log['id'],
+            'check_in_time': log['check_in_time'],
+            'check_out_time': log['check_out_time'],
+            'is_late': bool(log['is_late']),
+            'late_reason': log['late_reason'],
+            'total_break_time': log['total_break_time'] or 0,
+            'active_break': dict(active_break) if active_break else None
+        }
+    
+    today_cache.put(staff_id, date, status)
+    return status
+
+def get_data_versions(cursor, *names):
+    """Current {name: (version, updated_at)} for the named data versions"""
+    cursor.execute(
+        f"SELECT name, version, updated_at FROM data_versions WHERE name IN ({','.join('?' * len(names))})",
+        names
+    )
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+class FragmentCache:
+    """Bounded LRU of rendered template fragments.
+
+    Keys include the data versions the fragment was rendered from, so a
+    write anywhere (any worker, any code path) makes the old entry
+    unreachable and it ages out of the LRU.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, key, template_name, **context):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        html = Markup(render_template(template_name, **context))
+        with self._lock:
+            self._entries[key] = html
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+def not_modified(*parts, last_modified=None):
+    """A 304 response if the client already has this version, else None.
+
+    The ETag is derived from ``parts`` (data versions plus whatever else
+    the page depends on). Views set the same validators on their full
+    response with set_validators().
+    """
+    etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+    g.validators = (etag, last_modified)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = Response(status=304)
+    return set_validators(response)
+
+def set_validators(response):
+    etag, last_modified = g.pop('validators', (None, None))
+    if etag:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Always revalidate; the ETag makes that a cheap 304
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Write handlers for check-in, check-out and break events. Each one runs
+# against a cursor inside the caller's transaction and returns a result dict,
+# so it can be applied inline or by the batching writer thread. Successful
+# results carry the changed "today" fields so the status cache can be
+# updated write-through once the transaction commits.
+def record_check_in(cursor, staff_id, now, is_late, late_reason, client_info):
+    """Insert today's check-in and its location log"""
+    date = now.strftime('%Y-%m-%d')
+    cursor.execute('SELECT id FROM check_in_logs WHERE staff_id = ? AND date = ?', (staff_id, date))
+    if cursor.fetchone():
+        return {'status': 'already_checked_in', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        INSERT INTO check_in_logs (staff_id, check_in_time, date, is_late, late_reason)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (staff_id, now, date, is_late, late_reason))
+    check_in_log_id = cursor.lastrowid
+    
+    site, network_type = get_network_classifier().classify(client_info['ip_address'])
+    cursor.execute('''
+        INSERT INTO location_logs (check_in_log_id, ip_address, user_agent_id, site, network_type)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (
+        check_in_log_id,
+        client_info['ip_address'],
+        user_agent_cache.intern(cursor, client_info['user_agent'], shard_database(shard_for_id(staff_id))),
+        site,
+        network_type
+    ))
+    refresh_daily_summary(cursor, check_in_log_id)
+    return {
+        'status': 'ok',
+        'staff_id': staff_id,
+        'date': date,
+        'log_id': check_in_log_id,
+        'today': {
+            'id': check_in_log_id,
+            'check_in_time': now,
+            'check_out_time': None,
+            'is_late': bool(is_late),
+            'late_reason': late_reason,
+            'total_break_time': 0,
+            'active_break': None
+        }
+    }
+
+def record_check_out(cursor, staff_id, now):
+    """Close any active break and set today's check-out time"""
+    date = now.strftime('%Y-%m-%d')
+    cursor.execute('''
+        SELECT id, check_out_time 
+        FROM check_in_logs 
+        WHERE staff_id = ? AND date = ?
+    ''', (staff_id, date))
+    log = cursor.fetchone()
+    
+    if not log:
+        return {'status': 'not_checked_in', 'staff_id': staff_id, 'date': date}
+    if log['check_out_time'] is not None:
+        return {'status': 'already_checked_out', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        UPDATE break_logs 
+        SET break_end = ? 
+        WHERE check_in_log_id = ? AND break_end IS NULL
+    ''', (now, log['id']))
+    cursor.execute('UPDATE check_in_logs SET check_out_time = ? WHERE id = ?', (now, log['id']))
+    refresh_daily_summary(cursor, log['id'])
+    return {
+        'status': 'ok',
+        'staff_id': staff_id,
+        'date': date,
+        'log_id': log['id'],
+        'today': {'check_out_time': now, 'active_break': None}
+    }
+
+def record_break_start(cursor, staff_id, now, break_type):
+    """Open a break on today's check-in unless one is already active"""
+    date = now.strftime('%Y-%m-%d')
+    cursor.execute('''
+        SELECT id FROM check_in_logs 
+        WHERE staff_id = ? AND date = ?
+    ''', (staff_id, date))
+    check_in_log = cursor.fetchone()
+    if not check_in_log:
+        return {'status': 'not_checked_in', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        SELECT id FROM break_logs 
+        WHERE check_in_log_id = ? AND break_end IS NULL
+    ''', (check_in_log['id'],))
+    if cursor.fetchone():
+        return {'status': 'active_break', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        INSERT INTO break_logs (check_in_log_id, break_start, break_type)
+        VALUES (?, ?, ?)
+    ''', (check_in_log['id'], now, break_type))
+    refresh_daily_summary(cursor, check_in_log['id'])
+    return {
+        'status': 'ok',
+        'staff_id': staff_id,
+        'date': date,
+        'log_id': check_in_log['id'],
+        'today': {'active_break': {'break_start': now, 'break_type': break_type}}
+    }
+
+def record_break_end(cursor, staff_id, now):
+    """Close the active break and add its duration to total_break_time"""
+    date = now.strftime('%Y-%m-%d')
+    cursor.execute('''
+        SELECT id, total_break_time FROM check_in_logs 
+        WHERE staff_id = ? AND date = ?
+    ''', (staff_id, date))
+    check_in_log = cursor.fetchone()
+    if not check_in_log:
+        return {'status': 'not_checked_in', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        SELECT id, break_start, break_type FROM break_logs 
+        WHERE check_in_log_id = ? AND break_end IS NULL
+    ''', (check_in_log['id'],))
+    active_break = cursor.fetchone()
+    if not active_break:
+        return {'status': 'no_active_break', 'staff_id': staff_id, 'date': date}
+    
+    cursor.execute('''
+        UPDATE break_logs SET break_end = ? WHERE id = ?
+        RETURNING (break_end - break_start) / 60
+    ''', (now, active_break['id']))
+    break_duration = cursor.fetchone()[0]
+    cursor.execute('''
+        UPDATE check_in_logs 
+        SET total_break_time = total_break_time + ?
+        WHERE id = ?
+    ''', (break_duration, check_in_log['id']))
+    refresh_daily_summary(cursor, check_in_log['id'])
+    return {
+        'status': 'ok',
+        'staff_id': staff_id,
+        'date': date,
+        'log_id': check_in_log['id'],
+        'break_type': active_break['break_type'],
+        'duration': break_duration,
+        'today': {
+            'active_break': None,
+            'total_break_time': (check_in_log['total_break_time'] or 0) + break_duration
+        }
+    }
+
+class PendingWrite:
+    """A queued write; wait() blocks until its batch has committed"""
+
+    def __init__(self, handler, args):
+        self.handler = handler
+        self.args = args
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise sqlite3.OperationalError('Timed out waiting for batch commit')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class IngestQueue:
+    """Single writer thread that commits queued writes in batches.
+
+    Events that queue up while a batch is committing are grouped into the
+    next transaction, capped at ``batch_size`` events or ``interval_ms`` of
+    collection time. Each event runs in its own savepoint so one failure
+    does not sink the batch.
+    """
+
+    def __init__(self, pool, interval_ms=50, batch_size=200):
+        self.pool = pool
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.batches = 0
+        self.events = 0
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, handler, *args):
+        write = PendingWrite(handler, args)
+        self._queue.put(write)
+        return write
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'batches': self.batches,
+            'events': self.events,
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Group commit: take whatever queued up while the last batch was
+            # committing, bounded by batch size and collection time
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Keep the writer alive; anything not yet acknowledged fails
+                logger.exception(f"Ingest writer error: {str(e)}")
+                for write in batch:
+                    if not write._done.is_set():
+                        write.result = None
+                        write.error = e
+                        write._done.set()
+
+    def _commit(self, batch):
+        try:
+            conn = self.pool.acquire()
+        except sqlite3.Error as e:
+            for write in batch:
+                write.error = e
+                write._done.set()
+            return
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for write in batch:
+                cursor.execute('SAVEPOINT ingest_event')
+                try:
+                    write.result = write.handler(cursor, *write.args)
+                    cursor.execute('RELEASE ingest_event')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO ingest_event')
+                    cursor.execute('RELEASE ingest_event')
+                    write.result = None
+                    write.error = e
+            conn.commit()
+            self.batches += 1
+            self.events += len(batch)
+        except Exception as e:
+            # Nothing in the batch was committed, including writes that succeeded
+            logger.error(f"Ingest batch failed: {str(e)}")
+            conn.rollback()
+            for write in batch:
+                write.result = None
+                write.error = e
+        finally:
+            self.pool.release(conn)
+            for write in batch:
+                write._done.set()
+
+_ingest_queues = {}  # database path -> IngestQueue
+_ingest_lock = threading.Lock()
+
+def get_ingest_queue(office=None):
+    """Get this worker's ingestion queue (and writer thread) for an office's shard"""
+    pool = get_pool(office)
+    ingest_queue = _ingest_queues.get(pool.database)
+    if ingest_queue is None or ingest_queue.pool is not pool:
+        with _ingest_lock:
+            ingest_queue = _ingest_queues.get(pool.database)
+            if ingest_queue is None or ingest_queue.pool is not pool:
+                ingest_queue = _ingest_queues[pool.database] = IngestQueue(
+                    pool,
+                    interval_ms=app.config['INGEST_BATCH_INTERVAL_MS'],
+                    batch_size=app.config['INGEST_BATCH_SIZE'],
+                )
+    return ingest_queue
+
+def apply_write(handler, *args):
+    """Apply a write handler and commit it.
+
+    Every handler takes the staff id first, which picks the shard. With
+    INGEST_BATCHING enabled the write is handed to that shard's ingestion
+    queue and this call returns once the batch containing it has committed.
+    """
+    office = shard_for_id(args[0])
+    if app.config['INGEST_BATCHING']:
+        write = get_ingest_queue(office).submit(handler, *args)
+        result = write.wait(app.config['INGEST_ACK_TIMEOUT'])
+        if result is None:
+            raise write.error or sqlite3.OperationalError('Batched write returned no result')
+    else:
+        conn = get_db(office)
+        try:
+            result = handler(conn.cursor(), *args)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    
+    today_cache.write_through(result)
+    if result.get('status') == 'ok':
+        event_broker.publish(WRITE_EVENTS.get(handler, handler.__name__), {
+            'staff_id': result['staff_id'],
+            'date': result['date'],
+            'log_id': result.get('log_id')
+        })
+    return result
+
+class EventBroker:
+    """In-process pub/sub that fans committed changes out to SSE streams.
+
+    Each subscriber gets a bounded queue; a client too slow to drain it
+    misses events and resyncs from /api/status. Recent events are kept so
+    a reconnecting EventSource can replay from its Last-Event-ID.
+    """
+
+    def __init__(self, history=256, max_queue=100):
+        self.version = 0
+        self.max_queue = max_queue
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self.version += 1
+            event = (self.version, event_type, data)
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def subscribe(self, last_event_id=None, subscriber=None):
+        """Register a subscriber; anything with put_nowait() raising queue.Full works"""
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            if last_event_id is not None:
+                missed = [event for event in self._history if event[0] > last_event_id]
+                for event in missed[-self.max_queue:]:
+                    subscriber.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'subscribers': len(self._subscribers)}
+
+event_broker = EventBroker(app.config['SSE_HISTORY'])
+
+WRITE_EVENTS = {
+    record_check_in: 'check_in',
+    record_check_out: 'check_out',
+    record_break_start: 'break_start',
+    record_break_end: 'break_end',
+}
+
+def is_late_check_in(check_in_time):
+    """Whether a check-in falls after the configured late threshold"""
+    threshold = check_in_time.replace(hour=app.config['LATE_THRESHOLD'], minute=0, second=0, microsecond=0)
+    return check_in_time > threshold
+
+BULK_EVENT_TYPES = ('check_in', 'check_out', 'break_start', 'break_end')
+
+def parse_bulk_event(event):
+    """Validate one bulk event, returning (staff_id, timestamp) or raising ValueError"""
+    if not isinstance(event, dict):
+        raise ValueError('event must be an object')
+    if event.get('type') not in BULK_EVENT_TYPES:
+        raise ValueError(f"type must be one of {', '.join(BULK_EVENT_TYPES)}")
+    try:
+        staff_id = int(event['staff_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('staff_id must be an integer')
+    try:
+        timestamp = datetime.fromisoformat(event['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('timestamp must be an ISO 8601 date-time')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    if event['type'] == 'break_start' and event.get('break_type', 'regular') not in app.config['BREAK_TYPES']:
+        raise ValueError(f"break_type must be one of {', '.join(app.config['BREAK_TYPES'])}")
+    return staff_id, timestamp
+
+def _chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def apply_bulk_events(conn, events, client_info, office=None):
+    """Validate a batch of timestamped events and apply them in one transaction.
+
+    Current state for every (staff_id, date) involved is loaded up front and
+    the events are replayed in memory in timestamp order under the same rules
+    as the single-event handlers. The surviving changes are then written with
+    executemany. ``office`` names conn's shard; staff of other shards are
+    rejected as unknown. Returns one result dict per event, in input order.
+    """
+    results = [None] * len(events)
+    parsed = []
+    for index, event in enumerate(events):
+        try:
+            staff_id, timestamp = parse_bulk_event(event)
+        except ValueError as e:
+            results[index] = {'index': index, 'status': 'invalid', 'error': str(e)}
+            continue
+        parsed.append((timestamp, index, staff_id, event))
+    parsed.sort(key=lambda item: (item[0], item[1]))
+    if not parsed:
+        return results
+    
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        staff_ids = {item[2] for item in parsed}
+        dates = {item[0].strftime('%Y-%m-%d') for item in parsed}
+        
+        known_staff = set()
+        for chunk in _chunks(staff_ids):
+            cursor.execute(f"SELECT id FROM staff WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            known_staff.update(row['id'] for row in cursor.fetchall())
+        
+        # Today's state per (staff_id, date), as the handlers would see it
+        logs = {}
+        for chunk in _chunks(dates):
+            cursor.execute(f'''
+                SELECT id, staff_id, date, check_in_time, check_out_time, total_break_time 
+                FROM check_in_logs 
+                WHERE date IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for row in cursor.fetchall():
+                if row['staff_id'] in staff_ids:
+                    logs[(row['staff_id'], row['date'])] = {
+                        'id': row['id'],
+                        'new': False,
+                        'dirty': False,
+                        'check_out_time': row['check_out_time'],
+                        'total_break_time': row['total_break_time'] or 0,
+                        'active_break': None
+                    }
+        by_log_id = {log['id']: log for log in logs.values()}
+        for chunk in _chunks(by_log_id):
+            cursor.execute(f'''
+                SELECT id, check_in_log_id, break_start, break_type 
+                FROM break_logs 
+                WHERE break_end IS NULL AND check_in_log_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for row in cursor.fetchall():
+                by_log_id[row['check_in_log_id']]['active_break'] = {
+                    'id': row['id'], 'break_start': row['break_start'], 'break_type': row['break_type']
+                }
+        
+        # Ids are assigned up front so new breaks and locations can reference
+        # them; never reuse ids AUTOINCREMENT has already handed out
+        cursor.execute('''
+            SELECT MAX(
+                (SELECT COALESCE(MAX(id), 0) FROM check_in_logs),
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'check_in_logs'), 0)
+            )
+        ''')
+        next_log_id = cursor.fetchone()[0] + 1
+        
+        new_logs = []
+        new_breaks = []
+        closed_breaks = []
+        for timestamp, index, staff_id, event in parsed:
+            date = timestamp.strftime('%Y-%m-%d')
+            key = (staff_id, date)
+            log = logs.get(key)
+            event_type = event['type']
+            status = 'ok'
+            extra = {}
+            
+            if staff_id not in known_staff:
+                status = 'unknown_staff'
+            elif event_type == 'check_in':
+                if log:
+                    status = 'already_checked_in'
+                else:
+                    is_late = is_late_check_in(timestamp)
+                    log = logs[key] = {
+                        'id': next_log_id,
+                        'new': True,
+                        'dirty': True,
+                        'staff_id': staff_id,
+                        'date': date,
+                        'check_in_time': timestamp,
+                        'is_late': is_late,
+                        'late_reason': event.get('late_reason'),
+                        'check_out_time': None,
+                        'total_break_time': 0,
+                        'active_break': None
+                    }
+                    next_log_id += 1
+                    new_logs.append(log)
+                    extra['is_late'] = is_late
+            elif not log:
+                status = 'not_checked_in'
+            elif event_type == 'check_out':
+                if log['check_out_time'] is not None:
+                    status = 'already_checked_out'
+                else:
+                    if log['active_break']:
+                        log['active_break']['break_end'] = timestamp
+                        closed_breaks.append(log['active_break'])
+                        log['active_break'] = None
+                    log['check_out_time'] = timestamp
+                    log['dirty'] = True
+            elif event_type == 'break_start':
+                if log['active_break']:
+                    status = 'active_break'
+                else:
+                    log['active_break'] = {
+                        'id': None,
+                        'check_in_log_id': log['id'],
+                        'break_start': timestamp,
+                        'break_type': event.get('break_type', 'regular'),
+                        'break_end': None
+                    }
+                    new_breaks.append(log['active_break'])
+            elif event_type == 'break_end':
+                active_break = log['active_break']
+                if not active_break:
+                    status = 'no_active_break'
+                else:
+                    duration = int((timestamp - active_break['break_start']).total_seconds() / 60)
+                    active_break['break_end'] = timestamp
+                    if active_break['id'] is not None:
+                        closed_breaks.append(active_break)
+                    log['active_break'] = None
+                    log['total_break_time'] += duration
+                    log['dirty'] = True
+                    extra['duration'] = duration
+            
+            result = {'index': index, 'status': status, 'type': event_type, 'staff_id': staff_id, 'date': date}
+            if log and status == 'ok':
+                result['log_id'] = log['id']
+            result.update(extra)
+            results[index] = result
+        
+        cursor.executemany('''
+            INSERT INTO check_in_logs (
+                id, staff_id, check_in_time, check_out_time, date, is_late, late_reason, total_break_time
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (log['id'], log['staff_id'], log['check_in_time'], log['check_out_time'], log['date'],
+             log['is_late'], log['late_reason'], log['total_break_time'])
+            for log in new_logs
+        ])
+        user_agent_id = user_agent_cache.intern(cursor, client_info['user_agent'], shard_database(office))
+        site, network_type = get_network_classifier().classify(client_info['ip_address'])
+        cursor.executemany('''
+            INSERT INTO location_logs (check_in_log_id, ip_address, user_agent_id, site, network_type)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(log['id'], client_info['ip_address'], user_agent_id, site, network_type) for log in new_logs])
+        cursor.executemany(
+            'UPDATE check_in_logs SET check_out_time = ?, total_break_time = ? WHERE id = ?',
+            [(log['check_out_time'], log['total_break_time'], log['id'])
+             for log in logs.values() if log['dirty'] and not log['new']]
+        )
+        cursor.executemany('UPDATE break_logs SET break_end = ? WHERE id = ?',
+                           [(item['break_end'], item['id']) for item in closed_breaks])
+        cursor.executemany('''
+            INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type)
+            VALUES (?, ?, ?, ?)
+        ''', [
+            (item['check_in_log_id'], item['break_start'], item['break_end'], item['break_type'])
+            for item in new_breaks
+        ])
+        touched = {result['log_id'] for result in results if result and 'log_id' in result}
+        cursor.executemany(SUMMARY_UPSERT.format(where='l.id = ?'), [(log_id,) for log_id in touched])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for result in results:
+        if result and result['status'] != 'invalid':
+            today_cache.invalidate(result['staff_id'], result['date'])
+            if result['status'] == 'ok':
+                event_broker.publish(result['type'], {
+                    'staff_id': result['staff_id'],
+                    'date': result['date'],
+                    'log_id': result['log_id']
+                })
+    return results
+
+def apply_sharded_bulk_events(events, client_info):
+    """apply_bulk_events with each event sent to its staff member's shard.
+    
+    Each shard's events are applied in a transaction of their own.
+    """
+    groups = {}
+    for index, event in enumerate(events):
+        try:
+            office = shard_for_id(event['staff_id'])
+        except (KeyError, TypeError, ValueError):
+            office = app.config['HOME_OFFICE']  # Rejected by apply_bulk_events
+        groups.setdefault(office, []).append(index)
+    
+    results = [None] * len(events)
+    for office, indexes in groups.items():
+        shard_results = apply_bulk_events(get_db(office), [events[index] for index in indexes], client_info, office)
+        for index, result in zip(indexes, shard_results):
+            result['index'] = index
+            results[index] = result
+    return results
+
+# Rewrites total_break_time from the closed breaks of the matching logs and
+# returns the rows whose total actually changed
+BREAK_TOTALS_UPDATE = '''
+    WITH totals AS (
+        SELECT l.id AS log_id, COALESCE(SUM((b.break_end - b.break_start) / 60), 0) AS minutes
+        FROM check_in_logs l
+        LEFT JOIN break_logs b ON b.check_in_log_id = l.id AND b.break_end IS NOT NULL
+        WHERE {where}
+        GROUP BY l.id
+    )
+    UPDATE check_in_logs
+    SET total_break_time = totals.minutes
+    FROM totals
+    WHERE check_in_logs.id = totals.log_id
+      AND check_in_logs.total_break_time IS NOT totals.minutes
+    RETURNING id, staff_id, date
+'''
+
+# Background jobs. Each takes a pooled connection and the local time it runs
+# for, commits its own work, and returns a small dict kept in the run history.
+def job_auto_close(conn, now):
+    """Check out days and end breaks still open after AUTO_CLOSE_TIME.
+    
+    A forgotten check-out is closed at the cutoff on its own day, and open
+    breaks end at their day's check-out. Break totals and summary rows for
+    the closed days are updated in the same transaction.
+    """
+    hour, minute = map(int, app.config['AUTO_CLOSE_TIME'].split(':'))
+    cutoff = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    last_date = (now if now >= cutoff else now - timedelta(days=1)).strftime('%Y-%m-%d')
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            UPDATE check_in_logs
+            SET check_out_time = MAX(COALESCE(check_in_time, 0), CAST(strftime('%s', date) AS INTEGER) + ?)
+            WHERE check_out_time IS NULL AND date <= ?
+            RETURNING id, staff_id, date
+        ''', (hour * 3600 + minute * 60, last_date))
+        checked_out = cursor.fetchall()
+        cursor.execute('''
+            UPDATE break_logs
+            SET break_end = MAX(break_logs.break_start, l.check_out_time)
+            FROM check_in_logs l
+            WHERE break_logs.check_in_log_id = l.id
+              AND break_logs.break_end IS NULL
+              AND l.check_out_time IS NOT NULL
+            RETURNING break_logs.check_in_log_id
+        ''')
+        closed_breaks = [row[0] for row in cursor.fetchall()]
+        
+        fixed = []
+        for chunk in _chunks(sorted(set(closed_breaks))):
+            cursor.execute(BREAK_TOTALS_UPDATE.format(where=f"l.id IN ({','.join('?' * len(chunk))})"), chunk)
+            fixed.extend(cursor.fetchall())
+        touched = {row[0]: (row[1], row[2]) for row in checked_out + fixed}
+        cursor.executemany(SUMMARY_UPSERT.format(where='l.id = ?'), [(log_id,) for log_id in touched])
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    
+    today = now.strftime('%Y-%m-%d')
+    for log_id, (staff_id, date) in touched.items():
+        today_cache.invalidate(staff_id, date)
+    for log_id, staff_id, date in checked_out:
+        if date == today:
+            event_broker.publish('check_out', {'staff_id': staff_id, 'date': date, 'log_id': log_id})
+    return {'checked_out': len(checked_out), 'breaks_closed': len(closed_breaks), 'totals_fixed': len(fixed)}
+
+def _lookback_start(now):
+    return (now - timedelta(days=app.config['SCHEDULER_LOOKBACK_DAYS'])).strftime('%Y-%m-%d')
+
+def job_recompute_break_totals(conn, now):
+    """Repair total_break_time for recent days from the break logs"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(BREAK_TOTALS_UPDATE.format(where='l.date >= ?'), (_lookback_start(now),))
+        fixed = cursor.fetchall()
+        cursor.executemany(SUMMARY_UPSERT.format(where='l.id = ?'), [(row[0],) for row in fixed])
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    for log_id, staff_id, date in fixed:
+        today_cache.invalidate(staff_id, date)
+    return {'totals_fixed': len(fixed)}
+
+def job_refresh_summary(conn, now):
+    """Rebuild recent daily summary rows in case any drifted"""
+    try:
+        rows = backfill_daily_summary(conn.cursor(), _lookback_start(now), now.strftime('%Y-%m-%d'))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return {'rows': rows}
+
+def job_optimize(conn, now):
+    """Refresh the query planner statistics"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+        # PRAGMA optimize only maintains statistics that already exist
+        conn.execute('ANALYZE')
+        return {'ran': 'ANALYZE'}
+    conn.execute('PRAGMA optimize')
+    return {'ran': 'PRAGMA optimize'}
+
+def job_incremental_vacuum(conn, now):
+    """Return free pages to the filesystem (needs auto_vacuum=INCREMENTAL)"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return {'skipped': 'auto_vacuum is not INCREMENTAL'}
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # execute() steps the pragma once, which frees a single page
+    conn.executescript('PRAGMA incremental_vacuum;')
+    return {'pages_freed': free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]}
+
+def job_refresh_report_replica(conn, now):
+    """Copy the database to its reporting replica if it changed since the last copy"""
+    if not app.config['REPORT_REPLICA']:
+        return {'skipped': 'REPORT_REPLICA is off'}
+    database = conn.execute('PRAGMA database_list').fetchone()[2]
+    return get_report_replica(database).refresh(conn)
+
+# Jobs in the order they run when several are due at once
+SCHEDULED_JOBS = {
+    'auto_close': job_auto_close,
+    'recompute_break_totals': job_recompute_break_totals,
+    'refresh_summary': job_refresh_summary,
+    'optimize': job_optimize,
+    'incremental_vacuum': job_incremental_vacuum,
+    'refresh_report_replica': job_refresh_report_replica,
+}
+
+# Heavier jobs that wait for SCHEDULER_NIGHTLY_HOURS
+NIGHTLY_JOBS = {'recompute_break_totals', 'refresh_summary', 'optimize', 'incremental_vacuum'}
+
+class Scheduler:
+    """Runs SCHEDULED_JOBS on their intervals from a background thread.
+    
+    Every worker process runs a scheduler, but only the one holding the
+    scheduler_lease row runs jobs; the others take over once the lease goes
+    unrenewed for ``lease_ttl`` seconds. When each job last started is kept
+    in scheduler_jobs, so intervals hold across restarts and lease handovers.
+    Both tables live in ``pool``'s database; each job runs against every
+    shard ``shard_pools()`` returns.
+    """
+
+    LEASE = 'scheduler'
+
+    def __init__(self, pool, intervals, tick=60, lease_ttl=300, nightly_hours=(1, 5), shard_pools=None):
+        self.pool = pool
+        self.shard_pools = shard_pools
+        self.intervals = intervals
+        self.tick = tick
+        self.lease_ttl = lease_ttl
+        self.nightly_hours = nightly_hours
+        self.pid = os.getpid()
+        self.owner = f'{socket.gethostname()}:{self.pid}:{secrets.token_hex(4)}'
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            conn = self.pool.acquire()
+            try:
+                conn.execute('UPDATE scheduler_lease SET expires_at = 0 WHERE name = ? AND owner = ?',
+                             (self.LEASE, self.owner))
+                conn.commit()
+            finally:
+                self.pool.release(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing scheduler lease: {str(e)}")
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            try:
+                self.run_pending()
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {str(e)}")
+
+    def acquire_lease(self, conn):
+        """Take or renew the lease; False while another worker holds it"""
+        now = time.time()
+        rows = conn.execute('''
+            INSERT INTO scheduler_lease (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE scheduler_lease.owner = excluded.owner OR scheduler_lease.expires_at < ?
+            RETURNING owner
+        ''', (self.LEASE, self.owner, now + self.lease_ttl, now)).fetchall()
+        conn.commit()
+        return bool(rows)
+
+    def due_jobs(self, conn, now):
+        last_started = dict(conn.execute('SELECT name, last_started_at FROM scheduler_jobs').fetchall())
+        nightly = self.nightly_hours[0] <= now.hour < self.nightly_hours[1]
+        return [
+            name for name in SCHEDULED_JOBS
+            if self.intervals.get(name)
+            and (nightly or name not in NIGHTLY_JOBS)
+            and (last_started.get(name) or 0) + self.intervals[name] <= now.timestamp()
+        ]
+
+    def run_job(self, conn, name, now):
+        """Run one job and record how it went in scheduler_jobs"""
+        started = time.perf_counter()
+        result = error = None
+        try:
+            result = self.run_on_shards(SCHEDULED_JOBS[name], conn, now)
+        except Exception as e:
+            conn.rollback()
+            error = str(e)
+            logger.error(f"Scheduled job {name} failed: {error}")
+        duration_ms = (time.perf_counter() - started) * 1000
+        
+        conn.execute('''
+            INSERT INTO scheduler_jobs (
+                name, runs, failures, last_started_at, last_duration_ms, last_status, last_result, last_error
+            ) VALUES (?, 1, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                runs = runs + 1,
+                failures = failures + excluded.failures,
+                last_started_at = excluded.last_started_at,
+                last_duration_ms = excluded.last_duration_ms,
+                last_status = excluded.last_status,
+                last_result = excluded.last_result,
+                last_error = excluded.last_error
+        ''', (name, int(error is not None), now.timestamp(), duration_ms,
+              'error' if error else 'ok', json.dumps(result), error))
+        conn.commit()
+        if error is None:
+            logger.info(f"Scheduled job {name} took {duration_ms:.0f}ms: {result}")
+        return {'status': 'error' if error else 'ok', 'duration_ms': duration_ms, 'result': result, 'error': error}
 
-# Enable debug mode for development
-app.debug = True
+    def run_on_shards(self, job, conn, now):
+        """Run a job on the lease connection's database and every other shard.
+        
+        With several shards the result is {office: result}.
+        """
+        pools = self.shard_pools() if self.shard_pools else {}
+        if len(pools) <= 1:
+            return job(conn, now)
+        results = {}
+        for office, pool in pools.items():
+            if pool is self.pool:
+                results[office] = job(conn, now)
+                continue
+            shard_conn = pool.acquire()
+            try:
+                results[office] = job(shard_conn, now)
+            finally:
+                pool.release(shard_conn)
+        return results
 
-# Custom SQLite adapters and converters for Python 3.12 compatibility
-def adapt_datetime(dt):
-    return dt.isoformat()
+    def run_pending(self, now=None, jobs=None, force=False):
+        """Run due jobs while holding the lease.
+        
+        ``jobs`` limits the run to the named jobs, and ``force`` runs them
+        whether or not they are due. Returns {name: run} or None when
+        another worker holds the lease.
+        """
+        now = now or datetime.now()
+        conn = self.pool.acquire()
+        try:
+            if not self.acquire_lease(conn):
+                return None
+            names = list(jobs) if force and jobs else self.due_jobs(conn, now)
+            if jobs:
+                names = [name for name in names if name in jobs]
+            results = {}
+            for name in names:
+                # Renew so the lease covers each job from its start
+                if not self.acquire_lease(conn):
+                    break
+                results[name] = self.run_job(conn, name, now)
+            return results
+        finally:
+            self.pool.release(conn)
 
-def convert_datetime(val):
-    try:
-        return datetime.fromisoformat(val.decode())
-    except (AttributeError, ValueError):
-        return None
+_scheduler = None
+_scheduler_lock = threading.Lock()
 
-sqlite3.register_adapter(datetime, adapt_datetime)
-sqlite3.register_converter("timestamp", convert_datetime)
+def make_scheduler(pool):
+    return Scheduler(
+        pool,
+        app.config['SCHEDULER_JOBS'],
+        tick=app.config['SCHEDULER_TICK'],
+        lease_ttl=app.config['SCHEDULER_LEASE_TTL'],
+        nightly_hours=app.config['SCHEDULER_NIGHTLY_HOURS'],
+        shard_pools=shard_pools,
+    )
 
-# Configuration
-class Config:
-    # Database setup
-    DATABASE_PATH = 'check_in_system.db'
-    
-    # File upload configuration
-    UPLOAD_FOLDER = 'static/uploads'
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-    
-    # Session configuration
-    SESSION_COOKIE_SECURE = False  # Set to True only if using HTTPS
-    SESSION_COOKIE_HTTPONLY = True
-    SESSION_COOKIE_SAMESITE = 'Lax'
-    PERMANENT_SESSION_LIFETIME = timedelta(hours=8)
+def get_scheduler():
+    """Get this worker's scheduler, starting its thread on first use"""
+    global _scheduler
+    pool = get_pool()
+    if _scheduler is None or _scheduler.pool is not pool:
+        with _scheduler_lock:
+            if _scheduler is None or _scheduler.pool is not pool:
+                # A forked worker inherits the object but not the thread
+                if _scheduler is not None and _scheduler.pid == os.getpid():
+                    _scheduler.stop()
+                _scheduler = make_scheduler(pool)
+                _scheduler.start()
+    return _scheduler
+
+@app.before_request
+def start_scheduler():
+    if app.config['SCHEDULER_ENABLED']:
+        get_scheduler()
+
+class StaticAssets:
+    """Fingerprinted, precompressed copies of the files under static/.
     
-    # Check-in configuration
-    LATE_THRESHOLD = 9  # 9 AM
-    WORK_HOURS = 8  # 8 hours per day
-    BREAK_TYPES = {
-        'short': 15,    # 15 minutes
-        'regular': 30,  # 30 minutes
-        'lunch': 60     # 1 hour
-    }
+    Built once per process: every file gets a content-hashed name
+    (css/style.1a2b3c4d5e6f.css) plus gzip and, when the brotli module is
+    installed, brotli variants if they come out smaller. Content behind a
+    hashed name never changes, so those URLs are cached for a year. Files
+    in ``unversioned`` keep their plain name and are always revalidated.
+    """
 
-# Apply configuration
-app.config.from_object(Config)
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map'}
+    ENCODINGS = ('br', 'gzip')
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    def __init__(self, root, exclude=(), unversioned=()):
+        self.root = root
+        self.exclude = tuple(exclude)
+        self.unversioned = set(unversioned)
+        self.manifest = {}  # plain name -> fingerprinted name
+        self._assets = {}  # served name -> (asset, immutable)
+        self.version = None
+        self.build()
 
-def get_client_info():
-    """Get basic client information with error handling"""
-    try:
-        user_agent = request.headers.get('User-Agent', '').lower()
-        return {
-            'ip_address': request.remote_addr,
-            'browser': request.headers.get('User-Agent', 'Unknown'),
-            'is_mobile': any(device in user_agent for device in ['mobile', 'android', 'iphone', 'ipad'])
-        }
-    except Exception as e:
-        print(f"Error getting client info: {str(e)}")
+    def _read(self, name):
+        path = os.path.join(self.root, name)
+        with open(path, 'rb') as f:
+            return f.read(), datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+
+    def _asset(self, name, data, mtime):
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        variants = {'identity': data}
+        if os.path.splitext(name)[1] in self.COMPRESSIBLE:
+            compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(data, quality=11)
+            variants.update((encoding, body) for encoding, body in compressed.items() if len(body) < len(data))
         return {
-            'ip_address': 'Unknown',
-            'browser': 'Unknown',
-            'is_mobile': False
+            'digest': digest,
+            'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'mtime': mtime,
+            'variants': variants,
         }
 
-def init_db():
-    """Initialize the database with required tables"""
-    try:
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
-        cursor = conn.cursor()
-        
-        # Create staff table with indexes
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS staff (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_staff_email ON staff(email)')
-        
-        # Create check_in_logs table with indexes
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS check_in_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            staff_id INTEGER NOT NULL,
-            check_in_time TIMESTAMP,
-            check_out_time TIMESTAMP,
-            date TEXT NOT NULL,
-            is_late BOOLEAN DEFAULT FALSE,
-            late_reason TEXT,
-            total_break_time INTEGER DEFAULT 0,
-            FOREIGN KEY (staff_id) REFERENCES staff (id)
-        )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_check_in_logs_staff_date ON check_in_logs(staff_id, date)')
-        
-        # Create break_logs table with indexes
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS break_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            check_in_log_id INTEGER NOT NULL,
-            break_start TIMESTAMP NOT NULL,
-            break_end TIMESTAMP,
-            break_type TEXT NOT NULL,
-            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id)
-        )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_break_logs_check_in ON break_logs(check_in_log_id)')
+    def build(self):
+        manifest, assets = {}, {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if name.startswith(self.exclude) or name in self.unversioned:
+                    continue
+                asset = self._asset(name, *self._read(name))
+                stem, ext = os.path.splitext(name)
+                manifest[name] = f"{stem}.{asset['digest']}{ext}"
+                assets[manifest[name]] = (asset, True)
+                # The plain name still works, but has to be revalidated
+                assets[name] = (asset, False)
+        self.version = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+        self.manifest = manifest
         
-        # Create simplified location_logs table with indexes
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS location_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            check_in_log_id INTEGER NOT NULL,
-            ip_address TEXT NOT NULL,
-            browser TEXT,
-            is_mobile BOOLEAN,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id)
+        for name in self.unversioned:
+            if not os.path.exists(os.path.join(self.root, name)):
+                continue
+            data, mtime = self._read(name)
+            if name == 'sw.js':
+                data = self.service_worker_header().encode() + data
+            assets[name] = (self._asset(name, data, mtime), False)
+        self._assets = assets
+
+    def service_worker_header(self):
+        """Cache version and precache list the service worker is built with"""
+        urls = sorted(f'/static/{name}' for name in self.manifest.values())
+        return (
+            '// Generated from the static asset manifest\n'
+            f'const CACHE_VERSION = {json.dumps(self.version)};\n'
+            f'const PRECACHE_URLS = {json.dumps(urls)};\n\n'
         )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_location_logs_check_in ON location_logs(check_in_log_id)')
-        
-        conn.commit()
-        conn.close()
-        print("Database initialized successfully")
-    except sqlite3.Error as e:
-        print(f"Database initialization error: {str(e)}")
-        raise
 
-def get_db():
-    """Get database connection with connection pooling"""
-    if not hasattr(g, 'sqlite_db'):
-        try:
-            g.sqlite_db = sqlite3.connect(
-                app.config['DATABASE_PATH'],
-                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-            )
-            g.sqlite_db.row_factory = sqlite3.Row
-        except sqlite3.Error as e:
-            print(f"Database connection error: {str(e)}")
-            raise
-    return g.sqlite_db
+    def url_name(self, filename):
+        return self.manifest.get(filename, filename)
 
-@app.teardown_appcontext
-def close_db(error):
-    """Close the database connection at the end of request"""
-    if hasattr(g, 'sqlite_db'):
-        try:
-            g.sqlite_db.close()
-        except Exception as e:
-            print(f"Error closing database: {str(e)}")
+    def lookup(self, filename):
+        """(asset, immutable) for a served name, or (None, False)"""
+        return self._assets.get(filename, (None, False))
 
-def cache_control(*directives):
-    """Add Cache-Control header with given directives."""
-    def decorator(view):
-        @wraps(view)
-        def wrapped(*args, **kwargs):
-            try:
-                response = make_response(view(*args, **kwargs))
-                response.headers['Cache-Control'] = ', '.join(directives)
-                return response
-            except Exception as e:
-                print(f"Cache control error: {str(e)}")
-                return view(*args, **kwargs)
-        return wrapped
-    return decorator
+    def negotiate(self, asset, accept_encodings):
+        for encoding in self.ENCODINGS:
+            if encoding in asset['variants'] and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
 
-@app.after_request
-def add_cache_headers(response):
-    """Add cache headers to static assets"""
-    try:
-        if request.path.startswith('/static'):
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
-    except Exception as e:
-        print(f"Error adding cache headers: {str(e)}")
-        return response
-
-# Serve static files with caching
-@app.route('/static/<path:filename>')
-@cache_control('public', 'max-age=3600')
-def serve_static(filename):
-    """Serve static files with proper MIME types and caching"""
-    try:
-        return send_file(f'static/{filename}')
-    except Exception as e:
-        print(f"Error serving static file: {str(e)}")
-        return '', 404
+STATIC_ROOT = os.path.join(app.root_path, 'static')
+_static_assets = None
+_static_assets_lock = threading.Lock()
+
+def get_static_assets():
+    """Build the static asset manifest on first use.
+    
+    Not at import: processes that never serve pages (password hashers,
+    CLI commands) would otherwise pay for max-quality compression.
+    """
+    global _static_assets
+    if _static_assets is None:
+        with _static_assets_lock:
+            if _static_assets is None:
+                _static_assets = StaticAssets(
+                    STATIC_ROOT,
+                    exclude=(os.path.relpath(app.config['UPLOAD_FOLDER'], 'static').replace(os.sep, '/') + '/',),
+                    unversioned=('sw.js',),
+                )
+    return _static_assets
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Make url_for('static', filename=...) emit the fingerprinted name"""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = get_static_assets().url_name(values['filename'])
+
+@app.route('/static/<path:filename>', endpoint='static')
+def static_file(filename):
+    """Serve a static asset, precompressed and cached by its fingerprint"""
+    static_assets = get_static_assets()
+    asset, immutable = static_assets.lookup(filename)
+    if asset is None:
+        # Uploads and anything added after startup come straight from disk
+        return send_from_directory(STATIC_ROOT, filename, max_age=3600)
+    
+    encoding = static_assets.negotiate(asset, request.accept_encodings)
+    response = Response(asset['variants'][encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(f"{asset['digest']}-{encoding}")
+    response.last_modified = asset['mtime']
+    response.headers['Cache-Control'] = (
+        'public, max-age=31536000, immutable' if immutable else 'public, no-cache'
+    )
+    return response.make_conditional(request)
 
 # Routes
 @app.route('/')
 def index():
     """Home page route"""
     if 'user_id' in session:
-        # Detect device type
-        user_agent = request.headers.get('User-Agent', '').lower()
-        is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
-        
         # Redirect based on device type
-        if is_mobile:
+        if get_client_info()['is_mobile']:
             return redirect(url_for('mobile_check_in'))
         return redirect(url_for('dashboard'))
     return render_template('login.html')
 
+def find_staff_by_email(cursor, email):
+    cursor.execute('SELECT id, name, role, password FROM staff WHERE email = ?', (email,))
+    return cursor.fetchone()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login route with error handling"""
@@ -250,31 +3436,30 @@ def login():
         password = request.form['password']
         
         try:
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT id, name, role, password FROM staff WHERE email = ?', (email,))
-            user = cursor.fetchone()
+            # Staff may be in any office's shard
+            user = next((row for row in fan_out(find_staff_by_email, email).values() if row), None)
             
             if user:
-                # Try the new pbkdf2:sha256 method first
-                if check_password_hash(user['password'], password):
+                if verify_password(user['password'], password):
+                    if hasattr(session, 'regenerate'):
+                        session.regenerate()
                     session['user_id'] = user['id']
                     session['user_name'] = user['name']
                     session['user_role'] = user['role']
                     flash('Login successful!', 'success')
                     
-                    # Update user's password to new hashing method if it's using old method
-                    if not user['password'].startswith('pbkdf2:sha256'):
-                        new_hash = generate_password_hash(password, method='pbkdf2:sha256')
-                        cursor.execute('UPDATE staff SET password = ? WHERE id = ?', (new_hash, user['id']))
-                        conn.commit()
+                    # Re-hash with the configured method/cost if the stored hash predates it
+                    if password_needs_rehash(user['password']):
+                        try:
+                            new_hash = hash_password(password)
+                            conn = get_db(shard_for_id(user['id']))
+                            conn.execute('UPDATE staff SET password = ? WHERE id = ?', (new_hash, user['id']))
+                            conn.commit()
+                        except PasswordHasherBusy:
+                            pass  # Upgrade on a quieter login
                     
-                    # Detect device type and redirect
-                    user_agent = request.headers.get('User-Agent', '').lower()
-                    is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
-                    
-                    if is_mobile:
+                    # Redirect based on device type
+                    if get_client_info()['is_mobile']:
                         return redirect(url_for('mobile_check_in'))
                     return redirect(url_for('dashboard'))
                 else:
@@ -285,19 +3470,18 @@ def login():
                 flash('Invalid email or password', 'error')
                 
             return redirect(url_for('login'))
-                
+        
+        except PasswordHasherBusy:
+            flash('Lots of people are signing in right now. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
         except sqlite3.Error as e:
             logger.error(f"Database error during login: {str(e)}")
             flash(f'Database error: {str(e)}', 'error')
             return redirect(url_for('login'))
         except Exception as e:
-            logger.error(f"Unexpected error during login: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Unexpected error during login: {str(e)}")
             flash('An unexpected error occurred. Please try again.', 'error')
             return redirect(url_for('login'))
-        finally:
-            if 'conn' in locals():
-                conn.close()
     
     return render_template('login.html')
 
@@ -312,6 +3496,64 @@ def logout():
     
     return redirect(url_for('login'))
 
+def staff_list_page(cursor, query='', page=1, page_size=25):
+    """One page of staff by name, optionally filtered by name or email"""
+    where, params = '1', []
+    if query:
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', query) + '%'
+        where = r"name LIKE ? ESCAPE '\' OR email LIKE ? ESCAPE '\'"
+        params = [pattern, pattern]
+    cursor.execute(f'SELECT COUNT(*) FROM staff WHERE {where}', params)
+    total = cursor.fetchone()[0]
+    cursor.execute(f'''
+        SELECT id, name, email, role FROM staff
+        WHERE {where}
+        ORDER BY name, id
+        LIMIT ? OFFSET ?
+    ''', params + [page_size, (page - 1) * page_size])
+    return {
+        'staff_list': cursor.fetchall(),
+        'staff_total': total,
+        'page_count': max(-(-total // page_size), 1),
+    }
+
+def late_check_ins_today(cursor, today):
+    """Today's late check-ins, latest first"""
+    cursor.execute('''
+        SELECT s.name, l.check_in_time
+        FROM check_in_logs l
+        JOIN staff s ON l.staff_id = s.id
+        WHERE l.date = ? AND l.is_late = 1
+        ORDER BY l.check_in_time DESC
+    ''', (today,))
+    return cursor.fetchall()
+
+def all_staff_list_page(query='', page=1, page_size=25):
+    """staff_list_page over every office's shard"""
+    pages = fan_out(staff_list_page, query, 1, page * page_size)
+    total = sum(result['staff_total'] for result in pages.values())
+    staff = merge_sorted({office: result['staff_list'] for office, result in pages.items()},
+                         key=lambda row: (row['name'], row['id']))
+    return {
+        'staff_list': staff[(page - 1) * page_size:page * page_size],
+        'staff_total': total,
+        'page_count': max(-(-total // page_size), 1),
+    }
+
+def all_late_check_ins_today(today, conn=None):
+    """late_check_ins_today over every office's shard, latest first"""
+    return merge_sorted(fan_out(late_check_ins_today, today, conn=conn),
+                        key=lambda row: row['check_in_time'], reverse=True)
+
+def merge_data_versions(results):
+    """Combine fan_out() results of get_data_versions into {name: (versions, latest updated_at)}"""
+    names = next(iter(results.values()))
+    return {
+        name: (tuple(versions[name][0] for versions in results.values()),
+               max(versions[name][1] for versions in results.values()))
+        for name in names
+    }
+
 @app.route('/dashboard')
 def dashboard():
     """Dashboard route"""
@@ -324,12 +3566,27 @@ def dashboard():
     
     conn = get_db()
     cursor = conn.cursor()
+    today = datetime.now().strftime('%Y-%m-%d')
+    staff_query = request.args.get('staff_q', '').strip()
+    staff_page = max(request.args.get('staff_page', 1, type=int), 1)
+    
+    # Everything below is derived from these versions, so an unchanged
+    # version set means the page the client already has is still current.
+    # Admin tables cover every office, so admins depend on every shard's.
+    if user_role == 'admin':
+        versions = merge_data_versions(fan_out(get_data_versions, 'staff', 'check_ins', 'attendance'))
+    else:
+        versions = get_data_versions(cursor, 'staff', 'check_ins', 'attendance')
+    if '_flashes' not in session:
+        response = not_modified(
+            user_id, user_name, user_role, today, staff_query, staff_page, sorted(versions.items()),
+            last_modified=datetime.fromtimestamp(max(v[1] for v in versions.values()), timezone.utc)
+        )
+        if response is not None:
+            return response
     
     # Check if user has checked in today
-    today = datetime.now().strftime('%Y-%m-%d')
-    cursor.execute('SELECT id, check_in_time, check_out_time, is_late, total_break_time FROM check_in_logs WHERE staff_id = ? AND date = ?', 
-                  (user_id, today))
-    log = cursor.fetchone()
+    log = get_today_status(user_id, today)
     
     # Get attendance statistics
     # Last 5 days attendance
@@ -347,40 +3604,46 @@ def dashboard():
     ''', (user_id,))
     recent_logs = cursor.fetchall()
     
-    # Calculate statistics
-    total_days = len(recent_logs)
-    on_time_days = sum(1 for log in recent_logs if not log[3])  # not late
-    late_days = sum(1 for log in recent_logs if log[3])  # late
-    avg_break_time = sum(log[4] or 0 for log in recent_logs) / total_days if total_days > 0 else 0
+    # Attendance statistics over the same days, from the precomputed summary
+    cursor.execute('''
+        SELECT 
+            COUNT(*) as total_days,
+            COALESCE(SUM(is_late), 0) as late_days,
+            COALESCE(AVG(break_minutes), 0) as avg_break_time
+        FROM (
+            SELECT is_late, break_minutes 
+            FROM daily_attendance_summary 
+            WHERE staff_id = ? 
+            ORDER BY date DESC 
+            LIMIT 5
+        )
+    ''', (user_id,))
+    summary = cursor.fetchone()
+    total_days = summary['total_days']
+    late_days = summary['late_days']
+    on_time_days = total_days - late_days
+    avg_break_time = summary['avg_break_time']
     
     # Get current break status
-    active_break = None
-    if log:
-        cursor.execute('''
-            SELECT break_start, break_type 
-            FROM break_logs 
-            WHERE check_in_log_id = ? AND break_end IS NULL
-        ''', (log[0],))
-        active_break = cursor.fetchone()
+    active_break = log['active_break'] if log else None
     
-    # Get all staff for admin view
-    staff_list = []
-    late_check_ins = []
+    # Admin tables are cached as rendered fragments, keyed by the versions
+    # of the data they show
+    staff_table_html = late_check_ins_html = None
     if user_role == 'admin':
-        cursor.execute('SELECT id, name, email, role FROM staff')
-        staff_list = cursor.fetchall()
-        
-        # Get today's late check-ins for admin
-        cursor.execute('''
-            SELECT s.name, l.check_in_time 
-            FROM check_in_logs l 
-            JOIN staff s ON l.staff_id = s.id 
-            WHERE l.date = ? AND l.is_late = 1
-            ORDER BY l.check_in_time DESC
-        ''', (today,))
-        late_check_ins = cursor.fetchall()
-    
-    conn.close()
+        staff_table_html = fragment_cache.render(
+            ('staff_table', versions['staff'][0], user_id, staff_query, staff_page),
+            'staff_table.html',
+            user_id=user_id,
+            staff_query=staff_query,
+            staff_page=staff_page,
+            **all_staff_list_page(staff_query, staff_page, app.config['STAFF_PAGE_SIZE'])
+        )
+        late_check_ins_html = fragment_cache.render(
+            ('late_check_ins', versions['staff'][0], versions['check_ins'][0], today),
+            'late_check_ins.html',
+            late_check_ins=all_late_check_ins_today(today)
+        )
     
     # Calculate attendance percentages
     attendance_stats = {
@@ -392,17 +3655,18 @@ def dashboard():
         'late_days': late_days
     }
     
-    return render_template('dashboard.html', 
+    return set_validators(make_response(render_template('dashboard.html', 
                          user_name=user_name, 
                          user_role=user_role,
                          log=log,
                          today=today,
-                         staff_list=staff_list,
-                         is_late=log[3] if log else False,
-                         late_check_ins=late_check_ins,
+                         staff_table_html=staff_table_html,
+                         is_late=log['is_late'] if log else False,
+                         late_check_ins_html=late_check_ins_html,
                          active_break=active_break,
+                         state=today_state(log),
                          attendance_stats=attendance_stats,
-                         recent_logs=recent_logs)
+                         recent_logs=recent_logs)))
 
 @app.route('/check_in', methods=['POST'])
 def check_in():
@@ -410,28 +3674,18 @@ def check_in():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    staff_id_to_check_in = request.form.get('staff_id', session['user_id'])
+    staff_id_to_check_in = request.form.get('staff_id', session['user_id'], type=int)
     if session['user_role'] != 'admin':
         staff_id_to_check_in = session['user_id']
     
     today_str = datetime.now().strftime('%Y-%m-%d')
     now = datetime.now()
-    nine_am_today = now.replace(hour=9, minute=0, second=0, microsecond=0)
-    is_late = now > nine_am_today
+    is_late = is_late_check_in(now)
     late_reason = None
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
         # Check for existing check-in
-        cursor.execute('''
-            SELECT id FROM check_in_logs 
-            WHERE staff_id = ? AND date = ?
-        ''', (staff_id_to_check_in, today_str))
-        existing_log = cursor.fetchone()
-        
-        if existing_log:
+        if get_today_status(staff_id_to_check_in, today_str):
             flash('You\'ve already checked in today! 👍', 'info')
             return redirect(url_for('dashboard'))
         
@@ -446,30 +3700,11 @@ def check_in():
                     return jsonify({'need_reason': True})
                 return render_template('late_reason.html')
         
-        # Insert check-in log
-        cursor.execute('''
-            INSERT INTO check_in_logs (staff_id, check_in_time, date, is_late, late_reason)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (staff_id_to_check_in, now, today_str, is_late, late_reason))
-        check_in_log_id = cursor.lastrowid
-        
-        # Insert location log
-        cursor.execute('''
-            INSERT INTO location_logs (check_in_log_id, ip_address, browser, is_mobile)
-            VALUES (?, ?, ?, ?)
-        ''', (
-            check_in_log_id,
-            client_info['ip_address'],
-            client_info['browser'],
-            client_info['is_mobile']
-        ))
-        
-        # Get staff info for message
-        cursor.execute('SELECT name, email FROM staff WHERE id = ?', (staff_id_to_check_in,))
-        staff_info = cursor.fetchone()
-        staff_name = staff_info['name']
+        result = apply_write(record_check_in, staff_id_to_check_in, now, is_late, late_reason, client_info)
         
-        conn.commit()
+        if result['status'] == 'already_checked_in':
+            flash('You\'ve already checked in today! 👍', 'info')
+            return redirect(url_for('dashboard'))
         
         if is_late:
             if is_mobile:
@@ -481,9 +3716,6 @@ def check_in():
         
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'success': True})
@@ -497,62 +3729,25 @@ def submit_late_reason():
         return redirect(url_for('login'))
     
     # Check if request is from mobile
-    user_agent = request.headers.get('User-Agent', '').lower()
-    is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
-    
-    if not is_mobile:
+    if not get_client_info()['is_mobile']:
         flash('Late reason submission is only available on mobile devices', 'warning')
         return redirect(url_for('dashboard'))
     
     staff_id = session['user_id']
     late_reason = request.form.get('late_reason')
-    today_str = datetime.now().strftime('%Y-%m-%d')
     now = datetime.now()
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Check for existing check-in
-        cursor.execute('''
-            SELECT id FROM check_in_logs 
-            WHERE staff_id = ? AND date = ?
-        ''', (staff_id, today_str))
-        existing_log = cursor.fetchone()
-        
-        if existing_log:
+        # Insert check-in log with late reason
+        result = apply_write(record_check_in, staff_id, now, True, late_reason, get_client_info())
+        if result['status'] == 'already_checked_in':
             flash('You\'ve already checked in today!', 'info')
             return redirect(url_for('mobile_check_in'))
         
-        # Insert check-in log with late reason
-        cursor.execute('''
-            INSERT INTO check_in_logs (
-                staff_id, check_in_time, date, is_late, late_reason
-            ) VALUES (?, ?, ?, ?, ?)
-        ''', (staff_id, now, today_str, True, late_reason))
-        check_in_log_id = cursor.lastrowid
-        
-        # Insert location log
-        client_info = get_client_info()
-        cursor.execute('''
-            INSERT INTO location_logs (
-                check_in_log_id, ip_address, browser, is_mobile
-            ) VALUES (?, ?, ?, ?)
-        ''', (
-            check_in_log_id,
-            client_info['ip_address'],
-            client_info['browser'],
-            client_info['is_mobile']
-        ))
-        
-        conn.commit()
         flash('Check-in completed with late reason recorded. Thank you for the explanation! 👍', 'success')
         
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     return redirect(url_for('mobile_check_in'))
 
@@ -562,52 +3757,24 @@ def check_out():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    staff_id_to_check_out = request.form.get('staff_id', session['user_id'])
+    staff_id_to_check_out = request.form.get('staff_id', session['user_id'], type=int)
     if session['user_role'] != 'admin':
         staff_id_to_check_out = session['user_id']
     
-    today = datetime.now().strftime('%Y-%m-%d')
     now = datetime.now()
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get check-in record
-        cursor.execute('''
-            SELECT id, check_out_time 
-            FROM check_in_logs 
-            WHERE staff_id = ? AND date = ?
-        ''', (staff_id_to_check_out, today))
-        log = cursor.fetchone()
+        result = apply_write(record_check_out, staff_id_to_check_out, now)
         
-        if not log:
+        if result['status'] == 'not_checked_in':
             flash('Don\'t forget to check in first! 😊', 'info')
-        elif log['check_out_time'] is not None:
+        elif result['status'] == 'already_checked_out':
             flash('You\'ve already checked out. See you tomorrow! 👋', 'info')
         else:
-            # End any active breaks
-            cursor.execute('''
-                UPDATE break_logs 
-                SET break_end = ? 
-                WHERE check_in_log_id = ? AND break_end IS NULL
-            ''', (now, log['id']))
-            
-            # Update check-out time
-            cursor.execute('''
-                UPDATE check_in_logs 
-                SET check_out_time = ? 
-                WHERE id = ?
-            ''', (now, log['id']))
-            
-            conn.commit()
             flash('Great job today! Have a wonderful evening! 🌟', 'success')
         
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     return redirect(url_for('dashboard'))
 
@@ -620,119 +3787,424 @@ def register():
         name = request.form['name']
         email = request.form['email']
         password = request.form['password']
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
         
         # Only admins can create other admin accounts
         role = request.form['role'] if is_admin else 'staff'
+        office = request.form.get('office') or current_office()
         
         try:
-            conn = get_db()
-            cursor = conn.cursor()
+            if office not in shard_databases():
+                raise ValueError(f'Unknown office: {office}')
+            hashed_password = hash_password(password)
             
-            cursor.execute('''
-                INSERT INTO staff (name, email, password, role, created_at) 
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (name, email, hashed_password, role))
-            conn.commit()
+            # A shard's staff table only sees its own office's emails, so the
+            # email is claimed in the home shard first; a concurrent register
+            # of the same email in another office fails here
+            home = get_db(app.config['HOME_OFFICE'])
+            try:
+                home.execute('INSERT INTO staff_emails (email) VALUES (?)', (email,))
+                home.commit()
+            except sqlite3.Error:
+                home.rollback()
+                raise
+            conn = get_db(office)
+            try:
+                conn.execute('''
+                    INSERT INTO staff (name, email, password, role, created_at) 
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (name, email, hashed_password, role))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                home.execute('DELETE FROM staff_emails WHERE email = ?', (email,))
+                home.commit()
+                raise
             
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
             
         except sqlite3.IntegrityError:
             flash('Email already exists', 'error')
+        except ValueError as e:
+            flash(str(e), 'error')
+        except PasswordHasherBusy:
+            flash('The server is busy right now. Please try again in a moment.', 'warning')
         except sqlite3.Error as e:
             flash(f'Database error: {str(e)}', 'error')
-        finally:
-            if 'conn' in locals():
-                conn.close()
         
         if is_admin:
             return redirect(url_for('dashboard'))
         return redirect(url_for('register'))
     
-    return render_template('register.html', is_admin=is_admin)
+    return render_template('register.html', is_admin=is_admin, offices=list(shard_databases()),
+                           selected_office=current_office())
+
+def daily_report(cursor, date):
+    """Every check-in log for a day with its open break, in check-in order"""
+    # The open break (start_break allows at most one per log) comes from the
+    # idx_break_logs_open partial index
+    cursor.execute(f'''
+        SELECT 
+            l.id,
+            s.name,
+            l.check_in_time,
+            l.check_out_time,
+            s.id as staff_id,
+            b.id IS NOT NULL as is_on_break,
+            b.break_start,
+            b.break_type,
+            l.is_late,
+            l.late_reason,
+            l.total_break_time,
+            strftime('%H:%M:%S', l.check_in_time, 'unixepoch') as check_in_at,
+            strftime('%H:%M:%S', l.check_out_time, 'unixepoch') as check_out_at,
+            strftime('%H:%M:%S', b.break_start, 'unixepoch') as break_since,
+            CASE WHEN l.check_out_time IS NOT NULL
+                 THEN {sql_hms('l.check_out_time - l.check_in_time')} ELSE 'N/A' END as duration
+        FROM check_in_logs l 
+        JOIN staff s ON l.staff_id = s.id 
+        LEFT JOIN break_logs b ON b.check_in_log_id = l.id AND b.break_end IS NULL
+        WHERE l.date = ?
+        ORDER BY l.check_in_time
+    ''', (date,))
+    return cursor.fetchall()
+
+@app.route('/reports')
+def reports():
+    """View reports route with error handling (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        flash('Unauthorized access', 'error')
+        return redirect(url_for('dashboard'))
+    
+    # Get date filter from query params
+    date_filter = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+    
+    data_as_of = None
+    try:
+        # Get all logs for the selected date from every office's reporting replica
+        data_as_of = report_data_as_of()
+        logs = merge_sorted(fan_out(daily_report, date_filter, replica=True),
+                            key=lambda row: row['check_in_time'] or EPOCH)
+        
+    except sqlite3.Error as e:
+        flash(f'Database error: {str(e)}', 'error')
+        logs = []
+    
+    return render_template('reports.html', 
+                         logs=logs, 
+                         selected_date=date_filter,
+                         data_as_of=data_as_of)
+
+# Shared CTEs for /reports/range. Every column read from check_in_logs is in
+# idx_check_in_logs_date_cover, so the log scan is index-only. Staff count
+# towards absences from the day they joined, or their first check-in if
+# history was imported before their account was created.
+RANGE_REPORT_CTES = '''
+    WITH RECURSIVE days(day) AS (
+        SELECT :start
+        UNION ALL
+        SELECT date(day, '+1 day') FROM days WHERE day < :end
+    ),
+    logs AS (
+        SELECT l.id, l.date, l.staff_id, l.is_late, l.total_break_time,
+               l.check_out_time - l.check_in_time AS worked_seconds
+        FROM check_in_logs l
+        WHERE l.date BETWEEN :start AND :end
+          AND (:staff_id IS NULL OR l.staff_id = :staff_id)
+    ),
+    roster AS MATERIALIZED (
+        SELECT s.id, s.name,
+               MIN(date(s.created_at),
+                   COALESCE((SELECT MIN(date) FROM check_in_logs WHERE staff_id = s.id), date(s.created_at))) AS joined
+        FROM staff s
+        WHERE :staff_id IS NULL OR s.id = :staff_id
+    ),
+    workdays AS MATERIALIZED (
+        SELECT day FROM days WHERE strftime('%w', day) NOT IN ('0', '6')
+    ),
+    per_day AS (
+        SELECT d.day,
+               strftime('%w', d.day) NOT IN ('0', '6') AS is_workday,
+               (SELECT COUNT(*) FROM roster r WHERE r.joined <= d.day) AS roster_size,
+               COUNT(l.staff_id) AS present,
+               COALESCE(SUM(l.is_late), 0) AS late,
+               COALESCE(SUM(l.worked_seconds), 0) AS worked_seconds,
+               COUNT(l.worked_seconds) AS completed,
+               COALESCE(SUM(l.total_break_time), 0) AS break_minutes
+        FROM days d
+        LEFT JOIN logs l ON l.date = d.day
+        GROUP BY d.day
+    )
+'''
+
+# One query per grouping. Each computes its aggregates and window columns
+# over the whole range first, then applies the keyset condition, so a
+# page's rolling averages and ranks match the unpaginated report.
+RANGE_REPORT_QUERIES = {
+    'day': RANGE_REPORT_CTES + '''
+        SELECT * FROM (
+            SELECT day AS period, present, late, worked_seconds, completed, break_minutes,
+                   CASE WHEN is_workday THEN MAX(roster_size - present, 0) ELSE 0 END AS absences,
+                   late * 1.0 / NULLIF(present, 0) AS late_rate,
+                   AVG(late * 1.0 / NULLIF(present, 0))
+                       OVER (ORDER BY day ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) AS rolling_late_rate
+            FROM per_day
+        )
+        WHERE :after IS NULL OR period > :after
+        ORDER BY period
+        LIMIT :limit
+    ''',
+    'week': RANGE_REPORT_CTES + '''
+        , per_week AS (
+            SELECT date(day, '-6 days', 'weekday 1') AS week,
+                   SUM(present) AS present, SUM(late) AS late,
+                   SUM(worked_seconds) AS worked_seconds, SUM(completed) AS completed,
+                   SUM(break_minutes) AS break_minutes,
+                   SUM(CASE WHEN is_workday THEN MAX(roster_size - present, 0) ELSE 0 END) AS absences
+            FROM per_day
+            GROUP BY week
+        )
+        SELECT * FROM (
+            SELECT week AS period, present, late, worked_seconds, completed, break_minutes, absences,
+                   late * 1.0 / NULLIF(present, 0) AS late_rate,
+                   AVG(late * 1.0 / NULLIF(present, 0))
+                       OVER (ORDER BY week ROWS BETWEEN 3 PRECEDING AND CURRENT ROW) AS rolling_late_rate
+            FROM per_week
+        )
+        WHERE :after IS NULL OR period > :after
+        ORDER BY period
+        LIMIT :limit
+    ''',
+    'staff': RANGE_REPORT_CTES + '''
+        , per_staff AS (
+            SELECT r.id AS staff_id, r.name,
+                   COUNT(l.date) AS present,
+                   COALESCE(SUM(l.is_late), 0) AS late,
+                   COALESCE(SUM(l.worked_seconds), 0) AS worked_seconds,
+                   COUNT(l.worked_seconds) AS completed,
+                   COALESCE(SUM(l.total_break_time), 0) AS break_minutes,
+                   MAX((SELECT COUNT(*) FROM workdays w WHERE w.day >= r.joined)
+                       - COUNT(CASE WHEN strftime('%w', l.date) NOT IN ('0', '6') THEN 1 END), 0) AS absences
+            FROM roster r
+            LEFT JOIN logs l ON l.staff_id = r.id
+            GROUP BY r.id
+        )
+        SELECT * FROM (
+            SELECT staff_id, name AS period, present, late, worked_seconds, completed, break_minutes, absences,
+                   late * 1.0 / NULLIF(present, 0) AS late_rate,
+                   RANK() OVER (ORDER BY late * 1.0 / NULLIF(present, 0) DESC NULLS LAST) AS lateness_rank
+            FROM per_staff
+        )
+        WHERE :after IS NULL OR (period, staff_id) > (:after, :after_id)
+        ORDER BY period, staff_id
+        LIMIT :limit
+    ''',
+    # Offices by name, then VPN and remote check-ins; absences don't apply
+    'site': RANGE_REPORT_CTES + '''
+        , per_site AS (
+            SELECT COALESCE(loc.site, CASE WHEN loc.network_type IS NULL THEN 'Unknown' ELSE 'Remote' END) AS period,
+                   MIN(loc.network_type) AS network_type,
+                   COUNT(*) AS present,
+                   COUNT(DISTINCT l.staff_id) AS staff_count,
+                   SUM(l.is_late) AS late,
+                   COALESCE(SUM(l.worked_seconds), 0) AS worked_seconds,
+                   COUNT(l.worked_seconds) AS completed,
+                   COALESCE(SUM(l.total_break_time), 0) AS break_minutes
+            FROM logs l
+            LEFT JOIN location_logs loc ON loc.check_in_log_id = l.id
+            GROUP BY period
+        )
+        SELECT period, network_type, present, staff_count, late, worked_seconds, completed, break_minutes,
+               NULL AS absences, late * 1.0 / NULLIF(present, 0) AS late_rate
+        FROM per_site
+        WHERE :after IS NULL OR period > :after
+        ORDER BY period
+        LIMIT :limit
+    ''',
+}
+
+def encode_report_cursor(row, group_by):
+    """Opaque keyset cursor pointing just past a report row"""
+    key = [row['period'], row['staff_id']] if group_by == 'staff' else [row['period']]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_report_cursor(cursor_str):
+    padded = cursor_str + '=' * (-len(cursor_str) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded))
+    return key[0], (key[1] if len(key) > 1 else None)
+
+def format_range_row(item):
+    """Round a raw range report row for display"""
+    item['worked_hours'] = round(item.pop('worked_seconds') / 3600, 2)
+    item['avg_worked_hours'] = round(item['worked_hours'] / item['completed'], 2) if item['completed'] else None
+    for key in ('late_rate', 'rolling_late_rate'):
+        if item.get(key) is not None:
+            item[key] = round(item[key], 3)
+    return item
+
+def range_report(cursor, start, end, group_by, staff_id=None, after=None, limit=50):
+    """One page of aggregated attendance for a date range.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    after_key, after_id = decode_report_cursor(after) if after else (None, None)
+    cursor.execute(RANGE_REPORT_QUERIES[group_by], {
+        'start': start, 'end': end, 'staff_id': staff_id,
+        'after': after_key, 'after_id': after_id, 'limit': limit + 1,
+    })
+    rows = [format_range_row(dict(row)) for row in cursor.fetchall()]
+    next_cursor = encode_report_cursor(rows[limit - 1], group_by) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def range_report_rows(cursor, start, end, group_by, staff_id=None):
+    """Every row of a range report, unpaginated and unrounded"""
+    cursor.execute(RANGE_REPORT_QUERIES[group_by], {
+        'start': start, 'end': end, 'staff_id': staff_id, 'after': None, 'after_id': None, 'limit': -1,
+    })
+    return [dict(row) for row in cursor.fetchall()]
+
+# Columns added up when the same period comes from several shards
+RANGE_REPORT_TOTALS = ('present', 'late', 'worked_seconds', 'completed', 'break_minutes', 'absences', 'staff_count')
+# Rows in each rolling_late_rate window, matching RANGE_REPORT_QUERIES
+RANGE_REPORT_WINDOWS = {'day': 7, 'week': 4}
+
+def merge_range_reports(shard_rows, group_by):
+    """Combine range_report_rows() from several shards into one report.
+
+    Staff rows are disjoint across shards; rows for the same day, week or
+    site are added up. Rates, rolling averages and ranks are then worked out
+    over the combined rows the way the SQL does for a single shard.
+    """
+    if group_by == 'staff':
+        rows = sorted((row for rows in shard_rows for row in rows), key=lambda row: (row['period'], row['staff_id']))
+    else:
+        periods = {}
+        for rows in shard_rows:
+            for row in rows:
+                merged = periods.setdefault(row['period'], dict(row, **{key: None for key in RANGE_REPORT_TOTALS if key in row}))
+                for key in RANGE_REPORT_TOTALS:
+                    if row.get(key) is not None:
+                        merged[key] = (merged[key] or 0) + row[key]
+                if 'network_type' in row:
+                    merged['network_type'] = min(filter(None, (merged['network_type'], row['network_type'])), default=None)
+        rows = sorted(periods.values(), key=lambda row: row['period'])
+    
+    for row in rows:
+        row['late_rate'] = row['late'] / row['present'] if row['present'] else None
+    window = RANGE_REPORT_WINDOWS.get(group_by)
+    if window:
+        for index, row in enumerate(rows):
+            rates = [other['late_rate'] for other in rows[max(index - window + 1, 0):index + 1]
+                     if other['late_rate'] is not None]
+            row['rolling_late_rate'] = sum(rates) / len(rates) if rates else None
+    if group_by == 'staff':
+        # RANK() ... ORDER BY late_rate DESC NULLS LAST
+        ranked = sorted(rows, key=lambda row: (row['late_rate'] is None, -(row['late_rate'] or 0)))
+        previous = rank = None
+        for position, row in enumerate(ranked, start=1):
+            if rank is None or row['late_rate'] != previous:
+                rank, previous = position, row['late_rate']
+            row['lateness_rank'] = rank
+    return rows
 
-@app.route('/reports')
-def reports():
-    """View reports route with error handling (admin only)"""
+def sharded_range_report(start, end, group_by, staff_id=None, after=None, limit=50):
+    """range_report over every office's shard.
+
+    Windows and ranks span all shards, so each shard's full report is
+    fetched and merged before the requested page is cut from it.
+    """
+    rows = merge_range_reports(fan_out(range_report_rows, start, end, group_by, staff_id, replica=True).values(),
+                               group_by)
+    if after:
+        after_key, after_id = decode_report_cursor(after)
+        if group_by == 'staff':
+            rows = [row for row in rows if (row['period'], row['staff_id']) > (after_key, after_id)]
+        else:
+            rows = [row for row in rows if row['period'] > after_key]
+    page = [format_range_row(row) for row in rows[:limit + 1]]
+    next_cursor = encode_report_cursor(page[limit - 1], group_by) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+@app.route('/reports/range')
+def reports_range():
+    """Worked hours, lateness, breaks and absences over a date range (admin only).
+    
+    Query parameters: start, end (YYYY-MM-DD), group_by (day, week, staff or site),
+    optional staff_id, and the after cursor from the previous page. Returns
+    JSON when requested with format=json or an Accept: application/json header.
+    """
     if 'user_id' not in session or session['user_role'] != 'admin':
         flash('Unauthorized access', 'error')
         return redirect(url_for('dashboard'))
     
+    wants_json = (request.args.get('format') == 'json'
+                  or request.accept_mimetypes.best == 'application/json')
+    today = datetime.now().date()
+    start_str = request.args.get('start') or (today - timedelta(days=29)).isoformat()
+    end_str = request.args.get('end') or today.isoformat()
+    group_by = request.args.get('group_by', 'day')
+    staff_id = request.args.get('staff_id', type=int)
+    after = request.args.get('after') or None
+    
+    error = None
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get date filter from query params
-        date_filter = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
-        
-        # Get all logs for the selected date with break information
-        cursor.execute('''
-            SELECT 
-                l.id,
-                s.name,
-                l.check_in_time,
-                l.check_out_time,
-                s.id as staff_id,
-                (
-                    SELECT COUNT(*)
-                    FROM break_logs b
-                    WHERE b.check_in_log_id = l.id
-                    AND b.break_end IS NULL
-                ) > 0 as is_on_break,
-                (
-                    SELECT break_start
-                    FROM break_logs b
-                    WHERE b.check_in_log_id = l.id
-                    AND b.break_end IS NULL
-                    LIMIT 1
-                ) as break_start,
-                (
-                    SELECT break_type
-                    FROM break_logs b
-                    WHERE b.check_in_log_id = l.id
-                    AND b.break_end IS NULL
-                    LIMIT 1
-                ) as break_type,
-                l.is_late,
-                l.late_reason,
-                l.total_break_time
-            FROM check_in_logs l 
-            JOIN staff s ON l.staff_id = s.id 
-            WHERE l.date = ?
-            ORDER BY l.check_in_time
-        ''', (date_filter,))
-        
-        logs = cursor.fetchall()
-        
-        # Calculate durations for each log
-        durations = []
-        for log in logs:
-            check_in = log['check_in_time']
-            check_out = log['check_out_time']
-            if check_in and check_out:
-                try:
-                    check_in_dt = datetime.strptime(check_in, '%Y-%m-%d %H:%M:%S.%f') if '.' in check_in else datetime.strptime(check_in, '%Y-%m-%d %H:%M:%S')
-                    check_out_dt = datetime.strptime(check_out, '%Y-%m-%d %H:%M:%S.%f') if '.' in check_out else datetime.strptime(check_out, '%Y-%m-%d %H:%M:%S')
-                    duration = check_out_dt - check_in_dt
-                    durations.append(str(duration))
-                except (ValueError, TypeError):
-                    durations.append('N/A')
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_str, '%Y-%m-%d').date()
+    except ValueError:
+        error = 'Invalid date format. Please use YYYY-MM-DD.'
+    else:
+        # Dates compare as text in SQL, so 2024-3-5 must become 2024-03-05
+        start_str, end_str = start_date.isoformat(), end_date.isoformat()
+        if end_date < start_date:
+            error = 'End date must be on or after start date.'
+        elif (end_date - start_date).days >= app.config['RANGE_REPORT_MAX_DAYS']:
+            error = f"Date range is limited to {app.config['RANGE_REPORT_MAX_DAYS']} days."
+    if group_by not in RANGE_REPORT_QUERIES:
+        error = 'group_by must be day, week, staff or site.'
+    if after:
+        try:
+            decode_report_cursor(after)
+        except (ValueError, TypeError, IndexError):
+            error = 'Invalid page cursor.'
+    
+    rows, next_cursor, data_as_of = [], None, None
+    if error is None:
+        try:
+            if staff_id is not None or len(shard_databases()) == 1:
+                office = shard_for_id(staff_id or 0)
+                data_as_of = report_data_as_of([office])
+                rows, next_cursor = range_report(
+                    get_report_db(office).cursor(), start_str, end_str, group_by,
+                    staff_id=staff_id, after=after, limit=app.config['RANGE_REPORT_PAGE_SIZE'],
+                )
             else:
-                durations.append('N/A')
-        
-    except sqlite3.Error as e:
-        flash(f'Database error: {str(e)}', 'error')
-        logs = []
-        durations = []
-    finally:
-        if 'conn' in locals():
-            conn.close()
+                data_as_of = report_data_as_of()
+                rows, next_cursor = sharded_range_report(
+                    start_str, end_str, group_by,
+                    after=after, limit=app.config['RANGE_REPORT_PAGE_SIZE'],
+                )
+        except sqlite3.Error as e:
+            error = f'Database error: {str(e)}'
     
-    return render_template('reports.html', 
-                         logs=logs, 
-                         selected_date=date_filter, 
-                         durations=durations)
+    if wants_json:
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify({
+            'start': start_str, 'end': end_str, 'group_by': group_by, 'staff_id': staff_id,
+            'rows': rows, 'next': next_cursor,
+            'data_as_of': data_as_of.isoformat(timespec='seconds') if data_as_of else None,
+        })
+    
+    if error:
+        flash(error, 'error')
+    return render_template('reports_range.html',
+                         rows=rows,
+                         next_cursor=next_cursor,
+                         start=start_str,
+                         end=end_str,
+                         group_by=group_by,
+                         staff_id=staff_id,
+                         data_as_of=data_as_of)
 
 @app.route('/delete_log/<int:log_id>', methods=['POST'])
 def delete_log(log_id):
@@ -741,25 +4213,30 @@ def delete_log(log_id):
         flash('Unauthorized access', 'error')
         return redirect(url_for('dashboard'))
     
+    office = shard_for_id(log_id)
     try:
-        conn = get_db()
+        conn = get_db(office)
         cursor = conn.cursor()
         
         # Get the date of the log to redirect back to the correct report page
-        cursor.execute('SELECT date FROM check_in_logs WHERE id = ?', (log_id,))
+        cursor.execute('SELECT staff_id, date FROM check_in_logs WHERE id = ?', (log_id,))
         log_date = cursor.fetchone()
         
         if log_date:
-            # Delete related records first
-            cursor.execute('DELETE FROM location_logs WHERE check_in_log_id = ?', (log_id,))
-            cursor.execute('DELETE FROM break_logs WHERE check_in_log_id = ?', (log_id,))
-            
-            # Delete the log
+            # Location, break and summary rows go with it via ON DELETE CASCADE
             cursor.execute('DELETE FROM check_in_logs WHERE id = ?', (log_id,))
+            if app.config['RESET_SEQUENCES_ON_DELETE']:
+                reset_table_sequence('check_in_logs', office)
             conn.commit()
             
-            # Reset the sequence for the check_in_logs table
-            reset_table_sequence('check_in_logs')
+            today_cache.invalidate(log_date['staff_id'], log_date['date'])
+            # The reports page this redirects to should not show the log again
+            get_report_replica(shard_database(office)).invalidate()
+            event_broker.publish('log_deleted', {
+                'staff_id': log_date['staff_id'],
+                'date': log_date['date'],
+                'log_id': log_id
+            })
             
             flash('Check-in log deleted successfully', 'success')
             date_to_redirect = log_date['date']
@@ -770,36 +4247,26 @@ def delete_log(log_id):
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
         date_to_redirect = datetime.now().strftime('%Y-%m-%d')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     return redirect(url_for('reports', date=date_to_redirect))
 
-def reset_table_sequence(table_name):
-    """Reset the SQLite autoincrement sequence for a table with error handling"""
+def reset_table_sequence(table_name, office=None):
+    """Reset the SQLite autoincrement sequence for a table in an office's shard.
+    
+    Never goes below the start of the shard's id range. Runs in the
+    caller's transaction; the caller commits.
+    """
+    office = office or current_office()
+    floor = shard_databases()[office][0] << SHARD_ID_BITS
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get the maximum ID from the table
-        cursor.execute(f"SELECT MAX(id) as max_id FROM {table_name}")
-        result = cursor.fetchone()
-        max_id = result['max_id'] if result else 0
-        
-        # Reset the sequence
+        cursor = get_db(office).cursor()
         cursor.execute(
-            "UPDATE sqlite_sequence SET seq = ? WHERE name = ?",
-            (max_id or 0, table_name)
+            f"UPDATE sqlite_sequence SET seq = MAX((SELECT COALESCE(MAX(id), 0) FROM {table_name}), ?) WHERE name = ?",
+            (floor, table_name)
         )
-        conn.commit()
-        
     except sqlite3.Error as e:
-        print(f"Error resetting sequence for {table_name}: {str(e)}")
+        logger.error(f"Error resetting sequence for {table_name}: {str(e)}")
         raise
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/delete_staff/<int:staff_id>', methods=['POST'])
 def delete_staff(staff_id):
@@ -813,170 +4280,562 @@ def delete_staff(staff_id):
         flash('You cannot delete your own account', 'error')
         return redirect(url_for('dashboard'))
     
+    office = shard_for_id(staff_id)
     try:
-        conn = get_db()
+        conn = get_db(office)
         cursor = conn.cursor()
         
-        # Get all check-in logs for this staff member
-        cursor.execute('SELECT id FROM check_in_logs WHERE staff_id = ?', (staff_id,))
-        log_ids = [row['id'] for row in cursor.fetchall()]
+        # Check-in logs, and through them break, location and summary rows,
+        # are removed by ON DELETE CASCADE in the same transaction
+        cursor.execute('DELETE FROM staff WHERE id = ? RETURNING email', (staff_id,))
+        deleted = cursor.fetchone()
         
-        # Delete related records first
-        for log_id in log_ids:
-            cursor.execute('DELETE FROM location_logs WHERE check_in_log_id = ?', (log_id,))
-            cursor.execute('DELETE FROM break_logs WHERE check_in_log_id = ?', (log_id,))
-        
-        # Delete check-in logs
-        cursor.execute('DELETE FROM check_in_logs WHERE staff_id = ?', (staff_id,))
-        
-        # Finally, delete the staff member
-        cursor.execute('DELETE FROM staff WHERE id = ?', (staff_id,))
+        if app.config['RESET_SEQUENCES_ON_DELETE']:
+            for table_name in SHARDED_SEQUENCES:
+                reset_table_sequence(table_name, office)
         
         conn.commit()
-        
-        # Reset sequences
-        reset_table_sequence('staff')
-        reset_table_sequence('check_in_logs')
-        reset_table_sequence('break_logs')
-        reset_table_sequence('location_logs')
+        if deleted:
+            # Free the email for a new registration in any office
+            home = get_db(app.config['HOME_OFFICE'])
+            home.execute('DELETE FROM staff_emails WHERE email = ?', (deleted['email'],))
+            home.commit()
+        today_cache.invalidate(staff_id)
+        # Their server-side sessions were deleted by the cascade as well
+        if hasattr(app.session_interface, 'invalidate_user'):
+            app.session_interface.invalidate_user(staff_id)
         
         flash('Staff member and all associated records deleted successfully', 'success')
         
     except sqlite3.Error as e:
         flash(f'Error deleting staff member: {str(e)}', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     return redirect(url_for('dashboard'))
 
 def create_admin_if_not_exists():
     """Create a default admin user if none exists"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM staff WHERE role = "admin"')
-        admin_count = cursor.fetchone()[0]
+        # An admin in any office counts; the default one goes in the home office
+        admin_count = sum(fan_out(
+            lambda cursor: cursor.execute('SELECT COUNT(*) FROM staff WHERE role = "admin"').fetchone()[0]
+        ).values())
         
         if admin_count == 0:
+            conn = get_db(app.config['HOME_OFFICE'])
+            cursor = conn.cursor()
+            
             # Use a simple default password: Admin@123
             default_password = 'Admin@123'
-            hashed_password = generate_password_hash(default_password, method='pbkdf2:sha256', salt_length=16)
+            hashed_password = hash_password(default_password)
             
             cursor.execute('''
                 INSERT INTO staff (name, email, password, role, created_at) 
                 VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
             ''', ('Admin User', 'admin@example.com', hashed_password, 'admin'))
+            cursor.execute("INSERT OR IGNORE INTO staff_emails (email) VALUES ('admin@example.com')")
             conn.commit()
             
-            print('\n' + '='*50)
-            print('ADMIN USER CREATED!')
-            print('='*50)
-            print('Email: admin@example.com')
-            print('Default Password: Admin@123')
-            print('IMPORTANT: Please change this password after logging in!')
-            print('='*50 + '\n')
+            logger.warning('Created default admin user admin@example.com with password Admin@123; '
+                           'change this password after logging in!')
         
-        conn.close()
     except sqlite3.Error as e:
-        print(f'Error creating admin user: {str(e)}')
+        logger.error(f'Error creating admin user: {str(e)}')
+        raise
+
+@app.cli.command('backfill-summary')
+@click.option('--start', help='First date to rebuild (YYYY-MM-DD)')
+@click.option('--end', help='Last date to rebuild (YYYY-MM-DD)')
+def backfill_summary_command(start, end):
+    """Rebuild daily_attendance_summary from the raw check-in logs"""
+    if bool(start) != bool(end):
+        raise click.UsageError('--start and --end must be given together')
+    
+    init_db()
+    rows = 0
+    for office in shard_databases():
+        conn = get_db(office)
+        rows += backfill_daily_summary(conn.cursor(), start, end)
+        conn.commit()
+    click.echo(f'Rebuilt {rows} daily summary rows')
+
+@app.cli.command('classify-locations')
+def classify_locations_command():
+    """Reclassify every location log after OFFICE_NETWORKS or VPN_NETWORKS change"""
+    init_db()
+    rows = 0
+    for office in shard_databases():
+        conn = get_db(office)
+        rows += classify_location_logs(conn.cursor())
+        conn.commit()
+    click.echo(f'Reclassified {rows} location logs')
+
+def move_staff(staff_id, office):
+    """Move a staff member and their history to another office's shard.
+
+    Their rows are copied with new ids from the target shard's range and
+    deleted from the source in the same transaction; sessions are not
+    copied, so they sign in again. In WAL mode the commit is atomic per
+    file only, so a crash mid-commit can leave a copy behind in the target.
+    Returns the new staff id.
+    """
+    source = shard_for_id(staff_id)
+    if source == office:
+        raise ValueError(f'Staff member {staff_id} is already in {office}')
+    # A plain connection reads and writes the raw stored values
+    conn = sqlite3.connect(shard_database(office), timeout=app.config['DB_BUSY_TIMEOUT'] / 1000)
+    try:
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute('ATTACH DATABASE ? AS source', (shard_database(source),))
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            INSERT INTO main.staff (name, email, password, role, created_at)
+            SELECT name, email, password, role, created_at FROM source.staff WHERE id = ?
+            RETURNING id
+        ''', (staff_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f'No staff member with id {staff_id}')
+        new_staff_id = row[0]
+
+        # Log ids are assigned up front so breaks and locations can follow them
+        cursor.execute('''
+            SELECT MAX(
+                (SELECT COALESCE(MAX(id), 0) FROM main.check_in_logs),
+                COALESCE((SELECT seq FROM main.sqlite_sequence WHERE name = 'check_in_logs'), 0)
+            )
+        ''')
+        next_log_id = cursor.fetchone()[0] + 1
+        cursor.execute('CREATE TEMP TABLE moved_logs (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)')
+        cursor.execute('''
+            INSERT INTO temp.moved_logs (old_id, new_id)
+            SELECT id, ? + ROW_NUMBER() OVER (ORDER BY id) - 1 FROM source.check_in_logs WHERE staff_id = ?
+        ''', (next_log_id, staff_id))
+        cursor.execute('''
+            INSERT INTO main.check_in_logs (
+                id, staff_id, check_in_time, check_out_time, date, is_late, late_reason, total_break_time
+            )
+            SELECT m.new_id, ?, l.check_in_time, l.check_out_time, l.date, l.is_late, l.late_reason, l.total_break_time
+            FROM source.check_in_logs l
+            JOIN temp.moved_logs m ON m.old_id = l.id
+        ''', (new_staff_id,))
+        cursor.execute('''
+            INSERT INTO main.break_logs (check_in_log_id, break_start, break_end, break_type)
+            SELECT m.new_id, b.break_start, b.break_end, b.break_type
+            FROM source.break_logs b
+            JOIN temp.moved_logs m ON m.old_id = b.check_in_log_id
+            ORDER BY b.id
+        ''')
+        cursor.execute('''
+            INSERT OR IGNORE INTO main.user_agents (user_agent, browser, os, device, is_mobile)
+            SELECT ua.user_agent, ua.browser, ua.os, ua.device, ua.is_mobile
+            FROM source.user_agents ua
+            WHERE ua.id IN (
+                SELECT loc.user_agent_id FROM source.location_logs loc
+                JOIN temp.moved_logs m ON m.old_id = loc.check_in_log_id
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO main.location_logs (check_in_log_id, ip_address, created_at, user_agent_id, site, network_type)
+            SELECT m.new_id, loc.ip_address, loc.created_at, target_ua.id, loc.site, loc.network_type
+            FROM source.location_logs loc
+            JOIN temp.moved_logs m ON m.old_id = loc.check_in_log_id
+            LEFT JOIN source.user_agents ua ON ua.id = loc.user_agent_id
+            LEFT JOIN main.user_agents target_ua ON target_ua.user_agent = ua.user_agent
+            ORDER BY loc.id
+        ''')
+        cursor.execute(SUMMARY_UPSERT.format(where='l.id IN (SELECT new_id FROM temp.moved_logs)'))
+        # Logs, breaks, locations, summary rows and sessions go by ON DELETE CASCADE
+        cursor.execute('DELETE FROM source.staff WHERE id = ?', (staff_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
         raise
+    finally:
+        conn.close()
+
+    today_cache.invalidate(staff_id)
+    if hasattr(app.session_interface, 'invalidate_user'):
+        app.session_interface.invalidate_user(staff_id)
+    return new_staff_id
+
+@app.cli.command('move-staff')
+@click.argument('office')
+@click.argument('emails', nargs=-1, required=True)
+def move_staff_command(office, emails):
+    """Move staff members, by email, and their history to OFFICE's shard"""
+    init_db()
+    if office not in shard_databases():
+        raise click.BadParameter(f"must be one of {', '.join(shard_databases())}", param_hint='OFFICE')
+    for email in emails:
+        user = next((row for row in fan_out(find_staff_by_email, email).values() if row), None)
+        if user is None:
+            click.echo(f'{email}: not found')
+            continue
+        try:
+            new_staff_id = move_staff(user['id'], office)
+        except ValueError as e:
+            click.echo(f'{email}: {e}')
+            continue
+        click.echo(f'{email}: moved to {office} as staff {new_staff_id}')
+
+# Tables written by archive-logs, one file per table per day. Timestamps
+# are read as raw epoch integers so no row goes through the datetime
+# converter; location created_at is CURRENT_TIMESTAMP text in UTC.
+ARCHIVE_TABLES = {
+    'check_in_logs': ("""
+        SELECT l.id, l.staff_id, s.name AS staff_name, s.email AS staff_email, s.role AS staff_role,
+               l.date, CAST(l.check_in_time AS INTEGER) AS check_in_time,
+               CAST(l.check_out_time AS INTEGER) AS check_out_time,
+               l.check_out_time - l.check_in_time AS worked_seconds,
+               l.is_late, l.late_reason, l.total_break_time
+        FROM check_in_logs l
+        JOIN staff s ON l.staff_id = s.id
+        WHERE l.date = ?
+        ORDER BY l.id
+    """, [('id', 'int'), ('staff_id', 'int'), ('staff_name', 'str'), ('staff_email', 'str'),
+          ('staff_role', 'str'), ('date', 'str'), ('check_in_time', 'ts'), ('check_out_time', 'ts'),
+          ('worked_seconds', 'int'), ('is_late', 'bool'), ('late_reason', 'str'), ('total_break_time', 'int')]),
+    'break_logs': ("""
+        SELECT b.id, b.check_in_log_id, l.staff_id, l.date,
+               CAST(b.break_start AS INTEGER) AS break_start, CAST(b.break_end AS INTEGER) AS break_end,
+               b.break_end - b.break_start AS duration_seconds, b.break_type
+        FROM break_logs b
+        JOIN check_in_logs l ON b.check_in_log_id = l.id
+        WHERE l.date = ?
+        ORDER BY b.id
+    """, [('id', 'int'), ('check_in_log_id', 'int'), ('staff_id', 'int'), ('date', 'str'),
+          ('break_start', 'ts'), ('break_end', 'ts'), ('duration_seconds', 'int'), ('break_type', 'str')]),
+    'location_logs': ("""
+        SELECT loc.id, loc.check_in_log_id, l.staff_id, l.date, loc.ip_address, ua.user_agent AS browser,
+               ua.is_mobile, loc.site, loc.network_type, CAST(strftime('%s', loc.created_at) AS INTEGER) AS created_at
+        FROM location_logs loc
+        JOIN check_in_logs l ON loc.check_in_log_id = l.id
+        LEFT JOIN user_agents ua ON loc.user_agent_id = ua.id
+        WHERE l.date = ?
+        ORDER BY loc.id
+    """, [('id', 'int'), ('check_in_log_id', 'int'), ('staff_id', 'int'), ('date', 'str'),
+          ('ip_address', 'str'), ('browser', 'str'), ('is_mobile', 'bool'), ('site', 'str'), ('network_type', 'str'),
+          ('created_at', 'ts_utc')]),
+}
+
+ARCHIVE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+def _arrow_type(kind):
+    return {
+        'int': pa.int64(),
+        'str': pa.string(),
+        'bool': pa.bool_(),
+        'ts': pa.timestamp('s'),
+        'ts_utc': pa.timestamp('s', tz='UTC'),
+    }[kind]
+
+def _archive_path(out_dir, table_name, day, fmt):
+    return os.path.join(out_dir, table_name, f'date={day}', f'part-0.{ARCHIVE_EXTENSIONS[fmt]}')
+
+def load_archive_manifest(out_dir):
+    """The archive's record of which days have been exported"""
+    try:
+        with open(os.path.join(out_dir, '_manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'format': None, 'last_date': None, 'days': {}}
+
+def _save_archive_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, '_manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def _write_archive_table(rows, columns, path, fmt):
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    arrays = []
+    for (name, kind), column in zip(columns, values):
+        if kind == 'bool':
+            column = [None if v is None else bool(v) for v in column]
+        arrays.append(pa.array(column, type=_arrow_type(kind)))
+    table = pa.Table.from_arrays(arrays, names=[name for name, _ in columns])
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    if fmt == 'parquet':
+        pq.write_table(table, tmp_path, compression='zstd')
+    else:
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def _archive_day_rows(cursor, day):
+    """{table: rows} of one day, as archive-logs writes them"""
+    return {table_name: [tuple(row) for row in cursor.execute(sql, (day,)).fetchall()]
+            for table_name, (sql, _) in ARCHIVE_TABLES.items()}
+
+def _archive_digest(day_rows):
+    """Fingerprint of a day's rows, to tell whether it changed since it was archived"""
+    return hashlib.sha256(json.dumps(day_rows, sort_keys=True, default=str).encode()).hexdigest()
+
+def _write_archive_day(day_rows, out_dir, day, fmt):
+    for table_name, rows in day_rows.items():
+        _write_archive_table(rows, ARCHIVE_TABLES[table_name][1], _archive_path(out_dir, table_name, day, fmt), fmt)
+    return {table_name: len(rows) for table_name, rows in day_rows.items()}
+
+def archive_logs(conn, out_dir, fmt='parquet', until=None):
+    """Export each day not yet in the archive, up to and including until.
+    
+    Days are written oldest first and recorded in the manifest as they
+    complete, so an interrupted run resumes where it stopped. Returns a list
+    of (day, {table: rows}).
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is required for archiving: pip install pyarrow')
+    if fmt not in ARCHIVE_EXTENSIONS:
+        raise ValueError(f'Unknown archive format: {fmt}')
+    
+    manifest = load_archive_manifest(out_dir)
+    if manifest['format'] not in (None, fmt):
+        raise ValueError(f"Archive in {out_dir} is {manifest['format']}, not {fmt}")
+    manifest['format'] = fmt
+    manifest.setdefault('digests', {})
+    until = until or (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT DISTINCT date FROM check_in_logs
+        WHERE date > ? AND date <= ?
+        ORDER BY date
+    ''', (manifest['last_date'] or '', until))
+    days = [row[0] for row in cursor.fetchall()]
+    
+    exported = []
+    for day in days:
+        day_rows = _archive_day_rows(cursor, day)
+        counts = _write_archive_day(day_rows, out_dir, day, fmt)
+        manifest['days'][day] = counts
+        manifest['digests'][day] = _archive_digest(day_rows)
+        manifest['last_date'] = day
+        _save_archive_manifest(out_dir, manifest)
+        exported.append((day, counts))
+    return exported
+
+def prune_archived_logs(conn, out_dir, before):
+    """Delete logs dated before `before` whose day is in the archive.
+    
+    Rows can land on a day after it was archived (backdated bulk uploads,
+    auto-close), so each day is re-read under a write lock first and
+    re-exported if it no longer matches what was archived. Break, location
+    and summary rows go with their check-in log through the foreign key
+    cascades. Returns the number of check-in logs deleted.
+    """
+    manifest = load_archive_manifest(out_dir)
+    fmt = manifest['format']
+    digests = manifest.setdefault('digests', {})
+    deleted = 0
+    for day in sorted(manifest['days']):
+        if day >= before:
+            continue
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            day_rows = _archive_day_rows(cursor, day)
+            digest = _archive_digest(day_rows)
+            if digest != digests.get(day) or not all(
+                os.path.exists(_archive_path(out_dir, table_name, day, fmt)) for table_name in ARCHIVE_TABLES
+            ):
+                manifest['days'][day] = _write_archive_day(day_rows, out_dir, day, fmt)
+                digests[day] = digest
+                _save_archive_manifest(out_dir, manifest)
+            deleted += cursor.execute('DELETE FROM check_in_logs WHERE date = ?', (day,)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return deleted
+
+@app.cli.command('archive-logs')
+@click.option('--out', 'out_dir', default=None, help='Archive directory (default: ARCHIVE_DIR)')
+@click.option('--format', 'fmt', type=click.Choice(sorted(ARCHIVE_EXTENSIONS)), default=None,
+              help='File format (default: ARCHIVE_FORMAT)')
+@click.option('--until', help='Last day to export, YYYY-MM-DD (default: yesterday)')
+@click.option('--prune', is_flag=True, help='Delete archived logs older than the retention window')
+@click.option('--retention-days', type=int, default=None, help='Days kept in SQLite (default: ARCHIVE_RETENTION_DAYS)')
+@click.option('--vacuum', is_flag=True, help='VACUUM after pruning to shrink the database file')
+def archive_logs_command(out_dir, fmt, until, prune, retention_days, vacuum):
+    """Export new days of check-in, break and location logs to Parquet/Arrow.
+    
+    Other offices' shards are archived to a subdirectory named after the office.
+    """
+    if pa is None:
+        raise click.ClickException('pyarrow is required for archiving: pip install pyarrow')
+    root_dir = out_dir or app.config['ARCHIVE_DIR']
+    fmt = fmt or app.config['ARCHIVE_FORMAT']
+    
+    init_db()
+    for office in shard_databases():
+        out_dir = root_dir if office == app.config['HOME_OFFICE'] else os.path.join(root_dir, office)
+        conn = get_db(office)
+        try:
+            exported = archive_logs(conn, out_dir, fmt, until)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        for day, counts in exported:
+            click.echo(f"{day}: " + ', '.join(f'{rows} {table_name}' for table_name, rows in counts.items()))
+        click.echo(f'Archived {len(exported)} days to {out_dir}')
+        
+        if prune:
+            retention_days = retention_days if retention_days is not None else app.config['ARCHIVE_RETENTION_DAYS']
+            before = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+            deleted = prune_archived_logs(conn, out_dir, before)
+            click.echo(f'Pruned {deleted} check-in logs dated before {before}')
+            if vacuum and deleted:
+                conn.execute('VACUUM')
+                click.echo('Vacuumed database')
+
+@app.cli.command('run-jobs')
+@click.argument('names', nargs=-1, type=click.Choice(list(SCHEDULED_JOBS)))
+@click.option('--force', is_flag=True, help='Run the named jobs even if they are not due')
+def run_jobs_command(names, force):
+    """Run due background jobs now, under the same lease as the workers"""
+    init_db()
+    results = make_scheduler(get_pool()).run_pending(jobs=names or None, force=force)
+    if results is None:
+        raise click.ClickException('Another worker holds the scheduler lease')
+    for name, run in results.items():
+        click.echo(f"{name}: {run['status']} in {run['duration_ms']:.0f}ms {run['error'] or run['result']}")
+    if not results:
+        click.echo('No jobs due')
+
+EXPORT_CHUNK_ROWS = 500  # CSV rows per streamed chunk
+
+def format_export_row(log):
+    """Turn a check-in log row into a CSV row for export_report.
+    
+    Times and the duration arrive pre-formatted from the export query.
+    """
+    if log['check_in_at'] and log['check_out_at']:
+        status_str = "Completed"
+    elif log['check_in_at']:
+        status_str = "Checked In"
+    else:
+        status_str = "In Progress"
+    
+    return [
+        log['name'],
+        log['check_in_at'] or "N/A",
+        log['check_out_at'] or "N/A",
+        log['duration'] or "N/A",
+        status_str,
+        "Yes" if log['is_late'] else "No",
+        log['total_break_time'] or 0,
+        log['date']
+    ]
+
+class _CSVLine:
+    """File-like sink so csv.writer returns each line instead of buffering it"""
+    def write(self, value):
+        return value
 
 @app.route('/export_report')
 def export_report():
-    """Export report to CSV with error handling (admin only)"""
+    """Stream a CSV report for a date range (admin only).
+    
+    Accepts start, end and staff_id query parameters; date is still
+    accepted as a single-day shorthand.
+    """
     if 'user_id' not in session or session['user_role'] != 'admin':
         flash('You do not have permission to access this page.', 'danger')
         return redirect(url_for('dashboard'))
     
-    selected_date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+    start_str = request.args.get('start') or request.args.get('date') or datetime.now().strftime('%Y-%m-%d')
+    end_str = request.args.get('end') or start_str
+    staff_id = request.args.get('staff_id', type=int)
     try:
-        selected_date_obj = datetime.strptime(selected_date_str, '%Y-%m-%d')
+        start_date = datetime.strptime(start_str, '%Y-%m-%d')
+        end_date = datetime.strptime(end_str, '%Y-%m-%d')
     except ValueError:
         flash('Invalid date format. Please use YYYY-MM-DD.', 'danger')
         return redirect(url_for('reports'))
     
+    if end_date < start_date:
+        flash('End date must not be before start date.', 'danger')
+        return redirect(url_for('reports', date=start_str))
+    # Dates compare as text in SQL, so 2024-3-5 must become 2024-03-05
+    start_str, end_str = start_date.date().isoformat(), end_date.date().isoformat()
+    
+    where = 'l.date BETWEEN ? AND ?'
+    params = [start_str, end_str]
+    if staff_id is not None:
+        where += ' AND l.staff_id = ?'
+        params.append(staff_id)
+    
+    # A staff member's logs are all in their office's shard
+    offices = [shard_for_id(staff_id)] if staff_id is not None else list(shard_databases())
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                s.name,
-                l.check_in_time,
-                l.check_out_time,
-                l.date,
-                l.is_late,
-                l.late_reason,
-                l.total_break_time
-            FROM check_in_logs l
-            JOIN staff s ON l.staff_id = s.id
-            WHERE l.date = ?
-            ORDER BY l.check_in_time
-        ''', (selected_date_str,))
-        
-        logs = cursor.fetchall()
-        
-        if not logs:
-            flash(f'No data to export for {selected_date_str}.', 'info')
-            return redirect(url_for('reports', date=selected_date_str))
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        output.write('Staff Name,Check-In Time,Check-Out Time,Duration,Status,Late,Break Time (min),Date\n')
-        
-        for log in logs:
-            # Safely parse check-in time
-            try:
-                check_in_time = datetime.strptime(log['check_in_time'], '%Y-%m-%d %H:%M:%S.%f') if log['check_in_time'] and '.' in log['check_in_time'] else \
-                               datetime.strptime(log['check_in_time'], '%Y-%m-%d %H:%M:%S') if log['check_in_time'] else None
-            except (ValueError, TypeError):
-                check_in_time = None
-            
-            # Safely parse check-out time
-            try:
-                check_out_time = datetime.strptime(log['check_out_time'], '%Y-%m-%d %H:%M:%S.%f') if log['check_out_time'] and '.' in log['check_out_time'] else \
-                                datetime.strptime(log['check_out_time'], '%Y-%m-%d %H:%M:%S') if log['check_out_time'] else None
-            except (ValueError, TypeError):
-                check_out_time = None
-            
-            # Calculate duration and status
-            duration_str = "N/A"
-            status_str = "In Progress"
+        data_as_of = report_data_as_of(offices)
+        cursors = []
+        for office in offices:
+            cursor = get_report_db(office).cursor()
+            cursor.execute(f'SELECT 1 FROM check_in_logs l WHERE {where} LIMIT 1', params)
+            if not cursor.fetchone():
+                continue
             
-            if check_in_time and check_out_time:
-                duration = check_out_time - check_in_time
-                hours, remainder = divmod(duration.total_seconds(), 3600)
-                minutes, seconds = divmod(remainder, 60)
-                duration_str = f"{int(hours)}h {int(minutes)}m"
-                status_str = "Completed"
-            elif check_in_time:
-                status_str = "Checked In"
-            
-            # Format times for CSV
-            check_in_str = check_in_time.strftime("%H:%M:%S") if check_in_time else "N/A"
-            check_out_str = check_out_time.strftime("%H:%M:%S") if check_out_time else "N/A"
-            
-            # Write row to CSV
-            output.write(f'{log["name"]},{check_in_str},{check_out_str},{duration_str},'
-                       f'{status_str},{"Yes" if log["is_late"] else "No"},'
-                       f'{log["total_break_time"] or 0},{log["date"]}\n')
-        
-        output.seek(0)
-        return send_file(
-            io.BytesIO(output.getvalue().encode()),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'check_in_report_{selected_date_str}.csv'
-        )
+            # Rows are read lazily from the cursor while the response streams, so
+            # memory use does not grow with the size of the range
+            cursor.execute(f'''
+                SELECT 
+                    s.name,
+                    strftime('%H:%M:%S', l.check_in_time, 'unixepoch') as check_in_at,
+                    strftime('%H:%M:%S', l.check_out_time, 'unixepoch') as check_out_at,
+                    CASE WHEN l.check_out_time IS NOT NULL
+                         THEN printf('%dh %dm', (l.check_out_time - l.check_in_time) / 3600,
+                                     (l.check_out_time - l.check_in_time) % 3600 / 60)
+                         END as duration,
+                    l.date,
+                    l.check_in_time,
+                    l.is_late,
+                    l.late_reason,
+                    l.total_break_time
+                FROM check_in_logs l
+                JOIN staff s ON l.staff_id = s.id
+                WHERE {where}
+                ORDER BY l.date, l.check_in_time
+            ''', params)
+            cursors.append(cursor)
+        
+        if not cursors:
+            period = start_str if start_str == end_str else f'{start_str} to {end_str}'
+            flash(f'No data to export for {period}.', 'info')
+            return redirect(url_for('reports', date=start_str))
         
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
-        return redirect(url_for('reports', date=selected_date_str))
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return redirect(url_for('reports', date=start_str))
+    
+    # Each shard's rows are already in order, so they are merged as they stream
+    if len(cursors) == 1:
+        logs = cursors[0]
+    else:
+        logs = heapq.merge(*cursors, key=lambda row: (row['date'], row['check_in_time'] or EPOCH))
+    
+    def generate():
+        writer = csv.writer(_CSVLine())
+        chunk = [writer.writerow(['Staff Name', 'Check-In Time', 'Check-Out Time', 'Duration',
+                                  'Status', 'Late', 'Break Time (min)', 'Date'])]
+        while True:
+            rows = list(islice(logs, EXPORT_CHUNK_ROWS))
+            if not rows:
+                break
+            chunk.extend(writer.writerow(format_export_row(log)) for log in rows)
+            yield ''.join(chunk)
+            chunk = []
+        if chunk:
+            yield ''.join(chunk)
+    
+    filename = f'check_in_report_{start_str}.csv' if start_str == end_str else f'check_in_report_{start_str}_to_{end_str}.csv'
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    if data_as_of:
+        response.last_modified = data_as_of.astimezone(timezone.utc)
+    return response
 
 @app.route('/mobile_check_in')
 def mobile_check_in():
@@ -989,50 +4848,26 @@ def mobile_check_in():
     today = datetime.now().strftime('%Y-%m-%d')
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
         # Get today's check-in status
-        cursor.execute('''
-            SELECT 
-                l.id,
-                l.staff_id,
-                l.check_in_time,
-                l.check_out_time,
-                l.is_late,
-                l.late_reason,
-                l.total_break_time
-            FROM check_in_logs l 
-            WHERE l.staff_id = ? AND l.date = ?
-        ''', (user_id, today))
-        log = cursor.fetchone()
+        log = get_today_status(user_id, today)
         
         # Get current break status if checked in
         active_break = None
-        if log:
-            cursor.execute('''
-                SELECT 
-                    break_start,
-                    break_type,
-                    ROUND((strftime('%s', 'now') - strftime('%s', break_start)) / 60.0) as duration
-                FROM break_logs 
-                WHERE check_in_log_id = ? AND break_end IS NULL
-            ''', (log['id'],))
-            active_break = cursor.fetchone()
+        if log and log['active_break']:
+            active_break = dict(log['active_break'])
+            active_break['duration'] = round((datetime.now() - active_break['break_start']).total_seconds() / 60)
         
     except sqlite3.Error as e:
         logger.error(f'Database error: {str(e)}')
         flash('An error occurred. Please try again.', 'error')
         return redirect(url_for('dashboard'))
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
     return render_template('mobile_check_in.html',
                          user_name=user_name,
                          log=log,
                          today=today,
-                         active_break=active_break)
+                         active_break=active_break,
+                         state=today_state(log))
 
 @app.route('/start_break', methods=['POST'])
 def start_break():
@@ -1043,51 +4878,23 @@ def start_break():
     staff_id = session['user_id']
     break_type = request.form.get('break_type', 'regular')
     now = datetime.now()
-    today = now.strftime('%Y-%m-%d')
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get today's check-in log
-        cursor.execute('''
-            SELECT id FROM check_in_logs 
-            WHERE staff_id = ? AND date = ?
-        ''', (staff_id, today))
-        check_in_log = cursor.fetchone()
+        result = apply_write(record_break_start, staff_id, now, break_type)
         
-        if not check_in_log:
+        if result['status'] == 'not_checked_in':
             flash('You need to check in first! 😊', 'warning')
             return redirect(url_for('dashboard'))
         
-        # Check for active break
-        cursor.execute('''
-            SELECT id FROM break_logs 
-            WHERE check_in_log_id = ? AND break_end IS NULL
-        ''', (check_in_log['id'],))
-        active_break = cursor.fetchone()
-        
-        if active_break:
+        if result['status'] == 'active_break':
             flash('You already have an active break! ⏸️', 'warning')
         else:
-            cursor.execute('''
-                INSERT INTO break_logs (check_in_log_id, break_start, break_type)
-                VALUES (?, ?, ?)
-            ''', (check_in_log['id'], now, break_type))
-            conn.commit()
             flash('Break started! Take your time 🌟', 'success')
         
     except sqlite3.Error as e:
         flash(f'Database error: {str(e)}', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
-    
-    # Detect device type
-    user_agent = request.headers.get('User-Agent', '').lower()
-    is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
     
-    return redirect(url_for('mobile_check_in' if is_mobile else 'dashboard'))
+    return redirect(url_for('mobile_check_in' if get_client_info()['is_mobile'] else 'dashboard'))
 
 @app.route('/end_break', methods=['POST'])
 def end_break():
@@ -1097,53 +4904,16 @@ def end_break():
     
     staff_id = session['user_id']
     now = datetime.now()
-    today = now.strftime('%Y-%m-%d')
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get check-in record
-        cursor.execute('''
-            SELECT id FROM check_in_logs 
-            WHERE staff_id = ? AND date = ?
-        ''', (staff_id, today))
-        check_in_log = cursor.fetchone()
+        result = apply_write(record_break_end, staff_id, now)
         
-        if check_in_log:
-            # Find active break
-            cursor.execute('''
-                SELECT id, break_start, break_type FROM break_logs 
-                WHERE check_in_log_id = ? AND break_end IS NULL
-            ''', (check_in_log['id'],))
-            active_break = cursor.fetchone()
-            
-            if active_break:
-                # Calculate break duration - break_start is now a datetime object
-                break_start = active_break['break_start']
-                break_duration = int((now - break_start).total_seconds() / 60)
-                
-                # Update break log
-                cursor.execute('''
-                    UPDATE break_logs 
-                    SET break_end = ? 
-                    WHERE id = ?
-                ''', (now, active_break['id']))
-                
-                # Update total break time
-                cursor.execute('''
-                    UPDATE check_in_logs 
-                    SET total_break_time = total_break_time + ?
-                    WHERE id = ?
-                ''', (break_duration, check_in_log['id']))
-                
-                conn.commit()
-                
-                # Get break type for message
-                break_type = active_break['break_type'].capitalize()
-                flash(f'{break_type} break ended! Duration: {break_duration} minutes ⏰', 'success')
-            else:
-                flash('No active break found! 🤔', 'warning')
+        if result['status'] == 'ok':
+            # Get break type for message
+            break_type = result['break_type'].capitalize()
+            flash(f'{break_type} break ended! Duration: {result["duration"]} minutes ⏰', 'success')
+        elif result['status'] == 'no_active_break':
+            flash('No active break found! 🤔', 'warning')
         else:
             flash('No check-in record found for today! 📝', 'warning')
         
@@ -1152,74 +4922,110 @@ def end_break():
     except Exception as e:
         logger.error(f"Error ending break: {str(e)}")
         flash('An error occurred while ending the break', 'error')
-    finally:
-        if 'conn' in locals():
-            conn.close()
     
-    # Detect device type
-    user_agent = request.headers.get('User-Agent', '').lower()
-    is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
+    return redirect(url_for('mobile_check_in' if get_client_info()['is_mobile'] else 'dashboard'))
+
+def location_history_for(cursor, date, network=None, site=None):
+    """A shard's (site counts, location logs) for a day, each in display order"""
+    cursor.execute('''
+        SELECT loc.network_type, loc.site, COUNT(*) AS check_ins
+        FROM check_in_logs l
+        JOIN location_logs loc ON loc.check_in_log_id = l.id
+        WHERE l.date = ?
+        GROUP BY loc.network_type, loc.site
+        ORDER BY loc.network_type, loc.site
+    ''', (date,))
+    site_counts = cursor.fetchall()
     
-    return redirect(url_for('mobile_check_in' if is_mobile else 'dashboard'))
+    cursor.execute('''
+        SELECT 
+            s.name,
+            l.check_in_time,
+            loc.ip_address,
+            ua.user_agent,
+            ua.is_mobile,
+            loc.created_at,
+            loc.site,
+            loc.network_type
+        FROM location_logs loc
+        JOIN check_in_logs l ON loc.check_in_log_id = l.id
+        JOIN staff s ON l.staff_id = s.id
+        LEFT JOIN user_agents ua ON loc.user_agent_id = ua.id
+        WHERE l.date = ?
+          AND (? IS NULL OR loc.network_type = ?)
+          AND (? IS NULL OR loc.site = ?)
+        ORDER BY l.check_in_time DESC
+    ''', (date, network, network, site, site))
+    return site_counts, cursor.fetchall()
+
+def _nulls_first(value):
+    return (value is not None, value or '')
 
 @app.route('/location_history')
 def location_history():
-    """View location history with error handling (admin only)"""
+    """View location history with error handling (admin only).
+    
+    Optional network (onsite, vpn or remote) and site query parameters
+    narrow the list; the per-site counts always cover the whole day.
+    Every office's reporting replica is queried in parallel and the results merged.
+    """
     if 'user_id' not in session or session['user_role'] != 'admin':
         flash('Unauthorized access', 'error')
         return redirect(url_for('dashboard'))
     
+    data_as_of = None
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
         # Get date filter from query params
         date_filter = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+        network_filter = request.args.get('network') if request.args.get('network') in NETWORK_TYPES else None
+        site_filter = request.args.get('site') or None
         
-        # Get all location logs for the selected date with simplified structure
-        cursor.execute('''
-            SELECT 
-                s.name,
-                l.check_in_time,
-                loc.ip_address,
-                loc.browser,
-                loc.is_mobile,
-                loc.created_at
-            FROM location_logs loc
-            JOIN check_in_logs l ON loc.check_in_log_id = l.id
-            JOIN staff s ON l.staff_id = s.id
-            WHERE l.date = ?
-            ORDER BY l.check_in_time DESC
-        ''', (date_filter,))
+        data_as_of = report_data_as_of()
+        results = fan_out(location_history_for, date_filter, network_filter, site_filter, replica=True)
+        
+        # The same site can appear in several shards' counts
+        totals = {}
+        for shard_counts, _ in results.values():
+            for row in shard_counts:
+                key = (row['network_type'], row['site'])
+                totals[key] = totals.get(key, 0) + row['check_ins']
+        site_counts = [
+            {'network_type': network_type, 'site': site, 'check_ins': check_ins}
+            for (network_type, site), check_ins in sorted(
+                totals.items(), key=lambda item: (_nulls_first(item[0][0]), _nulls_first(item[0][1])))
+        ]
         
         # Convert datetime objects to strings
         location_logs = []
-        for row in cursor.fetchall():
+        for row in merge_sorted({office: logs for office, (_, logs) in results.items()},
+                                key=lambda row: row[1] or EPOCH, reverse=True):
             location_logs.append({
                 'name': row[0],
                 'check_in_time': row[1].strftime('%Y-%m-%d %H:%M:%S') if row[1] else 'N/A',
                 'ip_address': row[2],
                 'browser': row[3],
                 'is_mobile': row[4],
-                'created_at': row[5].strftime('%Y-%m-%d %H:%M:%S') if row[5] else 'N/A'
+                'created_at': row[5].strftime('%Y-%m-%d %H:%M:%S') if row[5] else 'N/A',
+                'site': row[6],
+                'network_type': row[7]
             })
         
     except sqlite3.Error as e:
         logger.error(f'Database error in location_history: {str(e)}')
         flash(f'Database error: {str(e)}', 'error')
-        location_logs = []
+        location_logs, site_counts = [], []
     except Exception as e:
-        logger.error(f'Unexpected error in location_history: {str(e)}')
-        logger.error(traceback.format_exc())
+        logger.exception(f'Unexpected error in location_history: {str(e)}')
         flash('An unexpected error occurred', 'error')
-        location_logs = []
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        location_logs, site_counts = [], []
     
     return render_template('location_history.html', 
                          logs=location_logs, 
-                         selected_date=date_filter)
+                         site_counts=site_counts,
+                         selected_date=date_filter,
+                         selected_network=network_filter,
+                         selected_site=site_filter,
+                         data_as_of=data_as_of)
 
 @app.route('/change_password', methods=['GET', 'POST'])
 def change_password():
@@ -1244,12 +5050,12 @@ def change_password():
             cursor.execute('SELECT password FROM staff WHERE id = ?', (session['user_id'],))
             current_hash = cursor.fetchone()['password']
             
-            if not check_password_hash(current_hash, current_password):
+            if not verify_password(current_hash, current_password):
                 flash('Current password is incorrect', 'danger')
                 return redirect(url_for('change_password'))
             
             # Update password
-            new_hash = generate_password_hash(new_password, method='pbkdf2:sha256')
+            new_hash = hash_password(new_password)
             cursor.execute('''
                 UPDATE staff 
                 SET password = ? 
@@ -1260,14 +5066,207 @@ def change_password():
             flash('Password updated successfully! 🔐', 'success')
             return redirect(url_for('dashboard'))
         
+        except PasswordHasherBusy:
+            flash('The server is busy right now. Please try again in a moment.', 'warning')
         except sqlite3.Error as e:
             flash(f'Database error: {str(e)}', 'danger')
-        finally:
-            if 'conn' in locals():
-                conn.close()
     
     return render_template('change_password.html')
 
+def today_state(status):
+    """Collapse a today status into the state that decides which page controls show"""
+    if status is None:
+        return 'not_checked_in'
+    if status['check_out_time']:
+        return 'checked_out'
+    if status['active_break']:
+        return 'on_break'
+    return 'checked_in'
+
+def status_payload(conn, user_id, is_admin, today):
+    """The /api/status document for a user (shared with the ASGI entry point)"""
+    status = get_today_status(user_id, today, conn)
+    active_break = status['active_break'] if status else None
+    payload = {
+        'date': today,
+        'state': today_state(status),
+        'check_in_time': status['check_in_time'].isoformat() if status and status['check_in_time'] else None,
+        'check_out_time': status['check_out_time'].isoformat() if status and status['check_out_time'] else None,
+        'is_late': status['is_late'] if status else False,
+        'total_break_time': status['total_break_time'] if status else 0,
+        'active_break': {
+            'break_type': active_break['break_type'],
+            'break_start': active_break['break_start'].isoformat()
+        } if active_break else None
+    }
+    
+    if is_admin:
+        payload['late_check_ins'] = [
+            {'name': row['name'], 'check_in_time': row['check_in_time'].strftime('%H:%M')}
+            for row in all_late_check_ins_today(today, conn)
+        ]
+    return payload
+
+@app.route('/api/status')
+def api_status():
+    """Today's check-in status as JSON, with ETag/If-None-Match support"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    today = datetime.now().strftime('%Y-%m-%d')
+    try:
+        payload = status_payload(get_db(), session['user_id'], session['user_role'] == 'admin', today)
+    except sqlite3.Error as e:
+        logger.error(f'Database error in api_status: {str(e)}')
+        return jsonify({'error': 'Database error'}), 500
+    
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/events')
+def api_events():
+    """Server-Sent Events stream of check-in, break and check-out changes.
+    
+    Staff only receive their own events; admins receive everyone's.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    user_id = session['user_id']
+    is_admin = session['user_role'] == 'admin'
+    subscription = event_broker.subscribe(request.headers.get('Last-Event-ID', type=int))
+    keepalive = app.config['SSE_KEEPALIVE']
+    
+    def stream():
+        try:
+            yield f"retry: {app.config['SSE_RETRY_MS']}\n\n"
+            while True:
+                try:
+                    event_id, event_type, data = subscription.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if is_admin or data['staff_id'] == user_id:
+                    yield f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n'
+        finally:
+            event_broker.unsubscribe(subscription)
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/bulk_events', methods=['POST'])
+def bulk_events():
+    """Apply a batch of check-in, check-out and break events (admin only).
+    
+    Accepts a JSON array (or {"events": [...]}) sent as application/json, or
+    NDJSON with one event per line sent as application/x-ndjson, e.g.
+    {"type": "check_in", "staff_id": 7, "timestamp": "2024-03-04T08:55:00"}.
+    """
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    ndjson = request.mimetype in ('application/x-ndjson', 'application/jsonl')
+    if not ndjson and request.mimetype != 'application/json':
+        return jsonify({'error': 'Content-Type must be application/json or application/x-ndjson'}), 415
+    
+    body = request.get_data(as_text=True)
+    try:
+        if ndjson:
+            events = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            events = json.loads(body)
+            if isinstance(events, dict):
+                events = events.get('events')
+    except ValueError as e:
+        return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
+    
+    if not isinstance(events, list) or not events:
+        return jsonify({'error': 'Expected a non-empty list of events'}), 400
+    if len(events) > app.config['BULK_EVENTS_MAX']:
+        return jsonify({'error': f"At most {app.config['BULK_EVENTS_MAX']} events per request"}), 413
+    
+    try:
+        results = apply_sharded_bulk_events(events, get_client_info())
+    except sqlite3.Error as e:
+        logger.error(f'Database error in bulk_events: {str(e)}')
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+    
+    applied = sum(1 for result in results if result['status'] == 'ok')
+    return jsonify({
+        'applied': applied,
+        'rejected': len(results) - applied,
+        'results': results
+    })
+
+@app.route('/pool_stats')
+def pool_stats():
+    """Database connection pool statistics (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+
+    stats = get_pool().stats()
+    if len(shard_databases()) > 1:
+        stats['shards'] = {office: pool.stats() for office, pool in shard_pools().items()}
+    if app.config['REPORT_REPLICA']:
+        stats['report_replicas'] = {
+            office: get_report_replica(database).stats() for office, (_, database) in shard_databases().items()
+        }
+    return jsonify(stats)
+
+@app.route('/hasher_stats')
+def hasher_stats():
+    """Password hasher admission counters (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+
+    return jsonify(get_password_hasher().stats())
+
+@app.route('/metrics')
+def metrics():
+    """Per-route request, SQL and template metrics in Prometheus text format (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Today-status and fragment cache hit/miss counters (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    return jsonify({**today_cache.stats(), 'fragments': fragment_cache.stats(), 'user_agents': user_agent_cache.stats()})
+
+@app.route('/session_stats')
+def session_stats():
+    """Server-side session cache counters (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+    if not hasattr(app.session_interface, 'stats'):
+        return jsonify({'backend': 'cookie'})
+    
+    return jsonify(app.session_interface.stats())
+
+@app.route('/scheduler_stats')
+def scheduler_stats():
+    """Scheduler lease holder and job run history (admin only)"""
+    if 'user_id' not in session or session['user_role'] != 'admin':
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    cursor = get_db(app.config['HOME_OFFICE']).cursor()
+    cursor.execute('SELECT owner, expires_at FROM scheduler_lease WHERE name = ?', (Scheduler.LEASE,))
+    lease = cursor.fetchone()
+    cursor.execute('SELECT * FROM scheduler_jobs ORDER BY name')
+    return jsonify({
+        'worker': _scheduler.owner if _scheduler is not None else None,
+        'lease': dict(lease) if lease else None,
+        'jobs': [dict(row) for row in cursor.fetchall()],
+    })
+
 @app.route('/favicon.ico')
 def favicon():
     try:
@@ -1277,7 +5276,7 @@ def favicon():
             mimetype='text/html'
         )
     except Exception as e:
-        print(f"Error serving favicon: {str(e)}")
+        logger.warning(f"Error serving favicon: {str(e)}")
         return '', 204  # Return empty response if favicon not found
 
 # Ensure templates directory is properly set
@@ -1291,15 +5290,13 @@ def not_found_error(error):
 
 @app.errorhandler(500)
 def internal_error(error):
-    logger.error(f"500 Error: {error}")
-    # Log the full traceback
-    logger.error(traceback.format_exc())
+    # The traceback is formatted on the log writer thread
+    logger.error(f"500 Error: {error}", exc_info=getattr(error, 'original_exception', None) or error)
     return render_template('500.html'), 500
 
 @app.errorhandler(Exception)
 def handle_exception(error):
-    logger.error(f"Unhandled Exception: {error}")
-    logger.error(traceback.format_exc())
+    logger.error(f"Unhandled Exception: {error}", exc_info=error)
     return render_template('500.html'), 500
 
 if __name__ == '__main__':
@@ -1309,8 +5306,10 @@ if __name__ == '__main__':
             init_db()
             create_admin_if_not_exists()
     except Exception as e:
-        print(f"Startup error: {str(e)}")
+        logger.error(f"Startup error: {str(e)}")
+        log_pipeline.stop()
         exit(1)
     
-    # Run the app with default Flask development server
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    # Run the app with default Flask development server; FLASK_DEBUG=1 turns on the
+    # reloader and interactive debugger, which must never face a network
+    app.run(host='0.0.0.0', port=8080, debug=os.environ.get('FLASK_DEBUG', '') in ('1', 'true'))
\ No newline at end of file
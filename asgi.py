@@ -0,0 +1,351 @@
+"""ASGI entry point, for deployments holding many live-update connections.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8080 --workers 4
+
+The live-update endpoints (/api/events and /api/status) are served natively
+on the event loop, so an idle EventSource costs a coroutine instead of a
+worker thread. Their SQLite work goes through AsyncDatabase, one dedicated
+thread per worker that the loop awaits. Every other route (check-in,
+breaks, reports, export, ...) runs the unchanged Flask app in a bounded
+thread pool, with its writes funnelled through the ingestion writer thread.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Thread
+
+from app import app, event_broker, get_pool, logger, shard_for_id, status_payload
+
+# Writes from the threaded Flask routes share one writer thread
+app.config['INGEST_BATCHING'] = True
+
+class AsyncDatabase:
+    """Awaitable SQLite access through one dedicated thread.
+
+    The thread owns a pooled connection per office's shard; ``await
+    db.run(fn, *args, office=...)`` calls fn(conn, *args) there with that
+    office's connection (default: the home office) and resumes the coroutine
+    with the result, so the event loop never blocks on SQLite.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._jobs = queue.Queue()
+        self._thread = Thread(target=self._run, name='async-db', daemon=True)
+        self._thread.start()
+
+    async def run(self, fn, *args, office=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._jobs.put((fn, args, office, loop, future))
+        return await future
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql, params=()):
+        """Run a write and commit it, returning the row count"""
+        def write(conn):
+            try:
+                count = conn.execute(sql, params).rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return count
+        return await self.run(write)
+
+    def close(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        connections = {None: (self.pool, self.pool.acquire())}
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                fn, args, office, loop, future = job
+                try:
+                    if office not in connections:
+                        pool = get_pool(office)
+                        connections[office] = (pool, pool.acquire())
+                    result, error = fn(connections[office][1], *args), None
+                except Exception as e:
+                    result, error = None, e
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+        finally:
+            for pool, conn in connections.values():
+                pool.release(conn)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+class AsyncSubscriber:
+    """EventBroker subscriber that hands events to a coroutine"""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, event):
+        # Called from whichever thread published; full means the client is
+        # too slow and, as with the WSGI stream, misses the event
+        if self.queue.full():
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        elif f'HTTP_{name}' in environ:
+            environ[f'HTTP_{name}'] += f',{value}'
+        else:
+            environ[f'HTTP_{name}'] = value
+    return environ
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+class WSGIBridge:
+    """Runs a WSGI app in a thread pool and streams its response.
+
+    Response chunks pass through a small queue, so a slow client holds back
+    the producing thread (backpressure) rather than buffering the whole
+    body, and a client that disconnects stops the iteration.
+    """
+
+    def __init__(self, wsgi_app, max_threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = await read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue(maxsize=8)
+        stopped = threading.Event()
+
+        def put(message):
+            if stopped.is_set():
+                raise ConnectionAbortedError
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        def run():
+            response = {}
+            def start_response(status, headers, exc_info=None):
+                response['status'] = int(status.split(' ', 1)[0])
+                response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            try:
+                result = self.wsgi_app(build_environ(scope, body), start_response)
+                try:
+                    put({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                    for chunk in result:
+                        if chunk:
+                            put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except ConnectionAbortedError:
+                pass
+            except Exception as e:
+                logger.error(f"WSGI bridge error: {str(e)}")
+                if not stopped.is_set():
+                    put(e)
+
+        worker = loop.run_in_executor(self.executor, run)
+        started = False
+        try:
+            while True:
+                message = await messages.get()
+                if isinstance(message, Exception):
+                    # Once the headers are out the status can't change; end the body instead
+                    if not started:
+                        await send({'type': 'http.response.start', 'status': 500, 'headers': []})
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    break
+                await send(message)
+                started = started or message['type'] == 'http.response.start'
+                if message['type'] == 'http.response.body' and not message['more_body']:
+                    break
+        finally:
+            stopped.set()
+            # Unblock a producer waiting on the full queue
+            while not messages.empty():
+                messages.get_nowait()
+            await worker
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+class CheckInASGI:
+    """The ASGI application: native live-update routes, Flask for the rest"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.bridge = WSGIBridge(flask_app.wsgi_app, flask_app.config['ASGI_THREADS'])
+        self.db = None
+        self.routes = {
+            ('GET', '/api/status'): self.api_status,
+            ('GET', '/api/events'): self.api_events,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.db is None or self.db.pool is not get_pool():
+            self.db = AsyncDatabase(get_pool())
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            return await self.bridge(scope, receive, send)
+        return await handler(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.db = AsyncDatabase(get_pool())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.db is not None:
+                    self.db.close()
+                self.bridge.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def current_user(self, scope):
+        """(user_id, role) from the request's session, or None"""
+        def load(conn):
+            request = self.flask_app.request_class(build_environ(scope, b''))
+            session = self.flask_app.session_interface.open_session(self.flask_app, request)
+            if session is None or 'user_id' not in session:
+                return None
+            return session['user_id'], session.get('user_role')
+        return await self.db.run(load)
+
+    async def api_status(self, scope, receive, send):
+        """Same document and ETag as the Flask /api/status view"""
+        user = await self.current_user(scope)
+        if user is None:
+            return await send_json(send, 401, {'error': 'Not logged in'})
+        today = datetime.now().strftime('%Y-%m-%d')
+        payload = await self.db.run(status_payload, user[0], user[1] == 'admin', today, office=shard_for_id(user[0]))
+        # Serialise as jsonify does so both entry points agree on the ETag
+        body = self.flask_app.json.response(payload).get_data()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'.encode()
+        cache_headers = [(b'etag', etag), (b'cache-control', b'private, no-cache')]
+        if_none_match = dict(scope['headers']).get(b'if-none-match', b'')
+        if etag in [tag.strip() for tag in if_none_match.split(b',')]:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': cache_headers})
+            return await send({'type': 'http.response.body', 'body': b''})
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *cache_headers,
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def api_events(self, scope, receive, send):
+        """Server-Sent Events on the event loop; see app.api_events"""
+        user = await self.current_user(scope)
+        if user is None:
+            return await send_json(send, 401, {'error': 'Not logged in'})
+        user_id, is_admin = user[0], user[1] == 'admin'
+        last_event_id = dict(scope['headers']).get(b'last-event-id', b'')
+
+        subscriber = AsyncSubscriber(asyncio.get_running_loop(), event_broker.max_queue)
+        event_broker.subscribe(int(last_event_id) if last_event_id.isdigit() else None, subscriber)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({'type': 'http.response.body', 'more_body': True,
+                        'body': f"retry: {self.flask_app.config['SSE_RETRY_MS']}\n\n".encode()})
+            while True:
+                next_event = asyncio.ensure_future(subscriber.queue.get())
+                done, _ = await asyncio.wait({next_event, disconnected}, timeout=self.flask_app.config['SSE_KEEPALIVE'],
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    next_event.cancel()
+                    return
+                if next_event not in done:
+                    next_event.cancel()
+                    chunk = ': keepalive\n\n'
+                else:
+                    event_id, event_type, data = next_event.result()
+                    if not (is_admin or data['staff_id'] == user_id):
+                        continue
+                    chunk = f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n'
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        finally:
+            event_broker.unsubscribe(subscriber)
+            disconnected.cancel()
+
+application = CheckInASGI(app)
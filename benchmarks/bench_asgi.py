@@ -0,0 +1,166 @@
+"""Compare the WSGI and ASGI deployments under many open live-update streams.
+
+Starts the app under gunicorn (WSGI, threaded workers) and under uvicorn
+(asgi.py), then for each connection count opens that many /api/events
+streams at once and, while they are held open, polls /api/status from a
+separate client. Reports how many streams were established and the status
+probe's latency and failures. Both servers get the same worker count and a
+fresh copy of the seeded database. Run from the repository root:
+
+    python benchmarks/bench_asgi.py --connections 10 50 200 1000 --workers 2
+"""
+import argparse
+import asyncio
+import logging
+import os
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as checkin_app
+
+def make_database(path, staff_count):
+    """Seed staff and one logged-in session each; returns the session ids"""
+    checkin_app.app.config['DATABASE_PATH'] = path
+    checkin_app.init_db()
+    pool = checkin_app.get_pool()
+    conn = pool.acquire()
+    conn.executemany(
+        'INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+        [(f'Staff {i}', f'staff{i}@example.com', 'x', 'staff') for i in range(staff_count)]
+    )
+    conn.commit()
+    staff = conn.execute('SELECT id, name, role FROM staff').fetchall()
+    pool.release(conn)
+
+    store = checkin_app.SQLiteSessionStore()
+    serializer = checkin_app.ServerSideSessionInterface.serializer
+    expires_at = time.time() + 86400
+    sids = []
+    for staff_id, name, role in staff:
+        sid = secrets.token_urlsafe(32)
+        data = serializer.dumps({'user_id': staff_id, 'user_name': name, 'user_role': role})
+        store.save(sid, data, expires_at, staff_id)
+        sids.append(sid)
+    pool.close_all()
+    return sids
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(kind, workers, threads, port, cwd):
+    """Launch a server whose relative DATABASE_PATH resolves inside cwd"""
+    if kind == 'wsgi':
+        command = ['gunicorn', '-w', str(workers), '--threads', str(threads), '-b', f'127.0.0.1:{port}',
+                   '--log-level', 'error', 'app:app']
+    else:
+        command = ['uvicorn', 'asgi:application', '--workers', str(workers), '--port', str(port),
+                   '--log-level', 'error', '--no-access-log']
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    server = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+async def request_head(port, path, sid, timeout):
+    """Send a GET and read the status line and headers; returns (status, reader, writer)"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nCookie: session={sid}\r\n\r\n'.encode())
+    await writer.drain()
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+    return int(head.split(b' ', 2)[1]), reader, writer
+
+async def open_stream(port, sid, timeout):
+    """Open /api/events and wait for its first chunk (the retry: line)"""
+    try:
+        status, reader, writer = await request_head(port, '/api/events', sid, timeout)
+        if status != 200:
+            writer.close()
+            return None
+        await asyncio.wait_for(reader.readuntil(b'\n\n'), timeout)
+        return writer
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return None
+
+async def probe_status(port, sid, count, timeout):
+    latencies, failures = [], 0
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            status, _, writer = await request_head(port, '/api/status', sid, timeout)
+            writer.close()
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures += 1
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            failures += 1
+        await asyncio.sleep(0.05)
+    return sorted(latencies), failures
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(pct / 100 * len(sorted_values)))]
+
+async def run(port, sids, connections, probes, timeout):
+    # The status probe uses a session none of the streams hold
+    streams = await asyncio.gather(*(open_stream(port, sids[1 + i % (len(sids) - 1)], timeout)
+                                     for i in range(connections)))
+    opened = [writer for writer in streams if writer is not None]
+    latencies, failures = await probe_status(port, sids[0], probes, timeout)
+    for writer in opened:
+        writer.close()
+    await asyncio.sleep(0.5)
+    return len(opened), latencies, failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 50, 200, 1000],
+                        help='concurrent /api/events streams to hold open')
+    parser.add_argument('--workers', type=int, default=2, help='server processes for both deployments')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--staff', type=int, default=200, help='staff (and sessions) to seed')
+    parser.add_argument('--probes', type=int, default=20, help='/api/status requests per run')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request counts as failed')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print("=== WSGI vs ASGI Live-Connection Benchmark ===\n")
+    print(f"{'server':>7} {'streams':>8} {'opened':>7} {'status p50':>11} {'status p95':>11} {'failed':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        seed = os.path.join(tmp, 'seed.db')
+        sids = make_database(seed, args.staff)
+        for kind in ('wsgi', 'asgi'):
+            for connections in args.connections:
+                cwd = os.path.join(tmp, f'{kind}-{connections}')
+                os.makedirs(cwd)
+                shutil.copy(seed, os.path.join(cwd, checkin_app.Config.DATABASE_PATH))
+                port = free_port()
+                server = start_server(kind, args.workers, args.threads, port, cwd)
+                try:
+                    opened, latencies, failures = asyncio.run(
+                        run(port, sids, connections, args.probes, args.timeout))
+                finally:
+                    server.terminate()
+                    server.wait(30)
+                print(f"{kind:>7} {connections:>8} {opened:>7} {percentile(latencies, 50) * 1000:>9.1f}ms "
+                      f"{percentile(latencies, 95) * 1000:>9.1f}ms {failures:>7}")
+
+if __name__ == '__main__':
+    main()
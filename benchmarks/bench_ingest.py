@@ -0,0 +1,88 @@
+"""Compare per-request commits with the batched ingestion queue.
+
+Simulates a morning rush: every staff member checks in at once from a pool
+of concurrent request threads. Run from the repository root:
+
+    python benchmarks/bench_ingest.py --staff 1000 --threads 32
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as checkin_app
+
+CLIENT_INFO = checkin_app.client_info_for('10.0.0.1', 'bench')
+
+def make_database(path, staff_count):
+    checkin_app.app.config['DATABASE_PATH'] = path
+    checkin_app.init_db()
+    pool = checkin_app.get_pool()
+    conn = pool.acquire()
+    conn.executemany(
+        'INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+        [(f'Staff {i}', f'staff{i}@example.com', 'x', 'staff') for i in range(staff_count)]
+    )
+    conn.commit()
+    staff_ids = [row[0] for row in conn.execute('SELECT id FROM staff')]
+    pool.release(conn)
+    return pool, staff_ids
+
+def run_inline(pool, staff_ids, threads):
+    """Current path: every check-in commits its own transaction"""
+    now = datetime.now()
+    
+    def check_in(staff_id):
+        conn = pool.acquire()
+        try:
+            checkin_app.record_check_in(conn.cursor(), staff_id, now, False, None, CLIENT_INFO)
+            conn.commit()
+        finally:
+            pool.release(conn)
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(check_in, staff_ids))
+    return len(staff_ids)
+
+def run_batched(pool, staff_ids, threads, interval_ms, batch_size):
+    """Write-behind path: check-ins are grouped into batched transactions"""
+    now = datetime.now()
+    ingest = checkin_app.IngestQueue(pool, interval_ms=interval_ms, batch_size=batch_size)
+    
+    def check_in(staff_id):
+        ingest.submit(checkin_app.record_check_in, staff_id, now, False, None, CLIENT_INFO).wait(30)
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(check_in, staff_ids))
+    return ingest.batches
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--staff', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--interval-ms', type=int, default=checkin_app.Config.INGEST_BATCH_INTERVAL_MS)
+    parser.add_argument('--batch-size', type=int, default=checkin_app.Config.INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+    checkin_app.app.config['DB_POOL_SIZE'] = args.threads + 1
+    
+    print("=== Check-In Ingestion Benchmark ===\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, runner in (
+            ('inline', lambda pool, ids: run_inline(pool, ids, args.threads)),
+            ('batched', lambda pool, ids: run_batched(pool, ids, args.threads, args.interval_ms, args.batch_size)),
+        ):
+            pool, staff_ids = make_database(os.path.join(tmp, f'{label}.db'), args.staff)
+            started = time.perf_counter()
+            commits = runner(pool, staff_ids)
+            elapsed = time.perf_counter() - started
+            print(f"{label:>8}: {len(staff_ids)} check-ins in {elapsed:.2f}s "
+                  f"({len(staff_ids) / elapsed:,.0f} events/s, {commits} commits, "
+                  f"{commits / elapsed:,.0f} commits/s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Measure login throughput, and check-in latency during a login storm.
+
+For each pbkdf2 cost, every staff member logs in at once while a probe
+thread keeps checking other staff in. This runs once with hashing on the
+request threads (--workers 0) and once with the process pool, so you can
+see the cost of each setting and whether check-ins stay flat. Run from the
+repository root:
+
+    python benchmarks/bench_login.py --costs 100000 300000 600000 --logins 200
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as checkin_app
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'Bench@123'
+
+def make_database(path, cost, logins, probes):
+    checkin_app.app.config['DATABASE_PATH'] = path
+    checkin_app.init_db()
+    password = generate_password_hash(PASSWORD, method=f'pbkdf2:sha256:{cost}')
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+        [(f'Staff {i}', f'staff{i}@example.com', password, 'staff') for i in range(logins + probes)]
+    )
+    conn.commit()
+    conn.close()
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(pct / 100 * len(sorted_values)))]
+
+def run(cost, workers, logins, probes, threads, tmp):
+    checkin_app.app.config.update(
+        PASSWORD_HASH_METHOD=f'pbkdf2:sha256:{cost}',
+        PASSWORD_HASH_WORKERS=workers,
+        DB_POOL_SIZE=threads + 2,
+    )
+    make_database(os.path.join(tmp, f'login-{cost}-{workers}.db'), cost, logins, probes)
+
+    # Probe clients log in before the storm so only their check-ins are timed
+    probe_clients = []
+    for i in range(logins, logins + probes):
+        client = checkin_app.app.test_client()
+        client.post('/login', data={'email': f'staff{i}@example.com', 'password': PASSWORD})
+        probe_clients.append(client)
+
+    storm_running = threading.Event()
+    check_in_latencies = []
+
+    def probe():
+        storm_running.wait()
+        for client in probe_clients:
+            if not storm_running.is_set():
+                break
+            started = time.perf_counter()
+            client.post('/check_in')
+            check_in_latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+
+    def login(i):
+        started = time.perf_counter()
+        response = checkin_app.app.test_client().post(
+            '/login', data={'email': f'staff{i}@example.com', 'password': PASSWORD}
+        )
+        return response.status_code, time.perf_counter() - started
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+    started = time.perf_counter()
+    storm_running.set()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    storm_running.clear()
+    prober.join()
+
+    accepted = sorted(seconds for status, seconds in results if status == 302)
+    rejected = sum(1 for status, _ in results if status == 503)
+    check_ins = sorted(check_in_latencies)
+    mode = 'inline' if workers == 0 else f'{workers} procs'
+    print(f"{cost:>8} {mode:>8} {len(accepted) / elapsed:>9.1f} {percentile(accepted, 50) * 1000:>9.0f} "
+          f"{percentile(accepted, 95) * 1000:>9.0f} {rejected:>8} {len(check_ins):>7} "
+          f"{percentile(check_ins, 50) * 1000:>8.1f} {percentile(check_ins, 95) * 1000:>8.1f}")
+    checkin_app.get_pool().close_all()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+', default=[100000, 300000, 600000],
+                        help='pbkdf2 iteration counts to compare')
+    parser.add_argument('--workers', type=int, default=checkin_app.Config.PASSWORD_HASH_WORKERS,
+                        help='hashing processes for the pooled run')
+    parser.add_argument('--logins', type=int, default=100, help='logins in each storm')
+    parser.add_argument('--probes', type=int, default=200, help='staff available to the check-in probe')
+    parser.add_argument('--threads', type=int, default=32, help='concurrent login requests')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print("=== Login Storm Benchmark ===\n")
+    print(f"{'cost':>8} {'hashing':>8} {'logins/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'rejected':>8} "
+          f"{'checkins':>7} {'ci p50':>8} {'ci p95':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for cost in args.costs:
+            for workers in (0, args.workers):
+                run(cost, workers, args.logins, args.probes, args.threads, tmp)
+    checkin_app.get_password_hasher().shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Measure office-network classification cost as the prefix count grows.
+
+Loads random IPv4 and IPv6 prefixes into the PrefixTrie used to classify
+check-ins and times lookups of addresses inside and outside them, next to
+a linear scan with the ipaddress module for comparison. Run from the
+repository root:
+
+    python benchmarks/bench_networks.py --prefixes 100 1000 10000 --lookups 100000
+"""
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as checkin_app
+
+def random_networks(count, rng):
+    """Mostly IPv4 office-sized ranges, with some IPv6"""
+    networks = []
+    for _ in range(count):
+        if rng.random() < 0.8:
+            networks.append(ipaddress.ip_network((rng.getrandbits(32), rng.randint(8, 30)), strict=False))
+        else:
+            networks.append(ipaddress.ip_network((rng.getrandbits(128), rng.randint(32, 64)), strict=False))
+    return networks
+
+def random_addresses(networks, count, rng):
+    """Half inside a loaded network, half anywhere"""
+    addresses = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            network = rng.choice(networks)
+            addresses.append(str(network.network_address + rng.randrange(min(network.num_addresses, 1 << 32))))
+        elif rng.random() < 0.8:
+            addresses.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+        else:
+            addresses.append(str(ipaddress.IPv6Address(rng.getrandbits(128))))
+    return addresses
+
+def linear_lookup(networks, address):
+    ip = ipaddress.ip_address(address)
+    best = None
+    for network in networks:
+        if ip.version == network.version and ip in network and (best is None or network.prefixlen > best.prefixlen):
+            best = network
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--prefixes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--linear-lookups', type=int, default=1000, help='lookups timed for the linear scan')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print("=== Office Network Classification Benchmark ===\n")
+    print(f"{'prefixes':>9} {'build ms':>9} {'trie ns/lookup':>15} {'linear ns/lookup':>17} {'matched':>8}")
+    for count in args.prefixes:
+        networks = random_networks(count, rng)
+        addresses = random_addresses(networks, args.lookups, rng)
+
+        started = time.perf_counter()
+        trie = checkin_app.PrefixTrie()
+        for network in networks:
+            trie.insert(network, str(network))
+        build_ms = (time.perf_counter() - started) * 1000
+
+        lookup = trie.lookup
+        started = time.perf_counter()
+        matched = sum(1 for address in addresses if lookup(address) is not None)
+        trie_ns = (time.perf_counter() - started) / len(addresses) * 1e9
+
+        sample = addresses[:args.linear_lookups]
+        started = time.perf_counter()
+        for address in sample:
+            linear_lookup(networks, address)
+        linear_ns = (time.perf_counter() - started) / len(sample) * 1e9
+
+        # The two must agree on the matched prefix length
+        for address in sample[:200]:
+            expected = linear_lookup(networks, address)
+            found = lookup(address)
+            assert (found is None) == (expected is None), address
+            assert found is None or ipaddress.ip_network(found).prefixlen == expected.prefixlen, address
+
+        print(f"{count:>9} {build_ms:>9.1f} {trie_ns:>15,.0f} {linear_ns:>17,.0f} {matched / len(addresses):>7.0%}")
+
+if __name__ == '__main__':
+    main()
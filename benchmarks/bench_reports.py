@@ -0,0 +1,154 @@
+"""Benchmark the /reports open-break lookup on a synthetic day.
+
+Seeds one day of check-ins for a large staff (every log has a few closed
+breaks and a share of staff are on break right now), then times the old
+correlated-subquery query against the LEFT JOIN + partial index version.
+
+    python benchmarks/bench_reports.py --staff 5000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as checkin_app
+
+DAY = '2024-03-04'
+
+CORRELATED_QUERY = '''
+    SELECT 
+        l.id,
+        s.name,
+        l.check_in_time,
+        l.check_out_time,
+        s.id as staff_id,
+        (
+            SELECT COUNT(*)
+            FROM break_logs b
+            WHERE b.check_in_log_id = l.id
+            AND b.break_end IS NULL
+        ) > 0 as is_on_break,
+        (
+            SELECT break_start
+            FROM break_logs b
+            WHERE b.check_in_log_id = l.id
+            AND b.break_end IS NULL
+            LIMIT 1
+        ) as break_start,
+        (
+            SELECT break_type
+            FROM break_logs b
+            WHERE b.check_in_log_id = l.id
+            AND b.break_end IS NULL
+            LIMIT 1
+        ) as break_type,
+        l.is_late,
+        l.late_reason,
+        l.total_break_time
+    FROM check_in_logs l 
+    JOIN staff s ON l.staff_id = s.id 
+    WHERE l.date = ?
+    ORDER BY l.check_in_time
+'''
+
+JOIN_QUERY = '''
+    SELECT 
+        l.id,
+        s.name,
+        l.check_in_time,
+        l.check_out_time,
+        s.id as staff_id,
+        b.id IS NOT NULL as is_on_break,
+        b.break_start,
+        b.break_type,
+        l.is_late,
+        l.late_reason,
+        l.total_break_time
+    FROM check_in_logs l 
+    JOIN staff s ON l.staff_id = s.id 
+    LEFT JOIN break_logs b ON b.check_in_log_id = l.id AND b.break_end IS NULL
+    WHERE l.date = ?
+    ORDER BY l.check_in_time
+'''
+
+def seed(path, staff_count, breaks_per_log, on_break_share):
+    checkin_app.app.config['DATABASE_PATH'] = path
+    checkin_app.init_db()
+    conn = sqlite3.connect(path)
+    rng = random.Random(42)
+    start = datetime.strptime(DAY, '%Y-%m-%d').replace(hour=8)
+    
+    conn.executemany(
+        'INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+        [(f'Staff {i}', f'staff{i}@example.com', 'x', 'staff') for i in range(staff_count)]
+    )
+    logs = []
+    for staff_id in range(1, staff_count + 1):
+        check_in = start + timedelta(minutes=rng.randint(0, 120))
+        logs.append((staff_id, check_in, DAY, check_in.hour >= 9))
+    conn.executemany(
+        'INSERT INTO check_in_logs (staff_id, check_in_time, date, is_late) VALUES (?, ?, ?, ?)',
+        logs
+    )
+    breaks = []
+    for log_id, (_, check_in, _, _) in enumerate(logs, start=1):
+        for n in range(breaks_per_log):
+            break_start = check_in + timedelta(hours=n + 1)
+            breaks.append((log_id, break_start, break_start + timedelta(minutes=15), 'short'))
+        if rng.random() < on_break_share:
+            breaks.append((log_id, check_in + timedelta(hours=breaks_per_log + 1), None, 'lunch'))
+    conn.executemany(
+        'INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES (?, ?, ?, ?)',
+        breaks
+    )
+    conn.commit()
+    conn.execute('ANALYZE')
+    return conn, len(breaks)
+
+def time_query(conn, sql, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        rows = conn.execute(sql, (DAY,)).fetchall()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return rows, timings[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--staff', type=int, default=5000)
+    parser.add_argument('--breaks-per-log', type=int, default=3)
+    parser.add_argument('--on-break', type=float, default=0.2, help='share of staff currently on break')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+    
+    print("=== Reports Query Benchmark ===\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        conn, break_count = seed(os.path.join(tmp, 'reports.db'), args.staff, args.breaks_per_log, args.on_break)
+        print(f"Seeded {args.staff} check-ins and {break_count} breaks for {DAY}\n")
+        
+        conn.execute('DROP INDEX idx_break_logs_open')
+        before_rows, before = time_query(conn, CORRELATED_QUERY, args.iterations)
+        
+        checkin_app.migration_open_break_index(conn.cursor())
+        conn.execute('ANALYZE')
+        after_rows, after = time_query(conn, JOIN_QUERY, args.iterations)
+        
+        assert [tuple(r) for r in before_rows] == [tuple(r) for r in after_rows], 'query results differ'
+        print(f"Before (3 correlated subqueries): {before * 1000:8.2f} ms (median)")
+        print(f"After (LEFT JOIN + partial index): {after * 1000:7.2f} ms (median)")
+        print(f"Speedup: {before / after:.1f}x\n")
+        
+        print("Query plan:")
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + JOIN_QUERY, (DAY,)):
+            print(f"  {row[-1]}")
+        conn.close()
+
+if __name__ == '__main__':
+    main()
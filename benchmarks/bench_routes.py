@@ -0,0 +1,259 @@
+"""Load-test the check-in hot paths end to end through the Flask app.
+
+Seeds a database with staff and months of attendance history, then drives
+the real routes (login, check-in, breaks, check-out, dashboard, reports and
+export) from concurrent workers using the Flask test client. Reports p50,
+p95 and p99 latency and throughput per route, plus the SQL and template
+time the app's own request metrics attribute to it, and saves the numbers
+as JSON so runs can be compared. Run from the repository root:
+
+    python benchmarks/bench_routes.py --staff 500 --months 6 --workers 16
+    python benchmarks/bench_routes.py --compare bench_results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as checkin_app
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'Bench@123'
+ADMIN_EMAIL = 'bench-admin@example.com'
+BREAK_TYPES = list(checkin_app.app.config['BREAK_TYPES'])
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+)
+
+def seed_database(path, staff_count, months, rng):
+    """Create staff plus months of weekday check-ins, breaks and locations.
+
+    Today is left empty so the workers can check in. Returns the staff ids
+    and the first and last seeded dates.
+    """
+    checkin_app.app.config['DATABASE_PATH'] = path
+    checkin_app.init_db()
+    # One hash for everyone: generating thousands of pbkdf2 hashes would
+    # dominate seeding time without changing what the routes do
+    password = generate_password_hash(PASSWORD, method='pbkdf2:sha256')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executemany(
+        'INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+        [(f'Staff {i}', f'staff{i}@example.com', password, 'staff') for i in range(staff_count)]
+    )
+    conn.execute('INSERT INTO staff (name, email, password, role) VALUES (?, ?, ?, ?)',
+                 ('Bench Admin', ADMIN_EMAIL, password, 'admin'))
+    staff_ids = [row[0] for row in conn.execute("SELECT id FROM staff WHERE role = 'staff'")]
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    first_day = today - timedelta(days=30 * months)
+    user_agent_ids = [checkin_app.user_agent_cache.intern(conn.cursor(), ua) for ua in USER_AGENTS]
+    logs, breaks, locations = [], [], []
+    log_id = 0
+    day = first_day
+    while day < today:
+        if day.weekday() < 5:
+            for staff_id in staff_ids:
+                log_id += 1
+                check_in = day + timedelta(hours=8, minutes=rng.randint(0, 90), seconds=rng.randint(0, 59))
+                check_out = day + timedelta(hours=17, minutes=rng.randint(0, 60))
+                total_break = 0
+                for _ in range(rng.randint(0, 2)):
+                    start = day + timedelta(hours=rng.randint(11, 14), minutes=rng.randint(0, 59))
+                    minutes = rng.randint(5, 45)
+                    breaks.append((log_id, start, start + timedelta(minutes=minutes), rng.choice(BREAK_TYPES)))
+                    total_break += minutes
+                is_late = checkin_app.is_late_check_in(check_in)
+                logs.append((log_id, staff_id, check_in, check_out,
+                             day.strftime('%Y-%m-%d'), is_late, 'Traffic' if is_late else None, total_break))
+                locations.append((log_id, f'10.0.{staff_id % 256}.{rng.randint(1, 254)}',
+                                  rng.choice(user_agent_ids)))
+        day += timedelta(days=1)
+
+    conn.executemany('''
+        INSERT INTO check_in_logs
+        (id, staff_id, check_in_time, check_out_time, date, is_late, late_reason, total_break_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', logs)
+    conn.executemany(
+        'INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES (?, ?, ?, ?)',
+        breaks
+    )
+    conn.executemany(
+        'INSERT INTO location_logs (check_in_log_id, ip_address, user_agent_id) VALUES (?, ?, ?)',
+        locations
+    )
+    checkin_app.backfill_daily_summary(conn.cursor())
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f"Seeded {len(staff_ids)} staff, {len(logs)} check-ins, {len(breaks)} breaks "
+          f"from {first_day:%Y-%m-%d} to {today - timedelta(days=1):%Y-%m-%d}")
+    return staff_ids, first_day, today - timedelta(days=1)
+
+class Recorder:
+    """Collects client-side latency samples per route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def request(self, client, route, method, path, **kwargs):
+        started = time.perf_counter()
+        response = getattr(client, method)(path, **kwargs)
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples.setdefault(route, []).append((elapsed, response.status_code))
+        return response
+
+def staff_session(recorder, email):
+    """A staff member's day: log in, check in, take a break, check out"""
+    client = checkin_app.app.test_client()
+    recorder.request(client, 'login', 'post', '/login', data={'email': email, 'password': PASSWORD})
+    recorder.request(client, 'dashboard', 'get', '/dashboard')
+    recorder.request(client, 'check_in', 'post', '/check_in')
+    recorder.request(client, 'start_break', 'post', '/start_break', data={'break_type': 'regular'})
+    recorder.request(client, 'end_break', 'post', '/end_break')
+    recorder.request(client, 'dashboard', 'get', '/dashboard')
+    recorder.request(client, 'check_out', 'post', '/check_out')
+
+def admin_session(recorder, rng, first_day, last_day):
+    """An admin browsing reports and exporting a month of history"""
+    client = checkin_app.app.test_client()
+    recorder.request(client, 'login', 'post', '/login', data={'email': ADMIN_EMAIL, 'password': PASSWORD})
+    recorder.request(client, 'dashboard', 'get', '/dashboard')
+    span = max((last_day - first_day).days, 1)
+    day = first_day + timedelta(days=rng.randint(0, span))
+    recorder.request(client, 'reports', 'get', f'/reports?date={day:%Y-%m-%d}')
+    start = first_day + timedelta(days=rng.randint(0, max(span - 30, 0)))
+    end = min(start + timedelta(days=30), last_day)
+    recorder.request(client, 'export_report', 'get', f'/export_report?start={start:%Y-%m-%d}&end={end:%Y-%m-%d}')
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarise(samples, elapsed):
+    """Combine client latencies with the app's own SQL and template totals"""
+    server = {}
+    for (route, _method), totals in checkin_app.request_metrics.snapshot().items():
+        merged = server.setdefault(route, {'requests': 0, 'db_seconds': 0.0, 'template_seconds': 0.0, 'queries': 0})
+        for field in merged:
+            merged[field] += totals[field]
+    routes = {}
+    for route, rows in sorted(samples.items()):
+        latencies = sorted(row[0] for row in rows)
+        totals = server.get(route) or {'requests': 1, 'db_seconds': 0.0, 'template_seconds': 0.0, 'queries': 0}
+        routes[route] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row[1] >= 500),
+            'throughput': len(rows) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'db_mean_ms': totals['db_seconds'] / totals['requests'] * 1000,
+            'template_mean_ms': totals['template_seconds'] / totals['requests'] * 1000,
+            'queries_per_request': totals['queries'] / totals['requests'],
+        }
+    return routes
+
+def print_table(routes, baseline=None):
+    header = f"{'route':<14}{'reqs':>7}{'err':>5}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db ms':>8}{'tpl ms':>8}{'queries':>9}"
+    if baseline:
+        header += f"{'p95 vs base':>13}"
+    print(header)
+    for route, stats in routes.items():
+        line = (f"{route:<14}{stats['requests']:>7}{stats['errors']:>5}{stats['throughput']:>9.1f}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['db_mean_ms']:>8.1f}"
+                f"{stats['template_mean_ms']:>8.1f}{stats['queries_per_request']:>9.1f}")
+        if baseline:
+            previous = baseline['routes'].get(route)
+            if previous and previous['p95_ms']:
+                line += f"{(stats['p95_ms'] / previous['p95_ms'] - 1) * 100:>+12.1f}%"
+            else:
+                line += f"{'-':>13}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--staff', type=int, default=200, help='staff accounts to seed')
+    parser.add_argument('--months', type=int, default=3, help='months of history to seed')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--sessions', type=int, default=None,
+                        help='staff check-in sessions to run (default: one per staff member)')
+    parser.add_argument('--admin-sessions', type=int, default=20, help='admin report/export sessions to run')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for the generated data')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous JSON results to compare p95 latency against')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    rng = random.Random(args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    checkin_app.app.config['DB_POOL_SIZE'] = args.workers + 1
+    print("=== Route Load Benchmark ===\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        staff_ids, first_day, last_day = seed_database(os.path.join(tmp, 'bench.db'), args.staff, args.months, rng)
+        sessions = args.sessions if args.sessions is not None else len(staff_ids)
+        emails = [f'staff{i % len(staff_ids)}@example.com' for i in range(sessions)]
+        recorder = Recorder()
+        jobs = [lambda email=email: staff_session(recorder, email) for email in emails]
+        jobs += [lambda seed=rng.random(): admin_session(recorder, random.Random(seed), first_day, last_day)
+                 for _ in range(args.admin_sessions)]
+        rng.shuffle(jobs)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for future in [executor.submit(job) for job in jobs]:
+                future.result()
+        elapsed = time.perf_counter() - started
+        checkin_app.get_pool().close_all()
+
+    routes = summarise(recorder.samples, elapsed)
+    total = sum(stats['requests'] for stats in routes.values())
+    print(f"\n{total} requests from {args.workers} workers in {elapsed:.2f}s ({total / elapsed:,.1f} req/s)\n")
+    print_table(routes, baseline)
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'elapsed_s': elapsed,
+        'requests': total,
+        'throughput': total / elapsed,
+        'routes': routes,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == '__main__':
+    main()
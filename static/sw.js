@@ -1,9 +1,9 @@
-const CACHE_NAME = 'check-in-system-v1';
+// CACHE_VERSION and PRECACHE_URLS are prepended by the server from the
+// static asset manifest, so a new deploy gets a new cache
+const CACHE_NAME = `check-in-system-${CACHE_VERSION}`;
 const ASSETS_TO_CACHE = [
     '/',
-    '/static/css/style.css',
-    '/static/js/script.js',
-    '/static/favicon.ico',
+    ...PRECACHE_URLS,
     '/mobile_check_in',
     '/dashboard'
 ];
@@ -36,6 +36,11 @@ self.addEventListener('activate', (event) => {
 
 // Fetch Event Strategy
 self.addEventListener('fetch', (event) => {
+    // Live status API and event stream must always hit the network
+    if (new URL(event.request.url).pathname.startsWith('/api/')) {
+        return;
+    }
+
     event.respondWith(
         caches.match(event.request)
             .then((response) => {
@@ -1,3 +1,4 @@
+import pytest
 import sqlite3
 import os
 from datetime import datetime
@@ -54,6 +55,900 @@ def test_file_structure():
     
     return all(os.path.exists(f) for f in required_files)
 
+def test_connection_pool(tmp_path):
+    from app import ConnectionPool
+    
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), max_size=2, timeout=0.1)
+    conn = pool.acquire()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    pool.release(conn)
+    
+    # Released connections are reused rather than reopened
+    assert pool.acquire() is conn
+    other = pool.acquire()
+    stats = pool.stats()
+    assert stats['size'] == 2 and stats['in_use'] == 2
+    
+    # A full pool times out instead of opening more connections
+    try:
+        pool.acquire()
+        assert False, 'expected pool timeout'
+    except sqlite3.OperationalError:
+        pass
+    assert pool.stats()['waits'] == 1
+    
+    pool.release(conn)
+    pool.release(other)
+    pool.close_all()
+    assert pool.stats()['size'] == 0
+
+def test_ingest_queue_handler_error(tmp_path):
+    from app import ConnectionPool, IngestQueue
+    
+    pool = ConnectionPool(str(tmp_path / 'ingest.db'), max_size=2)
+    conn = pool.acquire()
+    conn.execute('CREATE TABLE events (name TEXT)')
+    conn.commit()
+    pool.release(conn)
+    
+    def insert(cursor, name):
+        cursor.execute('INSERT INTO events (name) VALUES (?)', (name,))
+        return {'status': 'ok'}
+    
+    def broken(cursor, name):
+        cursor.execute('INSERT INTO events (name) VALUES (?)', (name,))
+        raise ValueError('bad event')
+    
+    ingest = IngestQueue(pool, interval_ms=0)
+    # A non-SQLite failure only rolls back its own event
+    writes = [ingest.submit(insert, 'a'), ingest.submit(broken, 'b'), ingest.submit(insert, 'c')]
+    assert writes[0].wait(5) == {'status': 'ok'}
+    with pytest.raises(ValueError):
+        writes[1].wait(5)
+    assert writes[2].wait(5) == {'status': 'ok'}
+    # The writer thread is still running for the next batch
+    assert ingest.submit(insert, 'd').wait(5) == {'status': 'ok'}
+    
+    conn = pool.acquire()
+    assert [row[0] for row in conn.execute('SELECT name FROM events ORDER BY rowid')] == ['a', 'c', 'd']
+    pool.release(conn)
+    pool.close_all()
+
+def test_streamed_export(tmp_path):
+    import app as app_module
+    from app import app, init_db, get_pool
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'export.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('Admin', 'admin@x.com', 'x', 'admin')")
+    conn.executemany('INSERT INTO check_in_logs (staff_id, check_in_time, check_out_time, date, is_late) VALUES (1, ?, ?, ?, ?)', [
+        (datetime(2024, 3, day, 9, minute), datetime(2024, 3, day, 17), f'2024-03-{day:02d}', minute > 0)
+        for day in (4, 5, 6) for minute in (0, 30)
+    ] + [(datetime(2024, 3, 10, 9), None, '2024-03-10', 0)])
+    conn.commit()
+    conn.close()
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='Admin', user_role='admin')
+    chunk_rows = app_module.EXPORT_CHUNK_ROWS
+    app_module.EXPORT_CHUNK_ROWS = 4
+    try:
+        # Unpadded dates are accepted and compared as their ISO form
+        response = client.get('/export_report?start=2024-3-5&end=2024-3-6', buffered=False)
+        assert response.is_streamed
+        chunks = [chunk.decode() for chunk in response.response]
+        wide = client.get('/export_report?start=2024-3-4&end=2024-3-10', buffered=False)
+        wide_chunks = [chunk.decode() for chunk in wide.response]
+    finally:
+        app_module.EXPORT_CHUNK_ROWS = chunk_rows
+    assert 'check_in_report_2024-03-05_to_2024-03-06.csv' in response.headers['Content-Disposition']
+    lines = ''.join(chunks).splitlines()
+    assert lines[0].startswith('Staff Name,Check-In Time')
+    assert [line.split(',')[1] + ' ' + line.split(',')[-1] for line in lines[1:]] == [
+        '09:00:00 2024-03-05', '09:30:00 2024-03-05', '09:00:00 2024-03-06', '09:30:00 2024-03-06',
+    ]
+    assert lines[2].split(',')[3:6] == ['7h 30m', 'Completed', 'Yes']
+    # Rows go out EXPORT_CHUNK_ROWS at a time, the header with the first chunk
+    assert len(chunks) == 1
+    assert [chunk.count('\n') for chunk in wide_chunks] == [5, 3]
+    get_pool().close_all()
+
+def test_daily_summary(tmp_path):
+    from app import app, init_db, refresh_daily_summary, record_break_start
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'summary.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    cursor.execute('''
+        INSERT INTO check_in_logs (staff_id, check_in_time, check_out_time, date, is_late, total_break_time)
+        VALUES (1, ?, ?, '2024-03-04', 1, 30)
+    ''', (datetime(2024, 3, 4, 9, 15), datetime(2024, 3, 4, 17, 45)))
+    log_id = cursor.lastrowid
+    cursor.execute("INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES (?, ?, ?, 'regular')",
+                   (log_id, datetime(2024, 3, 4, 12, 0), datetime(2024, 3, 4, 12, 30)))
+    refresh_daily_summary(cursor, log_id)
+    
+    cursor.execute('SELECT worked_seconds, break_minutes, break_count, is_late FROM daily_attendance_summary')
+    assert cursor.fetchall() == [(8.5 * 3600, 30, 1, 1)]
+    
+    # Starting a break counts it straight away, not only once it ends
+    conn.row_factory = sqlite3.Row
+    assert record_break_start(conn.cursor(), 1, datetime(2024, 3, 4, 15, 0), 'regular')['status'] == 'ok'
+    cursor.execute('SELECT break_count, break_minutes FROM daily_attendance_summary')
+    assert tuple(cursor.fetchone()) == (2, 30)
+    
+    # Timestamps are stored as integer local-epoch seconds
+    cursor.execute("SELECT typeof(check_in_time), strftime('%H:%M', check_in_time, 'unixepoch') FROM check_in_logs")
+    assert cursor.fetchone() == ('integer', '09:15')
+    conn.close()
+
+def test_today_status_cache(tmp_path, monkeypatch):
+    import app as app_module
+    from app import app, init_db, get_pool, today_cache, TodayStatusCache
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'cache.db')
+    init_db()
+    today_cache.clear()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    conn.commit()
+    conn.close()
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='A', user_role='staff')
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    # Committed writes update the cached entry without another read
+    client.post('/check_in')
+    status = today_cache.get(1, today)
+    assert status['id'] == 1 and status['check_out_time'] is None
+    client.post('/start_break', data={'break_type': 'lunch'})
+    assert today_cache.get(1, today)['active_break']['break_type'] == 'lunch'
+    client.post('/check_out')
+    status = today_cache.get(1, today)
+    assert status['check_out_time'] is not None and status['active_break'] is None
+    # A rejected write drops the entry so the next read goes to the database
+    today_cache.write_through({'status': 'not_checked_in', 'staff_id': 1, 'date': today, 'today': None})
+    assert today_cache.get(1, today) is TodayStatusCache.MISSING
+    
+    # A new day clears the previous day's entries
+    cache = TodayStatusCache(max_entries=2, ttl=30)
+    cache.put(1, '2024-03-04', None)
+    cache.put(2, '2024-03-04', {'id': 7})
+    assert cache.get(1, '2024-03-04') is None
+    cache.put(3, '2024-03-05', None)
+    assert cache.stats()['entries'] == 1
+    assert cache.get(2, '2024-03-04') is TodayStatusCache.MISSING
+    
+    # Least recently used entries are evicted past max_entries
+    for staff_id in (4, 5):
+        cache.put(staff_id, '2024-03-05', None)
+    assert cache.get(3, '2024-03-05') is TodayStatusCache.MISSING
+    
+    # Entries expire after the TTL
+    clock = [1000.0]
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: clock[0])
+    cache.put(6, '2024-03-05', {'id': 9})
+    clock[0] += 29
+    assert cache.get(6, '2024-03-05') == {'id': 9}
+    clock[0] += 2
+    assert cache.get(6, '2024-03-05') is TodayStatusCache.MISSING
+    get_pool().close_all()
+
+def test_status_api(tmp_path):
+    from app import app, init_db, get_pool, today_cache, EventBroker
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'status.db')
+    init_db()
+    today_cache.clear()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    conn.commit()
+    conn.close()
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='A', user_role='staff')
+    response = client.get('/api/status')
+    assert response.json['state'] == 'not_checked_in'
+    etag = response.headers['ETag']
+    # Unchanged status revalidates to a bodiless 304
+    response = client.get('/api/status', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    client.post('/check_in')
+    response = client.get('/api/status', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.json['state'] == 'checked_in'
+    
+    # Reconnecting subscribers replay events after their Last-Event-ID
+    broker = EventBroker(history=3, max_queue=2)
+    for log_id in range(1, 5):
+        broker.publish('check_in', {'staff_id': 1, 'date': 'd', 'log_id': log_id})
+    assert broker.subscribe().empty()
+    replay = broker.subscribe(last_event_id=1)
+    assert [replay.get_nowait()[0] for _ in range(replay.qsize())] == [3, 4]
+    broker.publish('check_out', {'staff_id': 1, 'date': 'd', 'log_id': 4})
+    assert replay.get_nowait()[:2] == (5, 'check_out')
+    broker.unsubscribe(replay)
+    assert broker.stats() == {'version': 5, 'subscribers': 1}
+    today_cache.clear()
+    get_pool().close_all()
+
+def test_bulk_events(tmp_path):
+    from app import app, init_db, get_db, get_pool, apply_bulk_events
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'bulk.db')
+    init_db()
+    client_info = {'ip_address': '10.0.0.5', 'user_agent': 'badge-reader'}
+    with app.app_context():
+        conn = get_db()
+        conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+        conn.commit()
+        results = apply_bulk_events(conn, [
+            {'type': 'check_out', 'staff_id': 1, 'timestamp': '2024-03-04T17:00:00'},
+            {'type': 'check_in', 'staff_id': 1, 'timestamp': '2024-03-04T09:20:00'},
+            {'type': 'break_start', 'staff_id': 1, 'timestamp': '2024-03-04T12:00:00', 'break_type': 'lunch'},
+            {'type': 'break_end', 'staff_id': 1, 'timestamp': '2024-03-04T12:40:00'},
+            {'type': 'check_in', 'staff_id': 1, 'timestamp': '2024-03-04T10:00:00'},
+            {'type': 'check_in', 'staff_id': 2, 'timestamp': '2024-03-04T10:00:00'},
+            {'type': 'check_in', 'staff_id': 1},
+        ], client_info)
+        
+        # Events are replayed in timestamp order, so the check-out lands last
+        assert [r['status'] for r in results] == [
+            'ok', 'ok', 'ok', 'ok', 'already_checked_in', 'unknown_staff', 'invalid'
+        ]
+        assert results[1]['is_late'] and results[3]['duration'] == 40
+        
+        log = conn.execute('SELECT check_out_time, total_break_time, is_late FROM check_in_logs').fetchone()
+        assert log['check_out_time'] == datetime(2024, 3, 4, 17, 0)
+        assert log['total_break_time'] == 40 and log['is_late']
+        assert conn.execute('SELECT COUNT(*) FROM break_logs WHERE break_end IS NULL').fetchone()[0] == 0
+    
+    # The body format follows the Content-Type, so pretty-printed JSON is not read as NDJSON
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='A', user_role='admin')
+    pretty = '{\n  "events": [\n    {"type": "check_in", "staff_id": 1, "timestamp": "2024-03-05T09:00:00"}\n  ]\n}'
+    response = client.post('/api/bulk_events', data=pretty, content_type='application/json')
+    assert response.status_code == 200 and response.json['applied'] == 1
+    ndjson = '{"type": "check_out", "staff_id": 1, "timestamp": "2024-03-05T17:00:00"}\n'
+    response = client.post('/api/bulk_events', data=ndjson, content_type='application/x-ndjson')
+    assert response.status_code == 200 and response.json['applied'] == 1
+    assert client.post('/api/bulk_events', data=ndjson, content_type='application/json').status_code == 400
+    assert client.post('/api/bulk_events', data=ndjson, content_type='text/plain').status_code == 415
+    get_pool().close_all()
+
+def test_request_instrumentation(tmp_path, caplog):
+    from flask import g, Response
+    from app import app, init_db, get_db, request_metrics
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'metrics.db')
+    init_db()
+    with app.test_request_context('/reports'):
+        app.preprocess_request()
+        conn = get_db()
+        # A freshly opened pool connection has already run its setup PRAGMAs
+        stats = g.query_stats
+        setup_queries = stats.queries
+        conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+        assert len(conn.execute('SELECT * FROM staff').fetchall()) == 1
+        for _ in conn.execute('SELECT id FROM staff'):
+            pass
+        assert stats.queries == setup_queries + 3
+        assert stats.statements['SELECT * FROM staff'][0] == 1
+        assert stats.statements['SELECT id FROM staff'][2] == 1
+        
+        response = app.process_response(Response('ok'))
+        assert 'db;dur=' in response.headers['Server-Timing']
+    
+    # Teardown folds the request into the per-route totals
+    assert f'checkin_db_queries_total{{route="reports",method="GET"}} {setup_queries + 3}' in request_metrics.render()
+    
+    # Slow statements are logged with their plan but never their bound values
+    slow_query_ms = app.config['SLOW_QUERY_MS']
+    app.config['SLOW_QUERY_MS'] = 1e-6
+    try:
+        with app.test_request_context('/login'):
+            app.preprocess_request()
+            get_db().execute('SELECT id FROM staff WHERE email = ? AND password = ?', ('a@x.com', 'secret-hash')).fetchall()
+    finally:
+        app.config['SLOW_QUERY_MS'] = slow_query_ms
+    logged = '\n'.join(record.getMessage() for record in caplog.records if 'Slow query' in record.getMessage())
+    assert 'WHERE email = ? AND password = ?' in logged and 'params: 2 bound' in logged
+    assert 'secret-hash' not in logged and 'a@x.com' not in logged
+
+def test_password_rehash():
+    from werkzeug.security import generate_password_hash
+    from app import app, Config, PasswordHasher, PasswordHasherBusy, password_needs_rehash
+    
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    try:
+        assert not password_needs_rehash(generate_password_hash('pw', 'pbkdf2:sha256:1000'))
+        assert password_needs_rehash(generate_password_hash('pw', 'pbkdf2:sha256:2000'))
+        assert password_needs_rehash(generate_password_hash('pw', 'scrypt'))
+    finally:
+        app.config['PASSWORD_HASH_METHOD'] = Config.PASSWORD_HASH_METHOD
+    
+    # workers=0 hashes inline; a full admission limit refuses new jobs
+    inline = PasswordHasher(workers=0)
+    assert inline.check(inline.generate('pw', 'pbkdf2:sha256:1000'), 'pw')
+    full = PasswordHasher(workers=1, max_pending=1)
+    full._slots.acquire()
+    try:
+        full.check('pbkdf2:sha256:1000$x$y', 'pw')
+        assert False, 'expected PasswordHasherBusy'
+    except PasswordHasherBusy:
+        pass
+    assert full.stats()['rejected'] == 1
+    full._slots.release()
+    
+    # A job its caller stopped waiting for still holds its slot until it finishes
+    import time
+    slow = PasswordHasher(workers=1, max_pending=1, timeout=0.05)
+    try:
+        with pytest.raises(PasswordHasherBusy):
+            slow._run(time.sleep, 2)
+        with pytest.raises(PasswordHasherBusy):
+            slow._run(time.sleep, 0)
+        assert slow.stats()['timeouts'] == 1 and slow.stats()['rejected'] == 1
+        assert slow._slots.acquire(timeout=30)
+        slow._slots.release()
+    finally:
+        slow.shutdown()
+
+def test_cascade_deletes_migration(tmp_path):
+    from app import app, init_db, get_pool
+    
+    # The original schema: foreign keys without ON DELETE and ISO-string timestamps
+    app.config['DATABASE_PATH'] = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.executescript('''
+        CREATE TABLE staff (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL, role TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE check_in_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, staff_id INTEGER NOT NULL, check_in_time TIMESTAMP,
+            check_out_time TIMESTAMP, date TEXT NOT NULL, is_late BOOLEAN DEFAULT FALSE, late_reason TEXT,
+            total_break_time INTEGER DEFAULT 0,
+            FOREIGN KEY (staff_id) REFERENCES staff (id)
+        );
+        CREATE INDEX idx_check_in_logs_staff_date ON check_in_logs(staff_id, date);
+        CREATE TABLE break_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, check_in_log_id INTEGER NOT NULL, break_start TIMESTAMP NOT NULL,
+            break_end TIMESTAMP, break_type TEXT NOT NULL,
+            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id)
+        );
+        CREATE TABLE location_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, check_in_log_id INTEGER NOT NULL, ip_address TEXT NOT NULL,
+            browser TEXT, is_mobile BOOLEAN, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (check_in_log_id) REFERENCES check_in_logs (id)
+        );
+        INSERT INTO staff (name, email, password, role) VALUES ('Admin', 'admin@x.com', 'x', 'admin'), ('A', 'a@x.com', 'x', 'staff');
+        -- Log 2 belongs to a staff member deleted long ago; break 2 and location 2 hang off it
+        INSERT INTO check_in_logs (staff_id, check_in_time, date) VALUES
+            (2, '2024-03-04 09:00:00', '2024-03-04'), (99, '2024-03-04 09:00:00', '2024-03-04');
+        INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES
+            (1, '2024-03-04 12:00:00', '2024-03-04 12:30:00', 'lunch'), (2, '2024-03-04 12:00:00', NULL, 'short');
+        INSERT INTO location_logs (check_in_log_id, ip_address, browser, is_mobile) VALUES
+            (1, '10.0.0.1', 'Firefox', 0), (2, '10.0.0.2', 'Chrome', 0);
+    ''')
+    conn.commit()
+    conn.close()
+    
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    for table_name in ('check_in_logs', 'break_logs', 'location_logs'):
+        foreign_keys = conn.execute(f'PRAGMA foreign_key_list({table_name})').fetchall()
+        assert [row[6] for row in foreign_keys if row[2] in ('staff', 'check_in_logs')] == ['CASCADE'], table_name
+    assert [conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0] for t in ('check_in_logs', 'break_logs', 'location_logs')] == [1, 1, 1]
+    assert conn.execute('PRAGMA foreign_key_check').fetchall() == []
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='Admin', user_role='admin')
+    client.post('/delete_staff/2')
+    assert [conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0]
+            for t in ('staff', 'check_in_logs', 'break_logs', 'location_logs', 'daily_attendance_summary')] == [1, 0, 0, 0, 0]
+    conn.close()
+    get_pool().close_all()
+
+def test_server_side_sessions(tmp_path):
+    import time
+    from flask import request, Response
+    from app import app, init_db, FileSessionStore, SQLiteSessionStore, ServerSideSessionInterface
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'sessions.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'admin')")
+    conn.commit()
+    
+    worker = ServerSideSessionInterface(SQLiteSessionStore())
+    with app.test_request_context():
+        sess = worker.open_session(app, request)
+        sess['user_id'] = 1
+        sess['user_role'] = 'admin'
+        response = Response()
+        worker.save_session(app, sess, response)
+    sid = sess.sid
+    assert f'session={sid}' in response.headers['Set-Cookie']
+    
+    # Another worker (or a restart) finds the same session in the store
+    other = ServerSideSessionInterface(SQLiteSessionStore())
+    with app.test_request_context(headers={'Cookie': f'session={sid}'}):
+        assert other.open_session(app, request)['user_role'] == 'admin'
+    assert other.stats()['misses'] == 1
+    
+    # Deleting the staff member cascades to their sessions
+    conn.execute('PRAGMA foreign_keys=ON')
+    conn.execute('DELETE FROM staff WHERE id = 1')
+    conn.commit()
+    assert conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] == 0
+    conn.close()
+    assert SQLiteSessionStore().sweep(time.time()) == 0
+    
+    # A cookie that is not a generated session id is never used as a file name
+    (tmp_path / 'victim.json').write_text('{"data": "{}", "expires_at": 9999999999, "user_id": null}')
+    store_dir = tmp_path / 'sessions'
+    store_dir.mkdir()
+    files = ServerSideSessionInterface(FileSessionStore(str(store_dir)))
+    with app.test_request_context(headers={'Cookie': 'session=../victim'}):
+        sess = files.open_session(app, request)
+        assert sess.sid != '../victim' and files.stats()['misses'] == 0
+        sess['user_id'] = 1
+        files.save_session(app, sess, Response())
+    assert (tmp_path / 'victim.json').exists() and len(list(store_dir.iterdir())) == 1
+
+def test_range_report(tmp_path):
+    from app import app, init_db, get_pool, range_report
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'range.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO staff (name, email, password, role, created_at) VALUES (?, ?, 'x', 'staff', '2024-03-01')",
+                       [('Ann', 'ann@x.com'), ('Bob', 'bob@x.com')])
+    # Mon 4th: both in, Bob late; Tue 5th: only Ann; Sat 9th: Ann (weekend)
+    cursor.executemany('''
+        INSERT INTO check_in_logs (staff_id, check_in_time, check_out_time, date, is_late, total_break_time)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (1, datetime(2024, 3, 4, 8, 30), datetime(2024, 3, 4, 16, 30), '2024-03-04', 0, 30),
+        (2, datetime(2024, 3, 4, 9, 30), datetime(2024, 3, 4, 17, 30), '2024-03-04', 1, 0),
+        (1, datetime(2024, 3, 5, 8, 30), datetime(2024, 3, 5, 12, 30), '2024-03-05', 0, 0),
+        (1, datetime(2024, 3, 9, 10, 0), None, '2024-03-09', 1, 0),
+    ])
+    conn.commit()
+    
+    rows, next_cursor = range_report(cursor, '2024-03-04', '2024-03-10', 'day', limit=2)
+    assert [(r['period'], r['present'], r['late'], r['absences']) for r in rows] == [
+        ('2024-03-04', 2, 1, 0), ('2024-03-05', 1, 0, 1),
+    ]
+    assert rows[0]['worked_hours'] == 16 and rows[0]['late_rate'] == 0.5
+    rows, next_cursor = range_report(cursor, '2024-03-04', '2024-03-10', 'day', after=next_cursor, limit=2)
+    assert rows[0]['period'] == '2024-03-06' and rows[0]['absences'] == 2
+    
+    week, = range_report(cursor, '2024-03-04', '2024-03-10', 'week')[0]
+    assert week['period'] == '2024-03-04' and week['absences'] == 7 and week['break_minutes'] == 30
+    
+    ann, bob = range_report(cursor, '2024-03-04', '2024-03-10', 'staff')[0]
+    assert (ann['present'], ann['absences'], ann['avg_worked_hours']) == (3, 3, 6.0)
+    assert (bob['present'], bob['absences'], bob['lateness_rank']) == (1, 4, 1)
+    
+    plan = ' '.join(row[3] for row in cursor.execute(
+        'EXPLAIN QUERY PLAN SELECT date, staff_id, is_late, check_in_time, check_out_time, total_break_time '
+        "FROM check_in_logs WHERE date BETWEEN '2024-03-04' AND '2024-03-10'"))
+    assert 'COVERING INDEX idx_check_in_logs_date_cover' in plan
+    conn.close()
+    
+    # The route accepts unpadded dates and reports them in ISO form
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='Ann', user_role='admin')
+    report = client.get('/reports/range?start=2024-3-4&end=2024-3-5&group_by=day&format=json').get_json()
+    assert (report['start'], report['end']) == ('2024-03-04', '2024-03-05')
+    assert [(r['period'], r['present']) for r in report['rows']] == [('2024-03-04', 2), ('2024-03-05', 1)]
+    get_pool().close_all()
+
+def test_archive_logs(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    from app import app, init_db, archive_logs, prune_archived_logs
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'archive.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    for day in (4, 5, 6):
+        log_id = conn.execute('''
+            INSERT INTO check_in_logs (staff_id, check_in_time, check_out_time, date, is_late, total_break_time)
+            VALUES (1, ?, ?, ?, 0, 15)
+        ''', (datetime(2024, 3, day, 9), datetime(2024, 3, day, 17), f'2024-03-0{day}')).lastrowid
+        conn.execute("INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES (?, ?, ?, 'lunch')",
+                     (log_id, datetime(2024, 3, day, 12), datetime(2024, 3, day, 12, 15)))
+    conn.commit()
+    
+    out = str(tmp_path / 'archive')
+    assert [day for day, _ in archive_logs(conn, out, until='2024-03-05')] == ['2024-03-04', '2024-03-05']
+    # Later runs only append the days not yet archived
+    assert [day for day, _ in archive_logs(conn, out, until='2024-03-06')] == ['2024-03-06']
+    assert archive_logs(conn, out, until='2024-03-06') == []
+    
+    row, = pq.read_table(os.path.join(out, 'check_in_logs', 'date=2024-03-05', 'part-0.parquet')).to_pylist()
+    assert (row['staff_name'], row['check_in_time'], row['worked_seconds']) == ('A', datetime(2024, 3, 5, 9), 8 * 3600)
+    breaks = pq.read_table(os.path.join(out, 'break_logs', 'date=2024-03-05', 'part-0.parquet'))
+    assert breaks.column('duration_seconds').to_pylist() == [900]
+    
+    # A backdated check-in on an archived day is re-exported before pruning deletes it
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('B', 'b@x.com', 'x', 'staff')")
+    conn.execute("INSERT INTO check_in_logs (staff_id, check_in_time, date, is_late) VALUES (2, ?, '2024-03-05', 1)",
+                 (datetime(2024, 3, 5, 10),))
+    conn.commit()
+    assert prune_archived_logs(conn, out, '2024-03-06') == 3
+    assert conn.execute('SELECT date FROM check_in_logs').fetchall() == [('2024-03-06',)]
+    archived = pq.read_table(os.path.join(out, 'check_in_logs', 'date=2024-03-05', 'part-0.parquet'))
+    assert archived.column('staff_name').to_pylist() == ['A', 'B']
+    assert conn.execute('SELECT COUNT(*) FROM break_logs').fetchone() == (1,)
+    conn.close()
+
+def test_scheduler_jobs(tmp_path):
+    from app import app, init_db, ConnectionPool, Scheduler
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'jobs.db')
+    init_db()
+    pool = ConnectionPool(app.config['DATABASE_PATH'], max_size=2)
+    conn = pool.acquire()
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    # The 4th was never checked out and has a break left open; the 5th has a stale break total
+    conn.executemany('''
+        INSERT INTO check_in_logs (staff_id, check_in_time, check_out_time, date, is_late, total_break_time)
+        VALUES (1, ?, ?, ?, 0, ?)
+    ''', [(datetime(2024, 3, 4, 9), None, '2024-03-04', 0), (datetime(2024, 3, 5, 9), datetime(2024, 3, 5, 17), '2024-03-05', 99)])
+    conn.executemany('INSERT INTO break_logs (check_in_log_id, break_start, break_end, break_type) VALUES (?, ?, ?, ?)', [
+        (1, datetime(2024, 3, 4, 22, 30), None, 'regular'),
+        (2, datetime(2024, 3, 5, 12), datetime(2024, 3, 5, 12, 20), 'regular'),
+    ])
+    conn.commit()
+    pool.release(conn)
+    
+    intervals = {'auto_close': 900, 'recompute_break_totals': 3600, 'optimize': 3600}
+    scheduler = Scheduler(pool, intervals, nightly_hours=(1, 5))
+    results = scheduler.run_pending(now=datetime(2024, 3, 6, 2, 0))
+    assert list(results) == ['auto_close', 'recompute_break_totals', 'optimize']
+    assert results['auto_close']['result'] == {'checked_out': 1, 'breaks_closed': 1, 'totals_fixed': 1}
+    assert results['recompute_break_totals']['result'] == {'totals_fixed': 1}
+    
+    conn = pool.acquire()
+    assert [tuple(row) for row in conn.execute('SELECT check_out_time, total_break_time FROM check_in_logs ORDER BY id')] == [
+        (datetime(2024, 3, 4, 23, 0), 30), (datetime(2024, 3, 5, 17), 20),
+    ]
+    assert tuple(conn.execute("SELECT runs, last_status FROM scheduler_jobs WHERE name = 'optimize'").fetchone()) == (1, 'ok')
+    pool.release(conn)
+    
+    # Nothing is due again yet, and a second worker cannot take the lease
+    assert scheduler.run_pending(now=datetime(2024, 3, 6, 2, 5)) == {}
+    assert Scheduler(pool, intervals).run_pending(now=datetime(2024, 3, 6, 2, 30)) is None
+    scheduler.stop()
+    assert list(Scheduler(pool, intervals).run_pending(now=datetime(2024, 3, 6, 2, 30))) == ['auto_close']
+    pool.close_all()
+
+def test_dashboard_fragments(tmp_path):
+    from app import app, init_db, get_pool
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'dashboard.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.executemany("INSERT INTO staff (name, email, password, role) VALUES (?, ?, 'x', ?)",
+                     [('Admin', 'admin@x.com', 'admin')] + [(f'Staff {i:02d}', f's{i}@x.com', 'staff') for i in range(30)])
+    conn.commit()
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='Admin', user_role='admin')
+    response = client.get('/dashboard')
+    assert b'Page 1 of 2' in response.data and response.headers['Cache-Control'] == 'private, no-cache'
+    etag = response.headers['ETag']
+    assert client.get('/dashboard', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/dashboard?staff_q=staff 1').data.count(b'bi-person-circle') == 10
+    
+    # Any write to staff bumps its version, so the cached page is stale
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('New', 'new@x.com', 'x', 'staff')")
+    conn.commit()
+    assert conn.execute("SELECT version FROM data_versions WHERE name = 'staff'").fetchone()[0] == 32
+    response = client.get('/dashboard', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and b'(32 staff)' in response.data
+    conn.close()
+    get_pool().close_all()
+
+def test_static_assets(tmp_path):
+    import gzip
+    from app import StaticAssets
+    
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'css' / 'site.css').write_text('body { color: red; }\n' * 50)
+    (tmp_path / 'uploads').mkdir()
+    (tmp_path / 'uploads' / 'photo.jpg').write_bytes(b'jpeg')
+    (tmp_path / 'sw.js').write_text('const CACHE_NAME = `v-${CACHE_VERSION}`;\n')
+    assets = StaticAssets(str(tmp_path), exclude=('uploads/',), unversioned=('sw.js',))
+    
+    fingerprinted = assets.url_name('css/site.css')
+    assert fingerprinted.startswith('css/site.') and fingerprinted.endswith('.css')
+    assert assets.url_name('uploads/photo.jpg') == 'uploads/photo.jpg'
+    asset, immutable = assets.lookup(fingerprinted)
+    assert immutable and not assets.lookup('css/site.css')[1]
+    assert gzip.decompress(asset['variants']['gzip']) == (tmp_path / 'css' / 'site.css').read_bytes()
+    
+    sw, immutable = assets.lookup('sw.js')
+    assert not immutable and f'/static/{fingerprinted}'.encode() in sw['variants']['identity']
+
+def test_asgi_entry_point(tmp_path):
+    import asyncio
+    import json
+    import secrets
+    import time
+    from app import app, init_db, get_pool, event_broker, SQLiteSessionStore, ServerSideSessionInterface
+    
+    batching = app.config['INGEST_BATCHING']
+    import asgi
+    app.config['DATABASE_PATH'] = str(tmp_path / 'asgi.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('A', 'a@x.com', 'x', 'staff')")
+    conn.commit()
+    conn.close()
+    data = ServerSideSessionInterface.serializer.dumps({'user_id': 1, 'user_name': 'A', 'user_role': 'staff'})
+    sid = secrets.token_urlsafe(32)
+    SQLiteSessionStore().save(sid, data, time.time() + 60, 1)
+    
+    async def call(path, cookie='', publish=None):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'http_version': '1.1',
+                 'headers': [(b'cookie', cookie.encode())]}
+        sent, closed = [], asyncio.Event()
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        async def receive():
+            if messages:
+                return messages.pop()
+            await closed.wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        task = asyncio.ensure_future(asgi.application(scope, receive, send))
+        if publish:
+            while not sent:
+                await asyncio.sleep(0.01)
+            publish()
+            await asyncio.sleep(0.1)
+            closed.set()
+        await task
+        return sent
+    
+    try:
+        assert asyncio.run(call('/api/status'))[0]['status'] == 401
+        sent = asyncio.run(call('/api/status', f'session={sid}'))
+        assert json.loads(sent[1]['body'])['state'] == 'not_checked_in'
+        assert asyncio.run(call('/login'))[0]['status'] == 200
+        
+        # Staff streams only carry their own events
+        publish = lambda: (event_broker.publish('check_in', {'staff_id': 2, 'date': 'd', 'log_id': 1}),
+                           event_broker.publish('check_in', {'staff_id': 1, 'date': 'd', 'log_id': 2}))
+        body = b''.join(m.get('body', b'') for m in asyncio.run(call('/api/events', f'session={sid}', publish)))
+        assert body.count(b'event: check_in') == 1 and b'"log_id": 2' in body
+        assert event_broker.stats()['subscribers'] == 0
+    finally:
+        app.config['INGEST_BATCHING'] = batching
+        asgi.application.db.close()
+        get_pool().close_all()
+    
+    # A body that fails mid-stream ends the response instead of starting a second one
+    def failing_body():
+        yield b'partial'
+        raise ValueError('boom')
+    def failing_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return failing_body()
+    bridge = asgi.WSGIBridge(failing_app, 1)
+    sent = []
+    async def send(message):
+        sent.append(message)
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'http_version': '1.1', 'headers': []}
+    asyncio.run(bridge(scope, receive, send))
+    assert [m['type'] for m in sent].count('http.response.start') == 1
+    assert sent[0]['status'] == 200 and sent[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    bridge.executor.shutdown()
+
+def test_structured_request_logs(tmp_path):
+    import io
+    import json
+    from app import app, init_db, get_pool, logger, LogPipeline
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'logs.db')
+    init_db()
+    stream = io.StringIO()
+    pipeline = LogPipeline(stream)
+    logger.addHandler(pipeline.queue_handler)
+    try:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess.update(user_id=7, user_name='A', user_role='staff')
+        response = client.get('/api/status', headers={'X-Request-ID': 'req-1'})
+        assert response.headers['X-Request-ID'] == 'req-1'
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('outside a request')
+    finally:
+        logger.removeHandler(pipeline.queue_handler)
+        pipeline.stop()
+        get_pool().close_all()
+    
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    request_log = next(r for r in records if r.get('request_id') == 'req-1' and 'status' in r)
+    assert request_log['route'] == 'api_status' and request_log['user_id'] == 7
+    assert request_log['status'] == 200 and request_log['duration_ms'] >= 0
+    assert 'ValueError: boom' in records[-1]['exception'] and 'request_id' not in records[-1]
+
+def test_user_agent_dimension(tmp_path):
+    from app import app, init_db, get_pool, parse_user_agent, UserAgentCache
+    
+    iphone = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 Version/17.1 Mobile/15E148 Safari/604.1'
+    edge = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0'
+    assert parse_user_agent(iphone) == {'browser': 'Safari', 'os': 'iOS', 'device': 'mobile', 'is_mobile': True}
+    assert parse_user_agent(edge) == {'browser': 'Edge', 'os': 'Windows', 'device': 'desktop', 'is_mobile': False}
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'ua.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    cache = UserAgentCache(max_entries=1)
+    # A fresh insert is not cached until it has been read back committed
+    first = cache.intern(conn.cursor(), iphone)
+    conn.commit()
+    assert cache.intern(conn.cursor(), iphone) == first and cache.intern(conn.cursor(), iphone) == first
+    assert cache.stats()['hits'] == 1
+    cache.intern(conn.cursor(), edge)
+    assert conn.execute('SELECT COUNT(*) FROM user_agents').fetchone()[0] == 2
+    assert [row[1] for row in conn.execute('PRAGMA table_info(location_logs)')].count('user_agent_id') == 1
+    conn.close()
+    get_pool().close_all()
+
+def test_network_classification(tmp_path):
+    from app import (app, init_db, get_pool, record_check_in, client_info_for, classify_location_logs,
+                     range_report, PrefixTrie, Config)
+    
+    trie = PrefixTrie()
+    for cidr, value in (('10.0.0.0/8', 'a'), ('10.1.2.0/23', 'b'), ('10.1.3.128/25', 'c'), ('2001:db8::/32', 'd')):
+        trie.insert(cidr, value)
+    assert [trie.lookup(ip) for ip in ('10.9.9.9', '10.1.3.5', '10.1.3.200', '::ffff:10.1.3.200', '2001:db8::1')] == \
+        ['a', 'b', 'c', 'c', 'd']
+    assert trie.lookup('11.0.0.1') is None and trie.lookup('Unknown') is None
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'networks.db')
+    app.config.update(OFFICE_NETWORKS={'10.1.0.0/16': 'HQ'}, VPN_NETWORKS={'10.250.0.0/16': 'Corp VPN'})
+    try:
+        init_db()
+        conn = sqlite3.connect(app.config['DATABASE_PATH'], detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.row_factory = sqlite3.Row
+        conn.executemany("INSERT INTO staff (name, email, password, role) VALUES (?, ?, 'x', 'staff')",
+                         [('A', 'a@x.com'), ('B', 'b@x.com'), ('C', 'c@x.com')])
+        for staff_id, ip in ((1, '10.1.4.20'), (2, '10.250.0.9'), (3, '203.0.113.7')):
+            record_check_in(conn.cursor(), staff_id, datetime(2024, 3, 4, 9, 30), True, None, client_info_for(ip, 'test'))
+        conn.commit()
+        assert [tuple(row) for row in conn.execute('SELECT site, network_type FROM location_logs ORDER BY id')] == \
+            [('HQ', 'onsite'), ('Corp VPN', 'vpn'), (None, 'remote')]
+        rows, _ = range_report(conn.cursor(), '2024-03-04', '2024-03-04', 'site')
+        assert [(row['period'], row['present'], row['late']) for row in rows] == \
+            [('Corp VPN', 1, 1), ('HQ', 1, 1), ('Remote', 1, 1)]
+        
+        # A new office range only applies to old rows once they are reclassified
+        app.config['OFFICE_NETWORKS'] = {'10.1.0.0/16': 'HQ', '203.0.113.0/24': 'Annex'}
+        assert classify_location_logs(conn.cursor()) == 1
+        assert conn.execute("SELECT COUNT(*) FROM location_logs WHERE site = 'Annex'").fetchone()[0] == 1
+        conn.close()
+    finally:
+        app.config.update(OFFICE_NETWORKS=Config.OFFICE_NETWORKS, VPN_NETWORKS=Config.VPN_NETWORKS)
+        get_pool().close_all()
+
+def test_report_replica(tmp_path):
+    from app import app, init_db, get_pool, get_report_replica
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'live.db')
+    init_db()
+    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn.execute("INSERT INTO staff (name, email, password, role) VALUES ('Admin', 'admin@x.com', 'x', 'admin')")
+    conn.commit()
+    replica = get_report_replica()
+    assert replica.path == str(tmp_path / 'live.report.db')
+    assert replica.refresh()['copied'] and replica.refresh() == {'copied': False}
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(user_id=1, user_name='Admin', user_role='admin')
+    conn.execute("INSERT INTO check_in_logs (staff_id, check_in_time, date, is_late) VALUES (1, ?, date('now', 'localtime'), 0)",
+                 (datetime.now(),))
+    conn.commit()
+    # Reads within the staleness bound get the snapshot, stamped with its age
+    response = client.get('/reports')
+    assert b'Data as of' in response.data and b'Admin' not in response.data.split(b'<tbody')[-1]
+    replica.invalidate()
+    assert b'Admin' in client.get('/reports').data.split(b'<tbody')[-1]
+    assert client.get('/export_report').last_modified is not None
+    
+    replica_conn = replica.connect(max_age=60)
+    with pytest.raises(sqlite3.OperationalError, match='readonly'):
+        replica_conn.execute('DELETE FROM staff')
+    replica_conn.close()
+    conn.close()
+    get_pool().close_all()
+
+def test_office_shards(tmp_path):
+    from app import app, init_db, shard_pools, shard_for_id, move_staff, Config, SHARD_ID_BITS
+    
+    app.config['DATABASE_PATH'] = str(tmp_path / 'main.db')
+    app.config['SHARDS'] = {'lagos': (1, str(tmp_path / 'lagos.db'))}
+    # Cheap inline hashes for the registrations below
+    app.config.update(PASSWORD_HASH_METHOD='pbkdf2:sha256:1000', PASSWORD_HASH_WORKERS=0)
+    try:
+        init_db()
+        main = sqlite3.connect(app.config['DATABASE_PATH'])
+        lagos = sqlite3.connect(str(tmp_path / 'lagos.db'))
+        main.execute("INSERT INTO staff (name, email, password, role) VALUES ('Admin', 'admin@x.com', 'x', 'admin')")
+        main.commit()
+        lagos_id = lagos.execute("INSERT INTO staff (name, email, password, role) VALUES ('Ada', 'ada@x.com', 'x', 'staff') "
+                                 "RETURNING id").fetchone()[0]
+        lagos.commit()
+        # Each shard's ids start in its own range, so an id names its office
+        assert lagos_id == (1 << SHARD_ID_BITS) + 1
+        assert shard_for_id(lagos_id) == 'lagos' and shard_for_id(1) == 'main'
+        
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess.update(user_id=lagos_id, user_name='Ada', user_role='staff')
+        assert client.post('/check_in').status_code == 302
+        assert lagos.execute('SELECT staff_id FROM check_in_logs').fetchall() == [(lagos_id,)]
+        assert main.execute('SELECT COUNT(*) FROM check_in_logs').fetchone()[0] == 0
+        
+        with client.session_transaction() as sess:
+            sess.update(user_id=1, user_name='Admin', user_role='admin')
+        assert b'Ada' in client.get('/reports').data
+        assert b'Ada' in client.get('/export_report').data
+        
+        new_id = move_staff(lagos_id, 'main')
+        assert shard_for_id(new_id) == 'main'
+        assert main.execute('SELECT staff_id FROM check_in_logs').fetchall() == [(new_id,)]
+        assert lagos.execute('SELECT COUNT(*) FROM staff').fetchone()[0] == 0
+        assert set(shard_pools()) == {'main', 'lagos'}
+        
+        # Emails are reserved in the home shard, so they stay unique across offices
+        init_db()
+        assert main.execute('SELECT email FROM staff_emails ORDER BY email').fetchall() == [('ada@x.com',), ('admin@x.com',)]
+        client.post('/register', data={'name': 'Bo', 'email': 'bo@x.com', 'password': 'pw', 'role': 'staff', 'office': 'lagos'})
+        client.post('/register', data={'name': 'Bo 2', 'email': 'bo@x.com', 'password': 'pw', 'role': 'staff', 'office': 'main'})
+        client.post('/register', data={'name': 'Ada 2', 'email': 'ada@x.com', 'password': 'pw', 'role': 'staff', 'office': 'lagos'})
+        assert lagos.execute('SELECT name FROM staff').fetchall() == [('Bo',)]
+        assert main.execute('SELECT name FROM staff ORDER BY id').fetchall() == [('Admin',), ('Ada',)]
+        bo_id = lagos.execute('SELECT id FROM staff').fetchone()[0]
+        client.post(f'/delete_staff/{bo_id}')
+        assert main.execute("SELECT COUNT(*) FROM staff_emails WHERE email = 'bo@x.com'").fetchone()[0] == 0
+        client.post('/register', data={'name': 'Bo', 'email': 'bo@x.com', 'password': 'pw', 'role': 'staff', 'office': 'main'})
+        assert main.execute("SELECT COUNT(*) FROM staff WHERE email = 'bo@x.com'").fetchone()[0] == 1
+        main.close()
+        lagos.close()
+    finally:
+        for pool in shard_pools().values():
+            pool.close_all()
+        app.config['SHARDS'] = {}
+        app.config.update(PASSWORD_HASH_METHOD=Config.PASSWORD_HASH_METHOD,
+                          PASSWORD_HASH_WORKERS=Config.PASSWORD_HASH_WORKERS)
+
 if __name__ == '__main__':
     print("=== Check-In System Feature Test ===\n")
     